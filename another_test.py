@@ -106,10 +106,70 @@ if __name__ == '__main__':
         access_token = config.get(botname, 'access_token')
         access_token_secret = config.get(botname, 'access_token_secret')
 
+        # Get the size and overflow policy of the queue of monitored tweets,
+        # if they're set.
+        tweet_queue_size = 10000
+        if config.has_option(botname, 'tweet_queue_size'):
+            tweet_queue_size = config.getint(botname, 'tweet_queue_size')
+        tweet_queue_policy = 'drop-oldest'
+        if config.has_option(botname, 'tweet_queue_policy'):
+            tweet_queue_policy = config.get(botname, 'tweet_queue_policy')
+
+        # Get whether the queue of monitored tweets spills to disk and where,
+        # if they're set.
+        tweet_queue_backend = 'memory'
+        if config.has_option(botname, 'tweet_queue_backend'):
+            tweet_queue_backend = config.get(botname, 'tweet_queue_backend')
+        tweet_queue_directory = None
+        if config.has_option(botname, 'tweet_queue_directory'):
+            tweet_queue_directory = config.get(botname,
+                'tweet_queue_directory')
+
+        # Get the number and kind of workers that decode tweets from the
+        # stream, if they're set.
+        decode_workers = 1
+        if config.has_option(botname, 'decode_workers'):
+            decode_workers = config.getint(botname, 'decode_workers')
+        decode_mode = 'thread'
+        if config.has_option(botname, 'decode_mode'):
+            decode_mode = config.get(botname, 'decode_mode')
+
+        # Get whether duplicate tweets (and near duplicates) are thrown away,
+        # how many tweets the duplicate filter remembers, and the rate at
+        # which it's allowed to mistake a new tweet for a duplicate, if
+        # they're set.
+        deduplicate = True
+        if config.has_option(botname, 'deduplicate'):
+            deduplicate = config.getboolean(botname, 'deduplicate')
+        near_duplicates = False
+        if config.has_option(botname, 'dedup_near_duplicates'):
+            near_duplicates = config.getboolean(botname,
+                'dedup_near_duplicates')
+        dedup_capacity = 100000
+        if config.has_option(botname, 'dedup_capacity'):
+            dedup_capacity = config.getint(botname, 'dedup_capacity')
+        dedup_error_rate = 0.001
+        if config.has_option(botname, 'dedup_error_rate'):
+            dedup_error_rate = config.getfloat(botname, 'dedup_error_rate')
+
+        # Get the directory the archive of tweets goes in, if it's set.
+        tweet_archive = None
+        if config.has_option(botname, 'tweet_archive'):
+            tweet_archive = config.get(botname, 'tweet_archive')
+
+        # Get the database file that the bot's owner's own tweets are imported
+        # into, if it's set.
+        tweet_database = None
+        if config.has_option(botname, 'tweet_database'):
+            tweet_database = config.get(botname, 'tweet_database')
+
         # Instantiate a Twitter bot.
         bot = TwitterBot(owner, botname, username, password, muc, muclogin,
             imalive, responsefile, function, api_key, api_secret, access_token,
-            access_token_secret)
+            access_token_secret, tweet_queue_size, tweet_queue_policy,
+            decode_workers, decode_mode, tweet_archive, dedup_capacity,
+            dedup_error_rate, tweet_queue_backend, tweet_queue_directory,
+            tweet_database, deduplicate, near_duplicates)
     else:
         print "No other kinds of microblog bots are defined yet."
         sys.exit(0)
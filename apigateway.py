@@ -0,0 +1,425 @@
+#!/usr/bin/env python2
+# -*- coding: utf-8 -*-
+# vim: set expandtab tabstop=4 shiftwidth=4 :
+
+# This is an Exocortex helper class that every call to Twitter's REST API
+# goes through, so that the bot keeps track of its rate limits instead of
+# finding out about them from a TweepError.
+# - Every endpoint's quota (how many calls are left in the current window,
+#   and when the window resets) is read from the x-rate-limit-* headers of
+#   every response, and from rate_limit_status() whenever it's called.
+# - A call to an endpoint whose quota is used up waits until the window
+#   resets instead of failing.  If Twitter says the quota is used up anyway
+#   (HTTP 429), the call waits for the reset and tries again once.
+# - Calls are either interactive (the bot's owner is waiting for the answer)
+#   or background (polling).  When calls to an endpoint are waiting,
+#   interactive ones go first.  Background calls also leave the last few
+#   calls of every window for interactive ones.
+# - Per-endpoint utilization (calls made, calls left, time spent waiting) is
+#   reported in the bot's status.
+# - tweepy keeps the last response in the API object, so when two threads
+#   shared one, a call could pick up the quota headers of another endpoint's
+#   call and throttle the wrong endpoint.  Every thread makes its calls
+#   through its own shallow copy of the API object instead, so the headers
+#   that are read after a call are always that call's.
+
+# TODO:
+# -
+
+# By: The Doctor <drwho at virtadpt dot net>
+#     0x807B17C1 / 7960 1CDC 85C9 0B63 8D9F  DD89 3BD8 FF2B 807B 17C1
+
+# License: GPLv3
+# Pre-requisite modules have their own licenses.
+
+# Load modules.
+import copy
+import heapq
+import itertools
+import sys
+import threading
+import time
+
+# Resource paths of the endpoints behind the tweepy API methods the bots use.
+# These are the names that rate_limit_status() uses.
+ENDPOINTS = {
+    'followers': '/followers/list',
+    'get_user': '/users/show/:id',
+    'home_timeline': '/statuses/home_timeline',
+    'lookup_users': '/users/lookup',
+    'me': '/account/verify_credentials',
+    'mentions_timeline': '/statuses/mentions_timeline',
+    'rate_limit_status': '/application/rate_limit_status',
+    'search': '/search/tweets',
+    'trends_available': '/trends/available',
+    'trends_place': '/trends/place',
+    'user_timeline': '/statuses/user_timeline',
+}
+
+# How long to wait after a 429 that didn't say when the window resets.
+DEFAULT_BACKOFF = 60
+
+# Classes.
+""" This class holds what's known about one endpoint's rate limit. """
+class Endpoint(object):
+    __slots__ = ('name', 'limit', 'remaining', 'reset', 'calls', 'waited',
+        'rejected', 'waiters')
+
+    def __init__(self, name):
+        self.name = name
+
+        # Calls allowed per window, calls left in this one, and when it
+        # resets (seconds since the epoch).  None means unknown.
+        self.limit = None
+        self.remaining = None
+        self.reset = None
+
+        # Calls made, seconds spent waiting for the quota, and 429s.
+        self.calls = 0
+        self.waited = 0.0
+        self.rejected = 0
+
+        # Heap of (priority, ticket) of the calls waiting to go.
+        self.waiters = []
+
+    """ If the window has reset, start a new one. """
+    def refresh(self, now):
+        if self.reset is not None and now >= self.reset:
+            self.remaining = self.limit
+            self.reset = None
+
+""" This class makes calls to the API.  Calls are made in the thread that
+asks for them. """
+class APIGateway(object):
+    # Priorities.  Lower numbers go first.
+    INTERACTIVE = 0
+    BACKGROUND = 1
+
+    # How many calls in every window background calls leave for interactive
+    # ones.
+    reserve = 2
+
+    # The tweepy API object.  Calls are made through per-thread copies of it.
+    api = None
+
+    # Resource path -> Endpoint.
+    endpoints = {}
+
+    def __init__(self, api, reserve=None):
+        self.api = api
+        if reserve is not None:
+            self.reserve = reserve
+        self.endpoints = {}
+        self.condition = threading.Condition()
+        self.tickets = itertools.count()
+        self.local = threading.local()
+
+    """ Returns this thread's copy of the tweepy API object.  The copy shares
+    everything (the auth handler, the parser) with the original except the
+    last response. """
+    def _api(self):
+        api = getattr(self.local, 'api', None)
+        if api is None:
+            api = self.local.api = copy.copy(self.api)
+        return api
+
+    """ Returns the Endpoint for a tweepy method.  Called with the lock
+    held. """
+    def _endpoint(self, method):
+        name = ENDPOINTS.get(method, method)
+        endpoint = self.endpoints.get(name)
+        if endpoint is None:
+            endpoint = self.endpoints[name] = Endpoint(name)
+        return endpoint
+
+    """ Call a tweepy API method.  'priority' is INTERACTIVE or BACKGROUND.
+    If the call has to wait for the quota, 'notify' (if it's given) is called
+    with the endpoint's name and how many seconds the wait will be. """
+    def call(self, method, *args, **kwargs):
+        priority = kwargs.pop('priority', self.INTERACTIVE)
+        notify = kwargs.pop('notify', None)
+        with self.condition:
+            endpoint = self._endpoint(method)
+        api = self._api()
+        for attempt in (1, 2):
+            self._acquire(endpoint, priority, notify)
+            api.last_response = None
+            try:
+                result = getattr(api, method)(*args, **kwargs)
+            except Exception as error:
+                if _status(error) != 429 or attempt == 2:
+                    raise
+                with self.condition:
+                    endpoint.rejected += 1
+                    endpoint.remaining = 0
+                    reset = _reset(getattr(error, 'response', None))
+                    endpoint.reset = reset or time.time() + DEFAULT_BACKOFF
+                continue
+            finally:
+                self._update(endpoint, getattr(api, 'last_response', None))
+            if method == 'rate_limit_status':
+                self._update_all(result)
+            return result
+
+    """ Wait until a call can be made to an endpoint, then count it against
+    the quota. """
+    def _acquire(self, endpoint, priority, notify):
+        with self.condition:
+            ticket = (priority, next(self.tickets))
+            heapq.heappush(endpoint.waiters, ticket)
+            started = time.time()
+            notified = False
+            try:
+                while True:
+                    now = time.time()
+                    endpoint.refresh(now)
+                    reserve = self.reserve if priority == self.BACKGROUND \
+                        else 0
+                    allowed = endpoint.remaining is None or \
+                        endpoint.remaining > reserve
+                    if allowed and endpoint.waiters[0] == ticket:
+                        break
+                    if allowed:
+                        # Somebody more important is ahead of this call.
+                        self.condition.wait(1.0)
+                        continue
+                    wait = (endpoint.reset or now + 1.0) - now
+                    if notify and not notified:
+                        notified = True
+                        self.condition.release()
+                        try:
+                            notify(endpoint.name, wait)
+                        finally:
+                            self.condition.acquire()
+                        continue
+                    self.condition.wait(max(0.01, min(wait, 5.0)))
+            finally:
+                endpoint.waiters.remove(ticket)
+                heapq.heapify(endpoint.waiters)
+                self.condition.notify_all()
+            if endpoint.remaining is not None:
+                endpoint.remaining -= 1
+            endpoint.calls += 1
+            endpoint.waited += time.time() - started
+
+    """ Pick an endpoint's quota out of the headers of a response. """
+    def _update(self, endpoint, response):
+        headers = _headers(response)
+        if headers is None:
+            return
+        try:
+            limit = int(headers('x-rate-limit-limit'))
+            remaining = int(headers('x-rate-limit-remaining'))
+            reset = int(headers('x-rate-limit-reset'))
+        except (TypeError, ValueError):
+            return
+        with self.condition:
+            endpoint.limit = limit
+            endpoint.remaining = remaining
+            endpoint.reset = reset
+            self.condition.notify_all()
+
+    """ Update every endpoint from what rate_limit_status() returned. """
+    def _update_all(self, status):
+        try:
+            resources = status['resources']
+        except (KeyError, TypeError):
+            return
+        with self.condition:
+            for family in resources.itervalues():
+                for (name, quota) in family.iteritems():
+                    endpoint = self.endpoints.get(name)
+                    if endpoint is None:
+                        endpoint = self.endpoints[name] = Endpoint(name)
+                    endpoint.limit = quota['limit']
+                    endpoint.remaining = quota['remaining']
+                    endpoint.reset = quota['reset']
+            self.condition.notify_all()
+
+    """ Returns an object that looks like a tweepy API object, but makes all
+    of its calls through the gateway with the given priority. """
+    def client(self, priority=INTERACTIVE, notify=None):
+        return _Client(self, priority, notify)
+
+    """ Return a list of dicts describing every endpoint that's been used. """
+    def statistics(self):
+        now = time.time()
+        with self.condition:
+            stats = []
+            for name in sorted(self.endpoints):
+                endpoint = self.endpoints[name]
+                if not endpoint.calls:
+                    continue
+                endpoint.refresh(now)
+                stats.append({'name': name, 'limit': endpoint.limit,
+                    'remaining': endpoint.remaining,
+                    'reset': max(0, int(endpoint.reset - now))
+                        if endpoint.reset else 0,
+                    'calls': endpoint.calls, 'waited': endpoint.waited,
+                    'rejected': endpoint.rejected,
+                    'waiting': len(endpoint.waiters)})
+            return stats
+
+    """ Return the utilization of every endpoint that's been used as something
+    that can be sent to the user. """
+    def status_report(self):
+        stats = self.statistics()
+        if not stats:
+            return "No calls have been made to the Twitter API yet."
+        report = "Twitter API utilization:\n"
+        for endpoint in stats:
+            if endpoint['limit'] is None:
+                quota = "quota unknown"
+            else:
+                quota = "%(remaining)d of %(limit)d calls left, resets in %(reset)d seconds" % endpoint
+            report = report + "%s: %d calls (%s), %.1f seconds spent waiting for the quota, %d rejected, %d waiting.\n" % (endpoint['name'], endpoint['calls'], quota, endpoint['waited'], endpoint['rejected'], endpoint['waiting'])
+        return report.rstrip()
+
+""" This class stands in for a tweepy API object. """
+class _Client(object):
+    def __init__(self, gateway, priority, notify):
+        self._gateway = gateway
+        self._priority = priority
+        self._notify = notify
+
+    def __getattr__(self, method):
+        gateway = self._gateway
+        priority = self._priority
+        notify = self._notify
+        def call(*args, **kwargs):
+            kwargs['priority'] = priority
+            kwargs['notify'] = notify
+            return gateway.call(method, *args, **kwargs)
+        return call
+
+""" Returns a function that looks up a header in a response from either
+version of tweepy (requests' responses or httplib's), or None. """
+def _headers(response):
+    if response is None:
+        return None
+    headers = getattr(response, 'headers', None)
+    if headers is not None and hasattr(headers, 'get'):
+        return headers.get
+    if hasattr(response, 'getheader'):
+        return response.getheader
+    return None
+
+""" Returns the HTTP status of a TweepError, or None. """
+def _status(error):
+    response = getattr(error, 'response', None)
+    status = getattr(response, 'status_code', None) or \
+        getattr(response, 'status', None)
+    if status is None and getattr(error, 'api_code', None) == 88:
+        return 429
+    return status
+
+""" Returns the reset time from the headers of a response, or None. """
+def _reset(response):
+    headers = _headers(response)
+    if headers is None:
+        return None
+    try:
+        return int(headers('x-rate-limit-reset'))
+    except (TypeError, ValueError):
+        return None
+
+# Core code...
+if __name__ == '__main__':
+    # Self tests, with a fake API that allows three searches per second.
+    class FakeResponse(object):
+        def __init__(self, headers):
+            self.headers = headers
+
+    class FakeAPI(object):
+        window = 1.0
+        limit = 3
+
+        # Like tweepy, everything but the last response is shared by the
+        # gateway's copies.
+        def __init__(self):
+            self.lock = threading.Lock()
+            self.quota = {'window_start': time.time(), 'used': 0}
+            self.order = []
+            self.last_response = None
+
+        def search(self, q):
+            with self.lock:
+                now = time.time()
+                if now - self.quota['window_start'] >= self.window:
+                    self.quota['window_start'] = now
+                    self.quota['used'] = 0
+                self.quota['used'] += 1
+                self.order.append(q)
+                reset = int(self.quota['window_start'] + self.window + 1)
+                self.last_response = FakeResponse({'x-rate-limit-limit': str(
+                    self.limit), 'x-rate-limit-remaining': str(self.limit -
+                    self.quota['used']), 'x-rate-limit-reset': str(reset)})
+                if self.quota['used'] > self.limit:
+                    raise AssertionError("The quota was exceeded.")
+                return [q]
+
+        # Slow calls to two other endpoints, with their own quotas.
+        def user_timeline(self, screen_name):
+            self.last_response = FakeResponse({'x-rate-limit-limit': '900',
+                'x-rate-limit-remaining': '899', 'x-rate-limit-reset':
+                str(int(time.time() + 900))})
+            time.sleep(0.2)
+            return []
+
+        def get_user(self, screen_name):
+            self.last_response = FakeResponse({'x-rate-limit-limit': '180',
+                'x-rate-limit-remaining': '179', 'x-rate-limit-reset':
+                str(int(time.time() + 900))})
+            return screen_name
+
+    api = FakeAPI()
+    gateway = APIGateway(api, reserve=1)
+    waits = []
+    interactive = gateway.client(APIGateway.INTERACTIVE,
+        lambda name, seconds: waits.append((name, seconds)))
+    background = gateway.client(APIGateway.BACKGROUND)
+
+    assert interactive.search(q="first") == ["first"]
+    assert gateway.endpoints['/search/tweets'].remaining == 2
+
+    # The background call leaves the last call in the window alone.
+    threads = [threading.Thread(target=background.search,
+        kwargs={'q': 'background'})]
+    threads[0].start()
+    time.sleep(0.2)
+    threads.append(threading.Thread(target=interactive.search,
+        kwargs={'q': 'interactive'}))
+    threads[1].start()
+    for thread in threads:
+        thread.join()
+    assert api.order[:3] == ["first", "background", "interactive"]
+
+    # Calls made while the quota is used up wait for the reset, and the
+    # interactive ones go first.
+    threads = [threading.Thread(target=background.search,
+        kwargs={'q': 'background %d' % i}) for i in range(3)]
+    for thread in threads:
+        thread.start()
+    time.sleep(0.1)
+    thread = threading.Thread(target=interactive.search,
+        kwargs={'q': 'impatient'})
+    thread.start()
+    threads.append(thread)
+    for thread in threads:
+        thread.join()
+    assert api.order[3] == "impatient"
+    assert waits and waits[0][0] == '/search/tweets'
+
+    # A call that finishes while another one is running gets its own quota,
+    # not the other one's.
+    thread = threading.Thread(target=background.user_timeline,
+        kwargs={'screen_name': 'slow'})
+    thread.start()
+    time.sleep(0.05)
+    assert interactive.get_user(screen_name='fast') == 'fast'
+    thread.join()
+    assert gateway.endpoints['/statuses/user_timeline'].limit == 900
+    assert gateway.endpoints['/users/show/:id'].limit == 180
+    print gateway.status_report()
+    sys.exit(0)
+# Fin.
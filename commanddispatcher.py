@@ -0,0 +1,170 @@
+#!/usr/bin/env python2
+# -*- coding: utf-8 -*-
+# vim: set expandtab tabstop=4 shiftwidth=4 :
+
+# This is an Exocortex helper module that turns the long chains of
+# 'if "foo" in message' tests in the bots' message parsers into a registry of
+# commands.  Bot classes declare which trigger phrases each of their handler
+# methods answers to with the @command decorator when the class is defined.
+# The first time a bot of a given class gets a message, every trigger phrase
+# declared anywhere in the class hierarchy gets compiled into one regular
+# expression, which picks the longest matching trigger in a single pass over
+# the message.  That way "query user activity" can't get shadowed by
+# "query user" no matter which one got written first.
+
+# TODO:
+# - Make the group chat parser use this, too.
+
+# By: The Doctor <drwho at virtadpt dot net>
+#     0x807B17C1 / 7960 1CDC 85C9 0B63 8D9F  DD89 3BD8 FF2B 807B 17C1
+
+# License: GPLv3
+# Pre-requisite modules have their own licenses.
+
+# Load modules.
+import re
+import sys
+import threading
+import timeit
+
+# Classes.
+""" This class holds a table of trigger phrases and the names of the methods
+that handle them, and matches incoming messages against all of them at once.
+It stores method names rather than bound methods so that a subclass can
+override a handler without having to re-declare its triggers. """
+class CommandDispatcher(object):
+    # Trigger phrase -> name of the method that handles it.
+    handlers = {}
+
+    # Compiled matcher for every trigger in the table.  Set to None whenever
+    # the table changes so that it'll be rebuilt the next time it's needed.
+    matcher = None
+
+    """ Set up an empty table of commands. """
+    def __init__(self):
+        self.handlers = {}
+        self.matcher = None
+        self.lock = threading.Lock()
+
+    """ Add a trigger phrase to the table.  Triggers are matched against
+    lowercased message bodies, so they're lowercased, too.  Registering a
+    trigger that already exists replaces its handler, which is how subclasses
+    override the commands of their parents. """
+    def register(self, trigger, handler):
+        with self.lock:
+            self.handlers[trigger.lower()] = handler
+            self.matcher = None
+
+    """ Build the regular expression that matches every trigger in the table.
+    The alternatives are sorted longest first, so at any given position in a
+    message the regex engine will always take the longest trigger that
+    starts there. """
+    def compile(self):
+        with self.lock:
+            triggers = sorted(self.handlers, key=len, reverse=True)
+            self.matcher = re.compile('|'.join(map(re.escape, triggers)))
+        return self.matcher
+
+    """ Scan a (lowercased) message for trigger phrases.  Returns a tuple of
+    (trigger, handler name) for the longest trigger found, or (None, None) if
+    nothing in the table matches.  Ties go to whichever trigger appears first
+    in the message. """
+    def match(self, message):
+        matcher = self.matcher
+        if matcher is None:
+            matcher = self.compile()
+
+        found = matcher.findall(message)
+        if not found:
+            return (None, None)
+        trigger = max(found, key=len)
+        return (trigger, self.handlers[trigger])
+
+""" Decorator that marks a bot method as the handler for one or more trigger
+phrases.  Handlers are called with the message stanza and the lowercased
+message body, i.e., handler(self, msg, message). """
+def command(*triggers):
+    def mark(method):
+        method.command_triggers = triggers
+        return method
+    return mark
+
+# Dispatchers that have been built already, one per bot class.
+_dispatchers = {}
+
+""" Return the dispatcher for a bot class, building it the first time it's
+asked for.  The class hierarchy is walked from the base class down so that
+commands declared in subclasses replace the ones they inherit. """
+def dispatcher_for(cls):
+    dispatcher = _dispatchers.get(cls)
+    if dispatcher is not None:
+        return dispatcher
+
+    dispatcher = CommandDispatcher()
+    for klass in reversed(cls.__mro__):
+        for name, attribute in vars(klass).items():
+            triggers = getattr(attribute, 'command_triggers', ())
+            for trigger in triggers:
+                dispatcher.register(trigger, name)
+    dispatcher.compile()
+    _dispatchers[cls] = dispatcher
+    return dispatcher
+
+# Core code...
+if __name__ == '__main__':
+    # Benchmark the dispatcher against the chain of substring tests that
+    # TwitterBot.message() and ExocortexBot.message() used to run on every
+    # message.  The lists below are the triggers in the order those chains
+    # tested them.
+    twitterbot_chain = ['help', 'twitter status', 'search hashtag',
+        'search for', 'post tweet', 'post to twitter', 'list trends',
+        'find trends', 'get archive', 'get tweets', 'get my tweets',
+        'query user activity', 'query user timeline', 'query user',
+        'monitor twitter for', 'list search terms', 'stop monitoring',
+        'delete search terms', 'stop listening for', 'delete search term']
+    exocortexbot_chain = ['help', 'robots report', 'status', 'add response',
+        'delete response', 'change response', 'replace response',
+        'dump responses', 'list responses', 'list commands', 'commands',
+        'shut down', 'shutdown']
+
+    dispatcher = CommandDispatcher()
+    for trigger in exocortexbot_chain + twitterbot_chain:
+        dispatcher.register(trigger, trigger)
+    dispatcher.compile()
+
+    def old_chain(body):
+        message = body.lower()
+        for trigger in twitterbot_chain:
+            if trigger in message:
+                return trigger
+        message = body.lower()
+        for trigger in exocortexbot_chain:
+            if trigger in message:
+                return trigger
+        return None
+
+    def new_dispatcher(body):
+        return dispatcher.match(body.lower())[0]
+
+    # Sanity checks.
+    assert new_dispatcher("Query user activity drwho 20") == \
+        "query user activity"
+    assert new_dispatcher("delete search terms") == "delete search terms"
+    assert new_dispatcher("list trends help") == "list trends"
+    assert new_dispatcher("what's the weather like?") is None
+
+    messages = ["Hello there, how are you doing today?",
+        "query user activity drwho 20",
+        "twitter status",
+        "add response, larry, moe",
+        "shut down"]
+    iterations = 100000
+    print "%-40s %12s %12s" % ("message", "chain (us)", "dispatch (us)")
+    for body in messages:
+        old = min(timeit.repeat(lambda: old_chain(body), number=iterations,
+            repeat=3)) / iterations * 1000000
+        new = min(timeit.repeat(lambda: new_dispatcher(body),
+            number=iterations, repeat=3)) / iterations * 1000000
+        print "%-40s %12.2f %12.2f" % (body, old, new)
+    sys.exit(0)
+# Fin.
@@ -0,0 +1,581 @@
+#!/usr/bin/env python2
+# -*- coding: utf-8 -*-
+# vim: set expandtab tabstop=4 shiftwidth=4 :
+
+# This is an Exocortex helper class that can stand in for the in-memory queue
+# of tweets from the stream (see tweetqueue.py) when losing the tweets that
+# are still queued when the bot shuts down isn't acceptable.
+# - Tweets are kept in memory until the queue gets deeper than its high water
+#   mark.  After that, new tweets are appended to segment files on disk until
+#   the consumer has caught up with them, so a slow consumer can fall as far
+#   behind as there is disk space, and nothing is thrown away.
+# - Segment files are append-only.  Each record is a four byte big-endian
+#   length followed by the marshalled tweet.  When a segment gets big enough
+#   a new one is started, and segments are deleted once they've been read.
+# - A tweet isn't done with when it's taken out of the queue, but when the
+#   consumer calls task_done() for it (see tweetpipeline.py, which does that
+#   once a tweet's been delivered).  Consumers have to call task_done() for
+#   everything they get(), in the same order.
+# - How far the consumer has got (segment and byte offset of the oldest
+#   tweet from disk it hasn't finished with) is checkpointed to a file every
+#   so often, and when the queue is closed.  Segments are only deleted once
+#   the checkpoint is past them.  When the queue is opened again it picks up
+#   from the checkpoint, so the tweets that were on disk when the bot went
+#   down aren't lost.  A tweet that was finished with after the last
+#   checkpoint will be read again (the duplicate filter catches those).
+# - Closing the queue (when the bot shuts down) writes the tweets that were
+#   taken out but not finished with, and then the ones in memory, to a
+#   segment of their own in front of the others, followed by what's left to
+#   read of the segment the consumer was in the middle of (which is then
+#   deleted).  After that the consumer only gets the termination sentinel.
+#   Tweets that are in memory when the bot crashes are lost; set the high
+#   water mark to zero to send every tweet through the disk.
+# - Every tweet that goes to disk is flushed to the operating system as soon
+#   as it's written, so the bot crashing doesn't lose any of them.  They're
+#   fsync()'d in groups, at most sync_interval seconds (one by default)
+#   apart, so the machine going down can lose the tweets spilled in the
+#   last sync_interval seconds.  A sync_interval of zero fsync()s every one.
+# - A record at the end of a segment that was only partly written when the
+#   bot crashed is cut off when the queue is opened.
+# - None is the termination sentinel of the queue processor.  It's never
+#   written to disk, and it comes out after every tweet that went in before
+#   it.
+# - Benchmark it with:
+#   python durablequeue.py [file of captured stream payloads, one per line]
+
+# TODO:
+# -
+
+# By: The Doctor <drwho at virtadpt dot net>
+#     0x807B17C1 / 7960 1CDC 85C9 0B63 8D9F  DD89 3BD8 FF2B 807B 17C1
+
+# License: GPLv3
+# Pre-requisite modules have their own licenses.
+
+# Load modules.
+from collections import deque
+import itertools
+import json
+import marshal
+import os
+import Queue
+import struct
+import sys
+import time
+
+# Record header: the length of the marshalled tweet.
+_HEADER = struct.Struct('>I')
+
+# Classes.
+""" This class is the queue.  It's used exactly like Queue.Queue, but it's
+never full, and it should be closed when it's not needed any more. """
+class DurableTweetQueue(Queue.Queue):
+    # How many tweets are kept in memory before the queue starts spilling to
+    # disk, how big (in bytes) a segment file gets before a new one is
+    # started, and how many tweets are read between checkpoints.
+    high_water = 10000
+    segment_size = 16 * 1024 * 1024
+    checkpoint_interval = 1000
+
+    # The longest (in seconds) a tweet written to disk can go without being
+    # fsync()'d.
+    sync_interval = 1.0
+
+    # The directory the segments and the checkpoint go in.
+    directory = ""
+
+    # Counters.
+    enqueued = 0
+    spilled = 0
+    recovered = 0
+    high_water_mark = 0
+
+    def __init__(self, directory, high_water=None, segment_size=None,
+        checkpoint_interval=None, sync_interval=None):
+        self.directory = directory
+        if sync_interval is not None:
+            self.sync_interval = sync_interval
+        if high_water is not None:
+            self.high_water = high_water
+        if segment_size:
+            self.segment_size = segment_size
+        if checkpoint_interval:
+            self.checkpoint_interval = checkpoint_interval
+        Queue.Queue.__init__(self, 0)
+        # The tweets picked up from disk still have to be finished with.
+        self.unfinished_tasks = self.recovered
+
+    """ Called by Queue.Queue's constructor to set up the queue's storage.
+    Picks up whatever was left on disk by the last run. """
+    def _init(self, maxsize):
+        self.memory = deque()
+        self.sentinels = 0
+
+        # What's been taken out of the queue but not finished with, oldest
+        # first: (tweet, segment, offset) where the segment and offset are
+        # where it was on disk (or None if it came from memory).
+        self.unacked = deque()
+        self.closed = False
+        self.enqueued = 0
+        self.spilled = 0
+        self.high_water_mark = 0
+        self.checkpointfile = os.path.join(self.directory, "checkpoint")
+        if not os.path.isdir(self.directory):
+            os.makedirs(self.directory)
+
+        # Segment numbers, oldest first.  The consumer reads from the first
+        # one and the producer appends to the last one.  Segments that have
+        # been read all the way through wait in done_segments until the
+        # checkpoint is past them.
+        self.done_segments = deque()
+        self.segments = deque(sorted(int(filename[:-4]) for filename in
+            os.listdir(self.directory) if filename.endswith(".seg")))
+        (segment, offset) = self._read_checkpoint()
+        while self.segments and self.segments[0] < segment:
+            os.remove(self._segment_file(self.segments.popleft()))
+        if not self.segments or self.segments[0] != segment:
+            offset = 0
+
+        # Count what's on disk, and cut off a record that was only partly
+        # written.
+        self.disk_items = 0
+        self.disk_bytes = 0
+        for number in self.segments:
+            start = offset if number == self.segments[0] else 0
+            (count, end) = _scan(self._segment_file(number), start)
+            self.disk_items += count
+            self.disk_bytes += end - start
+            if os.path.getsize(self._segment_file(number)) > end:
+                with open(self._segment_file(number), "r+b") as damaged:
+                    damaged.truncate(end)
+        self.recovered = self.disk_items
+
+        self.writer = None
+        self.write_segment = self.segments[-1] if self.segments else 0
+        self.write_size = 0
+        self.last_sync = time.time()
+        self.reader = None
+        self.read_offset = offset
+        self.since_checkpoint = 0
+
+    """ Returns the filename of a segment. """
+    def _segment_file(self, number):
+        return os.path.join(self.directory, "%d.seg" % number)
+
+    """ Returns the (segment, offset) the last checkpoint says the consumer had
+    read up to, or (0, 0) if there isn't one. """
+    def _read_checkpoint(self):
+        try:
+            with open(self.checkpointfile) as checkpoint:
+                position = json.load(checkpoint)
+            return (position['segment'], position['offset'])
+        except (IOError, ValueError, KeyError, TypeError):
+            return (self.segments[0] if self.segments else 0, 0)
+
+    """ Returns the (segment, offset) of the oldest tweet on disk that hasn't
+    been finished with.  Called with the mutex held. """
+    def _position(self):
+        for (item, segment, offset) in self.unacked:
+            if segment is not None:
+                return (segment, offset)
+        if self.segments:
+            return (self.segments[0], self.read_offset)
+        return (self.write_segment, 0)
+
+    """ Write out how far the consumer has got, and delete the segments it's
+    finished with.  Called with the mutex held. """
+    def _write_checkpoint(self, sync=False):
+        (segment, offset) = self._position()
+        temporary = self.checkpointfile + ".tmp"
+        with open(temporary, "w") as checkpoint:
+            json.dump({'segment': segment, 'offset': offset}, checkpoint)
+            if sync:
+                checkpoint.flush()
+                os.fsync(checkpoint.fileno())
+        os.rename(temporary, self.checkpointfile)
+        self.since_checkpoint = 0
+        while self.done_segments and self.done_segments[0] < segment:
+            os.remove(self._segment_file(self.done_segments.popleft()))
+
+    """ Called by Queue.Queue with the mutex held to count what's in the
+    queue. """
+    def _qsize(self, len=len):
+        if self.closed:
+            return self.sentinels
+        return len(self.memory) + self.disk_items + self.sentinels
+
+    """ Called by Queue.Queue with the mutex held to put something into the
+    queue. """
+    def _put(self, item):
+        if item is None:
+            self.sentinels += 1
+            return
+        self.enqueued += 1
+        if self.closed or self.disk_items or \
+            len(self.memory) >= self.high_water:
+            self._append(item)
+        else:
+            self.memory.append(item)
+        depth = len(self.memory) + self.disk_items
+        if depth > self.high_water_mark:
+            self.high_water_mark = depth
+
+    """ Append a tweet to the last segment, starting a new one if it's full.
+    The tweet is flushed right away, and fsync()'d if it's been long enough
+    since the last time. """
+    def _append(self, item):
+        if self.writer is None or self.write_size >= self.segment_size:
+            if self.writer is not None:
+                os.fsync(self.writer.fileno())
+                self.writer.close()
+                self.write_segment += 1
+            if not self.segments or self.segments[-1] != self.write_segment:
+                self.segments.append(self.write_segment)
+            self.writer = open(self._segment_file(self.write_segment), "ab")
+            self.write_size = self.writer.tell()
+        data = marshal.dumps(item)
+        self.writer.write(_HEADER.pack(len(data)) + data)
+        self.writer.flush()
+        now = time.time()
+        if now - self.last_sync >= self.sync_interval:
+            os.fsync(self.writer.fileno())
+            self.last_sync = now
+        self.write_size += _HEADER.size + len(data)
+        self.disk_items += 1
+        self.disk_bytes += _HEADER.size + len(data)
+        self.spilled += 1
+
+    """ Called by Queue.Queue with the mutex held to take the next thing out of
+    the queue. """
+    def _get(self):
+        if self.closed:
+            self.sentinels -= 1
+            return None
+        if self.memory:
+            item = self.memory.popleft()
+            self.unacked.append((item, None, None))
+        elif self.disk_items:
+            (item, segment, offset) = self._read()
+            self.unacked.append((item, segment, offset))
+        else:
+            self.sentinels -= 1
+            item = None
+            self.unacked.append((None, None, None))
+        return item
+
+    """ Called by the consumer when it's finished with the oldest thing it
+    took out of the queue.  Checkpoints every so often. """
+    def task_done(self):
+        with self.mutex:
+            if self.unacked and not self.closed:
+                (item, segment, offset) = self.unacked.popleft()
+                if segment is not None:
+                    self.since_checkpoint += 1
+                    if self.since_checkpoint >= self.checkpoint_interval or \
+                        not self.disk_items:
+                        self._write_checkpoint()
+        Queue.Queue.task_done(self)
+
+    """ Read the next tweet from the first segment, moving on to the next one
+    if it's all been read.  Returns (tweet, segment, offset).  """
+    def _read(self):
+        while True:
+            number = self.segments[0]
+            if self.reader is None:
+                self.reader = open(self._segment_file(number), "rb")
+                self.reader.seek(self.read_offset)
+            header = self.reader.read(_HEADER.size)
+            if header:
+                break
+
+            # This segment's been read.  There has to be another one,
+            # because there are tweets left on disk.
+            self.reader.close()
+            self.reader = None
+            if number == self.write_segment and self.writer is not None:
+                self.writer.close()
+                self.writer = None
+            self.done_segments.append(self.segments.popleft())
+            self.read_offset = 0
+
+        (length, ) = _HEADER.unpack(header)
+        offset = self.read_offset
+        item = marshal.loads(self.reader.read(length))
+        self.read_offset += _HEADER.size + length
+        self.disk_items -= 1
+        self.disk_bytes -= _HEADER.size + length
+        return (item, self.segments[0], offset)
+
+    """ Write the tweets that haven't been finished with and the ones in
+    memory to disk in front of the ones already there, checkpoint, and stop
+    handing out anything but the termination sentinel.  Anything put into the
+    queue after this goes straight to disk. """
+    def close(self):
+        with self.mutex:
+            if self.closed:
+                return
+            pending = [item for (item, segment, offset) in self.unacked if
+                item is not None]
+            self.unacked.clear()
+            if pending or self.memory:
+                # The tweets that were taken out are older than the ones in
+                # memory, which are older than the ones on disk.
+                existing = list(self.done_segments) + list(self.segments)
+                if existing:
+                    number = min(existing) - 1
+                else:
+                    number = self.write_segment + 1
+                    self.write_segment = number + 1
+                if self.reader is not None:
+                    self.reader.close()
+                    self.reader = None
+                with open(self._segment_file(number), "wb") as segment:
+                    for item in itertools.chain(pending, self.memory):
+                        data = marshal.dumps(item)
+                        segment.write(_HEADER.pack(len(data)) + data)
+                        self.disk_items += 1
+                        self.disk_bytes += _HEADER.size + len(data)
+
+                    # The checkpoint can only say where to start reading in
+                    # the first segment, so the rest of the one the
+                    # consumer was in the middle of comes along.
+                    if self.segments and self.read_offset:
+                        first = self.segments.popleft()
+                        if first == self.write_segment and \
+                            self.writer is not None:
+                            self.writer.close()
+                            self.writer = None
+                        with open(self._segment_file(first), "rb") as rest:
+                            rest.seek(self.read_offset)
+                            while True:
+                                data = rest.read(1048576)
+                                if not data:
+                                    break
+                                segment.write(data)
+                        os.remove(self._segment_file(first))
+                    segment.flush()
+                    os.fsync(segment.fileno())
+                # Everything that was in the segments that have been read
+                # is in the new one, if it hasn't been finished with.
+                while self.done_segments:
+                    os.remove(self._segment_file(
+                        self.done_segments.popleft()))
+                self.segments.appendleft(number)
+                self.memory.clear()
+                self.read_offset = 0
+            if self.writer is not None:
+                self.writer.flush()
+                os.fsync(self.writer.fileno())
+            self._write_checkpoint(sync=True)
+            self.closed = True
+
+            # Hand the consumer the termination sentinel, so it shuts down.
+            self.sentinels += 1
+            self.unfinished_tasks += 1
+            self.not_empty.notify_all()
+
+    """ Return a dict of the queue's counters. """
+    def statistics(self):
+        with self.mutex:
+            return {'depth': len(self.memory) + self.disk_items,
+                'memory': len(self.memory), 'disk': self.disk_items,
+                'megabytes': self.disk_bytes / 1048576.0,
+                'segments': len(self.segments),
+                'high_water': self.high_water, 'enqueued': self.enqueued,
+                'spilled': self.spilled, 'recovered': self.recovered,
+                'high_water_mark': self.high_water_mark}
+
+    """ Return the queue's counters as something that can be sent to the
+    user. """
+    def status_report(self):
+        stats = self.statistics()
+        report = "The tweet queue holds %(depth)d tweets: %(memory)d in memory (spilling to disk past %(high_water)d) and %(disk)d on disk in %(segments)d segments (%(megabytes).1f MB).\n" % stats
+        report = report + "%(enqueued)d tweets have been queued and %(spilled)d of them went to disk.  %(recovered)d tweets were picked up from disk at startup.  The queue has been as deep as %(high_water_mark)d tweets." % stats
+        return report
+
+""" Count the complete records in a segment file starting at an offset.
+Returns (number of records, offset just past the last complete one). """
+def _scan(filename, offset):
+    count = 0
+    with open(filename, "rb") as segment:
+        segment.seek(offset)
+        while True:
+            header = segment.read(_HEADER.size)
+            if len(header) < _HEADER.size:
+                break
+            (length, ) = _HEADER.unpack(header)
+            if len(segment.read(length)) < length:
+                break
+            offset += _HEADER.size + length
+            count += 1
+    return (count, offset)
+
+# Core code...
+if __name__ == '__main__':
+    # Self tests.
+    import shutil
+    import tempfile
+    import threading
+    from tweetpipeline import load_payloads, TweetPipeline
+    from tweetqueue import BoundedTweetQueue
+
+    # Take tweets out of a queue and finish with them.
+    def take(queue, count):
+        items = []
+        for i in range(count):
+            items.append(queue.get())
+            queue.task_done()
+        return items
+
+    directory = tempfile.mkdtemp()
+    try:
+        queue = DurableTweetQueue(directory, high_water=5, segment_size=100)
+        for i in range(20):
+            queue.put("tweet %d" % i)
+        assert queue.statistics()['memory'] == 5
+        assert queue.statistics()['disk'] == 15
+        assert take(queue, 8) == ["tweet %d" % i for i in range(8)]
+
+        # Simulate a crash: the reader's position wasn't checkpointed, so
+        # the tweets read from disk come back.  The ones in memory are lost.
+        crashed = DurableTweetQueue(directory, high_water=5, segment_size=100)
+        assert crashed.recovered == 15
+        assert take(crashed, 1) == ["tweet 5"]
+
+        # A clean shutdown keeps everything, in order, even in the middle of
+        # a segment.
+        for i in range(20, 25):
+            crashed.put("tweet %d" % i)
+        crashed.put(u"tweet ☃")
+        crashed.put(None)
+        crashed.close()
+        reopened = DurableTweetQueue(directory, high_water=5,
+            segment_size=100)
+        items = []
+        while not reopened.empty():
+            items.extend(take(reopened, 1))
+        assert items == ["tweet %d" % i for i in range(6, 25)] + \
+            [u"tweet ☃"]
+
+        # Tweets in memory go in front of the ones on disk, and what's been
+        # read of the segment they're in doesn't come back.
+        for i in range(10):
+            reopened.put(i)
+        assert take(reopened, 10) == range(10)
+        for i in range(10, 18):
+            reopened.put(i)
+        assert reopened.read_offset and reopened.statistics()['memory'] == 5
+        reopened.close()
+        reopened = DurableTweetQueue(directory, high_water=5,
+            segment_size=100)
+        assert take(reopened, 8) == range(10, 18)
+
+        # Tweets that were taken out but not finished with come back, in
+        # front of everything else, and segments aren't deleted until the
+        # checkpoint is past them.
+        for i in range(20):
+            reopened.put(i)
+        assert [reopened.get() for i in range(12)] == range(12)
+        assert take(reopened, 0) == [] and reopened.done_segments
+        reopened.task_done()
+        reopened.close()
+        reopened = DurableTweetQueue(directory, high_water=5,
+            segment_size=100)
+        assert take(reopened, 19) == range(1, 20)
+
+        # The sentinel comes out after everything that went in before it.
+        for i in range(10):
+            reopened.put(i)
+        reopened.put(None)
+        assert take(reopened, 11) == range(10) + [None]
+        assert reopened.empty() and reopened.statistics()['segments'] <= 1
+        assert not reopened.done_segments
+
+        # Torn writes are cut off.
+        for i in range(5):
+            reopened.put("a")
+        for i in range(10):
+            reopened.put("b")
+        with open(reopened._segment_file(reopened.write_segment), "ab") as \
+            segment:
+            segment.write(_HEADER.pack(100) + "partial")
+        torn = DurableTweetQueue(directory, high_water=5, segment_size=100)
+        assert torn.recovered == 10
+        torn.close()
+    finally:
+        shutil.rmtree(directory)
+
+    # With the high water mark at zero, a crash loses nothing: every tweet
+    # that wasn't finished with is still on disk.
+    directory = tempfile.mkdtemp()
+    try:
+        queue = DurableTweetQueue(directory, high_water=0)
+        for i in range(100):
+            queue.put("t%d" % i)
+        assert take(queue, 50) == ["t%d" % i for i in range(50)]
+        crashed = DurableTweetQueue(directory, high_water=0)
+        items = take(crashed, crashed.recovered)
+        assert items[-50:] == ["t%d" % i for i in range(50, 100)]
+        crashed.close()
+    finally:
+        shutil.rmtree(directory)
+
+    # Nothing is lost when the queue is closed with the bot's consumer (the
+    # tweet pipeline) in the middle of working through it.
+    directory = tempfile.mkdtemp()
+    try:
+        queue = DurableTweetQueue(directory, high_water=10)
+        delivered = []
+        pipeline = TweetPipeline(queue,
+            lambda tweet: (delivered.append(tweet), time.sleep(0.002)), 2,
+            chunksize=4)
+        consumer = threading.Thread(target=pipeline.run)
+        consumer.daemon = True
+        consumer.start()
+        for i in range(2000):
+            queue.put(json.dumps(i))
+        time.sleep(0.5)
+        queue.close()
+        consumer.join()
+        assert 0 < len(delivered) < 1000
+        reopened = DurableTweetQueue(directory, high_water=10)
+        assert len(delivered) + reopened.recovered <= 2000 + \
+            pipeline.read_ahead
+        recovered = [json.loads(item) for item in take(reopened,
+            reopened.recovered)]
+        assert set(delivered) | set(recovered) == set(range(2000))
+        assert recovered == sorted(recovered)
+        print "Closed with %d tweets delivered, reopened with %d." % (
+            len(delivered), reopened.recovered)
+        reopened.close()
+    finally:
+        shutil.rmtree(directory)
+
+    # Benchmark enqueueing and dequeueing captured payloads.
+    payloads = load_payloads(sys.argv[1] if len(sys.argv) > 1 else None)
+    payloads = (payloads * (20000 // len(payloads) + 1))[:20000]
+    megabytes = sum(len(payload) for payload in payloads) / 1048576.0
+    for (label, make_queue) in (
+        ("In memory", lambda directory: BoundedTweetQueue(0)),
+        ("Durable, under the high water mark",
+            lambda directory: DurableTweetQueue(directory,
+            high_water=len(payloads))),
+        ("Durable, spilling to disk",
+            lambda directory: DurableTweetQueue(directory, high_water=0))):
+        directory = tempfile.mkdtemp()
+        try:
+            queue = make_queue(directory)
+            start = time.time()
+            for payload in payloads:
+                queue.put(payload)
+            enqueue = time.time() - start
+            start = time.time()
+            for payload in payloads:
+                queue.get()
+                queue.task_done()
+            dequeue = time.time() - start
+            print "%-36s enqueue %7.0f tweets/s (%5.1f MB/s), dequeue %7.0f tweets/s (%5.1f MB/s)." % (label + ":", len(payloads) / enqueue, megabytes / enqueue, len(payloads) / dequeue, megabytes / dequeue)
+        finally:
+            shutil.rmtree(directory)
+    sys.exit(0)
+# Fin.
@@ -45,12 +45,15 @@
 # Pre-requisite modules have their own licenses.
 
 # Load modules.
+from commanddispatcher import command, dispatcher_for
 import ConfigParser
-import json
+from keywordindex import KeywordIndex
 from optparse import OptionParser
 import os
-import random
 import resource
+from responsejournal import ResponseJournal
+from responselist import ResponseList
+from sendqueue import SendQueue
 import string
 import sys
 import logging
@@ -80,8 +83,40 @@ class ExocortexBot(ClientXMPP):
     # that the bot will randomly choose between.  This schema is designed to
     # be storable to disk in between restarts.
     # Schema: {"keyword": ["response0", "response1", ...], ...}
+    # In memory, each keyword's responses are kept in a ResponseList, which
+    # makes adding, deleting, and picking responses constant time.
+    # Response files in responsedb.py's format are loaded as a LazyResponses
+    # object, which acts like a dict but leaves responses on disk until
+    # they're needed.
     responses = {}
 
+    # Every change to self.responses is appended to this journal as it's
+    # made, so the table never has to be dumped to disk all at once.
+    journal = None
+
+    # Aho-Corasick automaton built from the keywords in self.responses, so
+    # that every keyword in a message can be found in one pass.  It's kept up
+    # to date by the methods that add and delete responses.
+    keyword_index = None
+
+    # Whether the bot answers only the longest keyword found in a message
+    # ('longest') or sends a response for every keyword found ('all').
+    response_match_policy = KeywordIndex.LONGEST
+
+    # Outbound messages go through this queue, which coalesces bursts of
+    # messages to the same recipient and rate limits them so the XMPP server
+    # doesn't (see sendqueue.py).  The settings below are how long it waits
+    # to coalesce messages (in seconds), how big a coalesced message can get
+    # (in characters), how many messages per second (and how many in a
+    # burst) each recipient can be sent, and how many characters can be
+    # waiting to go out before the oldest messages are thrown away.
+    send_queue = None
+    send_window = 0.5
+    send_max_size = 8192
+    send_rate = 1.0
+    send_burst = 5
+    send_max_pending = 1048576
+
     # Attribute that stores the MUC nick the bot's owner is using, which isn't
     # the same as their JID.
     owner_muc_nic = ""
@@ -108,22 +143,27 @@ class ExocortexBot(ClientXMPP):
         self.responsefile = responsefile
         self.function = function
 
-        # Load the bot's customized responses from disk.
-        loaded_responses = ""
+        # Load the bot's customized responses from disk, then replay any
+        # changes to them that were journaled since the snapshot was taken.
+        self.journal = ResponseJournal(responsefile)
         try:
-            rfile = open(responsefile, 'r')
-            loaded_responses = rfile.read()
-            rfile.close()
-            self.responses = json.loads(loaded_responses)
-
-            # Blank the loaded_responses variable to free up some memory.
-            loaded_responses = ""
+            self.responses = self.journal.load_snapshot()
         except IOError:
             print "ERROR: I wasn't able to load " + responsefile + ".  Moving on..."
+            self.responses = {}
+        self.journal.replay(self.responses)
+
+        # Index the keywords of the responses.
+        self.keyword_index = KeywordIndex(self.responses)
 
         # Log into the server.
         ClientXMPP.__init__(self, jid, password)
 
+        # Start the outbound message scheduler.
+        self.send_queue = SendQueue(self._send_now, self.send_window,
+            self.send_max_size, self.send_rate, self.send_burst,
+            self.send_max_pending)
+
         # Set appropriate event handlers for this session.  Please note that a
         # single event many be processed by multiple matching event handlers.
         self.add_event_handler("session_start", self.start, threaded=True)
@@ -163,8 +203,9 @@ class ExocortexBot(ClientXMPP):
                 mbody="%s was unable to join %s.  Please check the error logs to see what happened." % (self.botname, self.room))
 
     """ Event handler that fires whenever a message is sent to this JID. The
-    argument 'msg' represents a message stanza.  This method is meant to be
-    extensible when the base class is used to build other kinds of bots. """
+    argument 'msg' represents a message stanza.  Commands are looked up in the
+    bot's command dispatcher, which subclasses extend by decorating their
+    handler methods with @command. """
     def message(self, msg):
         # Potential message types: normal, chat, error, headline, groupchat
         if msg['type'] in ('chat', 'normal'):
@@ -178,64 +219,72 @@ class ExocortexBot(ClientXMPP):
             # To make parsing easier, lowercase the message body before
             # matching against it.
             message = msg['body'].lower()
-            if "help" in message:
-                self.send_message(mto=msg['from'],
-                    mbody="Hello.  My name is %s.  I am a generic ExocortexBot bot.  %s  I support the following commands:\n\n%s" % (self.botname, self.function, self.commands))
-                return
-
-            # If the user asks if the bot is alive, respond.
-            if "robots" in message and "report" in message:
-                self.send_message(mto=msg['from'], mbody=self.imalive)
-                return
 
-            # Return a status report to the user.
-            if "status" in message:
-                status = self._process_status(self.botname)
-                self.send_message(mto=msg['from'], mbody=status)
+            # Find the longest command trigger in the message and hand it off
+            # to whatever method handles it.
+            (trigger, handler) = dispatcher_for(type(self)).match(message)
+            if handler:
+                getattr(self, handler)(msg, message)
                 return
 
-            # Add a response to the database.
-            if "add response" in message:
-                self.add_response(message, msg['from'])
-                return
-
-            # Delete a response from the database.
-            if "delete response" in message:
-                self.delete_response(message, msg['from'])
-                return
-
-            # Replace a response in the database.
-            # "change"
-            if "change response" in message or "replace response" in message:
-                self.change_response(message, msg['from'])
-                return
-
-            # Print all responses for debugging.
-            if "dump responses" in message or "list responses" in message:
-                self.send_message(mto=msg['from'],
-                    mbody="Current responses:\n%s" % str(self.responses))
-                return
-
-            # Print all known commands.
-            if "list commands" in message or "commands" in message:
-                self.send_message(mto=msg['from'],
-                    mbody="This Exocortex bot supports the following commands:\n %s" % str(self.commands))
-                return
-
-            # If the user tells the bot to terminate, do so.
-            # "quit"
-            if "shut down" in message or "shutdown" in message:
-                self._shutdown(msg['from'])
-
             # If nothing else, match all of the keywords/phrases in the
             # response file against the message body and pick one of the
             # responses.
-            for keyword in self.responses:
-                if keyword in message:
-                    length = len(self.responses[keyword])
-                    self.send_message(mto=msg['from'],
-                        mbody=self.responses[keyword][random.randrange(length)])
-                return
+            keywords = self.keyword_index.search(message,
+                self.response_match_policy)
+            for keyword in keywords:
+                self.send_message(mto=msg['from'],
+                    mbody=self.responses[keyword].choice())
+            return
+
+    """ Send the user a help message. """
+    @command('help')
+    def _help(self, msg, message):
+        self.send_message(mto=msg['from'],
+            mbody="Hello.  My name is %s.  I am a generic ExocortexBot bot.  %s  I support the following commands:\n\n%s" % (self.botname, self.function, self.commands))
+
+    """ If the user asks if the bot is alive, respond. """
+    @command('robots report', 'robots, report')
+    def _robots_report(self, msg, message):
+        self.send_message(mto=msg['from'], mbody=self.imalive)
+
+    """ Return a status report to the user. """
+    @command('status')
+    def _status(self, msg, message):
+        status = self._process_status(self.botname)
+        self.send_message(mto=msg['from'], mbody=status)
+
+    """ Add a response to the database. """
+    @command('add response')
+    def _add_response(self, msg, message):
+        self.add_response(message, msg['from'])
+
+    """ Delete a response from the database. """
+    @command('delete response')
+    def _delete_response(self, msg, message):
+        self.delete_response(message, msg['from'])
+
+    """ Replace a response in the database. """
+    @command('change response', 'replace response')
+    def _change_response(self, msg, message):
+        self.change_response(message, msg['from'])
+
+    """ Print all responses for debugging. """
+    @command('dump responses', 'list responses')
+    def _dump_responses(self, msg, message):
+        self.send_message(mto=msg['from'],
+            mbody="Current responses:\n%s" % str(self.responses))
+
+    """ Print all known commands. """
+    @command('list commands', 'commands')
+    def _list_commands(self, msg, message):
+        self.send_message(mto=msg['from'],
+            mbody="This Exocortex bot supports the following commands:\n %s" % str(self.commands))
+
+    """ If the user tells the bot to terminate, do so. """
+    @command('shut down', 'shutdown')
+    def _shut_down(self, msg, message):
+        self._shutdown(msg['from'])
 
     """ Event handler that fields messages addressed to the bot when they come
     from a chatroom.  The argument 'msg' represents a message stanza.
@@ -305,7 +354,9 @@ class ExocortexBot(ClientXMPP):
         if new_keyword in self.responses:
             # Response does not exist.
             if new_response not in self.responses[new_keyword]:
-                self.responses[new_keyword].append(new_response)
+                with self.journal.lock:
+                    self.responses[new_keyword].add(new_response)
+                    self.journal.record('add', new_keyword, new_response)
                 self.send_message(mto=destination,
                     mbody="New response for keyword %s saved." % new_keyword)
             else:
@@ -313,8 +364,10 @@ class ExocortexBot(ClientXMPP):
                     mbody="That response exists already.")
         else:
             # New keyword, new response.
-            self.responses[new_keyword] = []
-            self.responses[new_keyword].append(new_response)
+            with self.journal.lock:
+                self.responses[new_keyword] = ResponseList([new_response])
+                self.journal.record('add', new_keyword, new_response)
+            self.keyword_index.add(new_keyword)
             self.send_message(mto=destination,
                 mbody="New keyword and response saved.")
         return
@@ -339,14 +392,19 @@ class ExocortexBot(ClientXMPP):
                 self.send_message(mto=destination,
                     mbody="That response does not exist.")
             else:
-                # Response exists.
-                self.responses[old_keyword].remove(old_response)
+                # Response exists.  If the keyword is now empty, delete it
+                # from the table.
+                with self.journal.lock:
+                    self.responses[old_keyword].remove(old_response)
+                    keyword_emptied = not self.responses[old_keyword]
+                    if keyword_emptied:
+                        del self.responses[old_keyword]
+                    self.journal.record('delete', old_keyword, old_response)
                 self.send_message(mto=destination,
                     mbody="Response deleted.")
 
-                # If the keyword is now empty, delete it from the table.
-                if not self.responses[old_keyword]:
-                    del self.responses[old_keyword]
+                if keyword_emptied:
+                    self.keyword_index.remove(old_keyword)
                     self.send_message(mto=destination,
                         mbody="Keyword '%s' deleted because it had an empty response list." % old_keyword)
         else:
@@ -372,8 +430,14 @@ class ExocortexBot(ClientXMPP):
         if keyword in self.responses:
             # Response exists.
             if old_response in self.responses[keyword]:
-                self.responses[keyword].append(new_response)
-                self.responses[keyword].remove(old_response)
+                # Take the old response out before putting the new one in,
+                # the same way the journal replays it, so that changing a
+                # response to itself doesn't lose it.
+                with self.journal.lock:
+                    self.responses[keyword].remove(old_response)
+                    self.responses[keyword].add(new_response)
+                    self.journal.record('change', keyword, old_response,
+                        new_response)
                 self.send_message(mto=destination,
                     mbody="Response for keyword %s updated." % keyword)
             else:
@@ -394,6 +458,20 @@ class ExocortexBot(ClientXMPP):
             self.send_message(mto=presence['from'].bare,
                 mbody=self.room_announcement, mtype='groupchat')
 
+    """ Queues a message to be sent by the outbound message scheduler
+    instead of sending it right away.  Takes the same arguments as
+    ClientXMPP.send_message(). """
+    def send_message(self, mto, mbody, msubject=None, mtype=None, mhtml=None,
+        mfrom=None, mnick=None):
+        self.send_queue.put(mto, mbody, msubject, mtype, mhtml, mfrom, mnick)
+
+    """ Called by the outbound message scheduler to actually send a
+    message. """
+    def _send_now(self, mto, mbody, msubject=None, mtype=None, mhtml=None,
+        mfrom=None, mnick=None):
+        ClientXMPP.send_message(self, mto, mbody, msubject, mtype, mhtml,
+            mfrom, mnick)
+
     """ Helper method that cleanly shuts down the bot.  Broken out so that
     it's not part of the parser's code, plus it makes it overloadable in the
     future so that subclasses can extend it. The argument 'destination' is the
@@ -404,19 +482,16 @@ class ExocortexBot(ClientXMPP):
             mbody="%s is shutting down..." % self.botname)
         self.send_message(mto=destination,
             mbody="%s is shutting down..." % self.botname, mtype='groupchat')
-        self.disconnect(wait=True)
 
-        # Back up the response file.
-        old_responsefile = self.responsefile + ".bak"
-        if os.path.exists(old_responsefile):
-            os.remove(old_responsefile)
-        if os.path.exists(self.responsefile):
-            os.rename(self.responsefile, old_responsefile)
+        # Get everything that's still queued out the door before
+        # disconnecting.
+        if not self.send_queue.close(30):
+            print "ERROR: Not every outbound message could be sent before shutting down."
+        self.disconnect(wait=True)
 
-        # Dump self.responses as a JSON document.
-        outfile = open(self.responsefile, 'w')
-        outfile.write(json.dumps(self.responses))
-        outfile.close()
+        # Every change to the response table is already in the journal, so
+        # all that's left to do is close it.
+        self.journal.close()
 
         # Bounce!
         sys.exit(0)
@@ -448,7 +523,10 @@ class ExocortexBot(ClientXMPP):
         status = status + "I am currently using %d KB of RAM.\n" % memory_utilization
 
         # Get the current system load.
-        status = status + "The current system load is %s." % str(os.getloadavg())
+        status = status + "The current system load is %s.\n" % str(os.getloadavg())
+
+        # Report on the outbound message queue.
+        status = status + self.send_queue.status_report()
         return status
 
 """ Figure out what to set the logging level to.  There isn't a
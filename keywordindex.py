@@ -0,0 +1,230 @@
+#!/usr/bin/env python2
+# -*- coding: utf-8 -*-
+# vim: set expandtab tabstop=4 shiftwidth=4 :
+
+# This is an Exocortex helper class that implements an Aho-Corasick automaton
+# over a set of keywords.  The bots use it to find every keyword in their
+# random response table that shows up in a message in one pass over the
+# message, instead of doing a substring search for every keyword in the
+# table.
+# - Keywords can be added and removed while the bot is running.  New keywords
+#   go into the trie right away, and the failure links get rebuilt the next
+#   time the index is searched.
+# - Searches can return every keyword found or only the longest one.
+
+# TODO:
+# - Prune trie nodes that no longer lead to any keywords.
+
+# By: The Doctor <drwho at virtadpt dot net>
+#     0x807B17C1 / 7960 1CDC 85C9 0B63 8D9F  DD89 3BD8 FF2B 807B 17C1
+
+# License: GPLv3
+# Pre-requisite modules have their own licenses.
+
+# Load modules.
+from collections import deque
+import random
+import string
+import sys
+import threading
+import time
+
+# Classes.
+""" This class is a keyword automaton.  Every state in the trie is an index
+into a handful of parallel lists, which is a lot more compact than making an
+object for every node. """
+class KeywordIndex(object):
+    # Match policies.
+    LONGEST = 'longest'
+    ALL = 'all'
+
+    # goto[state]: dict of character -> next state.
+    goto = []
+
+    # fail[state]: The state to fall back to when the next character doesn't
+    # have a transition.
+    fail = []
+
+    # output[state]: The keyword that ends at this state, or None.
+    output = []
+
+    # link[state]: The closest state along the failure chain that ends a
+    # keyword, or 0 if there isn't one.  This is what lets a search report
+    # keywords that are suffixes of other keywords without walking the whole
+    # failure chain at every character.
+    link = []
+
+    # The set of keywords in the index.
+    keywords = set()
+
+    # Set whenever the trie changes and the failure links have to be rebuilt.
+    dirty = False
+
+    """ Set up the index, optionally loading it with an iterable of
+    keywords. """
+    def __init__(self, keywords=()):
+        self.goto = [{}]
+        self.fail = [0]
+        self.output = [None]
+        self.link = [0]
+        self.keywords = set()
+        self.dirty = False
+        self.lock = threading.RLock()
+        for keyword in keywords:
+            self.add(keyword)
+
+    def __len__(self):
+        return len(self.keywords)
+
+    def __contains__(self, keyword):
+        return keyword in self.keywords
+
+    """ Add a keyword to the index.  Returns False if it was already there. """
+    def add(self, keyword):
+        if not keyword:
+            return False
+        with self.lock:
+            if keyword in self.keywords:
+                return False
+            state = 0
+            for character in keyword:
+                next_state = self.goto[state].get(character)
+                if next_state is None:
+                    next_state = len(self.goto)
+                    self.goto.append({})
+                    self.fail.append(0)
+                    self.output.append(None)
+                    self.link.append(0)
+                    self.goto[state][character] = next_state
+                state = next_state
+            self.output[state] = keyword
+            self.keywords.add(keyword)
+            self.dirty = True
+            return True
+
+    """ Remove a keyword from the index.  The states it ran through are left
+    in place because other keywords might share them.  Returns False if the
+    keyword wasn't in the index. """
+    def remove(self, keyword):
+        with self.lock:
+            if keyword not in self.keywords:
+                return False
+            state = 0
+            for character in keyword:
+                state = self.goto[state][character]
+            self.output[state] = None
+            self.keywords.discard(keyword)
+            self.dirty = True
+            return True
+
+    """ Rebuild the failure and output links with a breadth-first walk of the
+    trie.  This is linear in the size of the trie. """
+    def _build(self):
+        goto = self.goto
+        fail = self.fail
+        output = self.output
+        link = self.link
+
+        pending = deque()
+        for state in goto[0].itervalues():
+            fail[state] = 0
+            link[state] = 0
+            pending.append(state)
+
+        while pending:
+            parent = pending.popleft()
+            for character, state in goto[parent].iteritems():
+                fallback = fail[parent]
+                while fallback and character not in goto[fallback]:
+                    fallback = fail[fallback]
+                fallback = goto[fallback].get(character, 0)
+                fail[state] = fallback
+                if output[fallback] is not None:
+                    link[state] = fallback
+                else:
+                    link[state] = link[fallback]
+                pending.append(state)
+        self.dirty = False
+
+    """ Find the keywords that appear in a string.  With the 'all' policy,
+    every keyword found is returned in the order in which they end in the
+    text, once apiece.  With the 'longest' policy, only the longest keyword
+    found is returned (ties go to the one that ends first).  Either way the
+    return value is a list. """
+    def search(self, text, policy=LONGEST):
+        with self.lock:
+            if self.dirty:
+                self._build()
+
+            goto = self.goto
+            fail = self.fail
+            output = self.output
+            link = self.link
+
+            found = []
+            seen = set()
+            state = 0
+            for character in text:
+                while state and character not in goto[state]:
+                    state = fail[state]
+                state = goto[state].get(character, 0)
+
+                # Collect this state's keyword and every keyword that's a
+                # suffix of it.
+                match = state if output[state] is not None else link[state]
+                while match:
+                    keyword = output[match]
+                    if keyword not in seen:
+                        seen.add(keyword)
+                        found.append(keyword)
+                    match = link[match]
+
+        if policy == self.LONGEST and found:
+            return [max(found, key=len)]
+        return found
+
+# Core code...
+if __name__ == '__main__':
+    # Self tests.
+    index = KeywordIndex(['he', 'she', 'his', 'hers'])
+    assert index.search('ushers', KeywordIndex.ALL) == ['she', 'he', 'hers']
+    assert index.search('ushers') == ['hers']
+    assert index.search('nothing to see') == []
+    index.remove('hers')
+    assert index.search('ushers', KeywordIndex.ALL) == ['she', 'he']
+    index.add('usher')
+    assert index.search('ushers') == ['usher']
+    assert 'usher' in index and len(index) == 4
+
+    # Benchmark the index against testing every keyword with the 'in'
+    # operator, which is what ExocortexBot.message() used to do.
+    random.seed(0)
+    alphabet = string.ascii_lowercase
+    keywords = set()
+    while len(keywords) < 50000:
+        keywords.add(''.join(random.choice(alphabet)
+            for i in range(random.randint(4, 12))))
+    message = "hey bot, what do you think about the weather today? " * 2
+
+    start = time.time()
+    index = KeywordIndex(keywords)
+    index.search('')
+    print "Built an index of %d keywords in %.2f seconds." % (len(index),
+        time.time() - start)
+
+    iterations = 100
+    start = time.time()
+    for i in range(iterations):
+        naive = [keyword for keyword in keywords if keyword in message]
+    naive_time = (time.time() - start) / iterations
+
+    start = time.time()
+    for i in range(iterations):
+        indexed = index.search(message, KeywordIndex.ALL)
+    index_time = (time.time() - start) / iterations
+
+    assert sorted(naive) == sorted(indexed)
+    print "Substring scan: %.3f ms per message." % (naive_time * 1000)
+    print "Keyword index:  %.3f ms per message." % (index_time * 1000)
+    sys.exit(0)
+# Fin.
@@ -0,0 +1,388 @@
+#!/usr/bin/env python2
+# -*- coding: utf-8 -*-
+# vim: set expandtab tabstop=4 shiftwidth=4 :
+
+# This is an Exocortex helper module that implements an on-disk format for a
+# bot's table of random responses that can be opened without parsing the
+# whole thing.  The file gets memory-mapped, and the list of responses for a
+# keyword gets decoded the first time somebody asks for it.  Response files
+# in this format can be used anywhere a JSON response file can, because
+# responsejournal.py recognizes them by their magic number.
+# - File layout:
+#   magic number (8 bytes): "EXORSP1\n"
+#   header (32 bytes): number of keywords, offset of the keyword block,
+#       offset of the table of offsets, size of an offset in bytes.
+#   data: each keyword's list of responses as a UTF-8 JSON document, one
+#       after the other, in the same order as the keywords.
+#   keyword block: every keyword in sorted order, UTF-8 encoded and separated
+#       by NUL bytes.
+#   table of offsets: number of keywords + 1 native unsigned longs; entry N
+#       is where keyword N's responses start and entry N+1 is where they end.
+# - Convert a JSON response file with:
+#   python responsedb.py convert <JSON file> <new response file>
+# - Benchmark startup against a JSON response file with:
+#   python responsedb.py benchmark <number of keywords>
+
+# TODO:
+# -
+
+# By: The Doctor <drwho at virtadpt dot net>
+#     0x807B17C1 / 7960 1CDC 85C9 0B63 8D9F  DD89 3BD8 FF2B 807B 17C1
+
+# License: GPLv3
+# Pre-requisite modules have their own licenses.
+
+# Load modules.
+from array import array
+from bisect import bisect_left
+import collections
+import json
+import mmap
+import os
+import resource
+from responselist import ResponseList
+import shutil
+import struct
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+# Constants.
+MAGIC = "EXORSP1\n"
+HEADER = struct.Struct("<QQQQ")
+OFFSET_TYPE = 'L'
+
+# Classes.
+""" This class is a dict-like view of a response file in this module's
+format.  Keywords are read when the file is opened, but their lists of
+responses stay on disk until they're looked up.  Changes made to the table
+are kept in memory on top of what's in the file; they get written to disk by
+the response journal like any other change. """
+class LazyResponses(collections.MutableMapping):
+    # Memory map of the response file.
+    mapped = None
+
+    # Sorted list of the keywords in the file, and where their responses
+    # live.
+    keywords = []
+    offsets = None
+
+    # Response lists that have been looked up or changed since the file was
+    # opened.
+    resolved = {}
+
+    # Keywords in the file that have since been deleted, and keywords that
+    # have been added that aren't in the file.
+    deleted = set()
+    added = set()
+
+    """ Memory-map a response file and read its keywords.  Raises IOError if
+    the file isn't a response database. """
+    def __init__(self, filename):
+        self.lock = threading.Lock()
+        self.resolved = {}
+        self.deleted = set()
+        self.added = set()
+
+        responsefile = open(filename, 'rb')
+        try:
+            self.mapped = mmap.mmap(responsefile.fileno(), 0,
+                access=mmap.ACCESS_READ)
+        finally:
+            responsefile.close()
+
+        if self.mapped[:len(MAGIC)] != MAGIC:
+            raise IOError("%s is not a response database." % filename)
+        (count, keywords_offset, offsets_offset, offset_size) = \
+            HEADER.unpack_from(self.mapped, len(MAGIC))
+
+        self.offsets = array(OFFSET_TYPE)
+        if self.offsets.itemsize != offset_size:
+            raise IOError("%s was written on a different kind of machine." %
+                filename)
+        self.offsets.fromstring(self.mapped[offsets_offset:offsets_offset +
+            (count + 1) * offset_size])
+        if sys.byteorder != 'little':
+            self.offsets.byteswap()
+
+        if count:
+            self.keywords = self.mapped[keywords_offset:offsets_offset].decode(
+                'utf-8').split(u'\x00')
+        else:
+            self.keywords = []
+
+    """ Find a keyword in the file.  Returns its position in the list of
+    keywords, or -1 if it isn't there. """
+    def _find(self, keyword):
+        position = bisect_left(self.keywords, keyword)
+        if position < len(self.keywords) and \
+            self.keywords[position] == keyword:
+            return position
+        return -1
+
+    def __getitem__(self, keyword):
+        responses = self.resolved.get(keyword)
+        if responses is not None:
+            return responses
+        if keyword in self.deleted:
+            raise KeyError(keyword)
+        position = self._find(keyword)
+        if position < 0:
+            raise KeyError(keyword)
+
+        # Decode this keyword's responses and hang onto them.
+        with self.lock:
+            responses = self.resolved.get(keyword)
+            if responses is None:
+                responses = ResponseList(json.loads(
+                    self.mapped[self.offsets[position]:
+                    self.offsets[position + 1]]))
+                self.resolved[keyword] = responses
+        return responses
+
+    def __setitem__(self, keyword, responses):
+        self.resolved[keyword] = responses
+        if keyword in self.deleted:
+            self.deleted.discard(keyword)
+        elif self._find(keyword) < 0:
+            self.added.add(keyword)
+
+    def __delitem__(self, keyword):
+        if keyword not in self:
+            raise KeyError(keyword)
+        self.resolved.pop(keyword, None)
+        if keyword in self.added:
+            self.added.discard(keyword)
+        else:
+            self.deleted.add(keyword)
+
+    def __contains__(self, keyword):
+        if keyword in self.added:
+            return True
+        if keyword in self.deleted:
+            return False
+        return self._find(keyword) >= 0
+
+    def __iter__(self):
+        for keyword in self.keywords:
+            if keyword not in self.deleted:
+                yield keyword
+        for keyword in list(self.added):
+            yield keyword
+
+    def __len__(self):
+        return len(self.keywords) - len(self.deleted) + len(self.added)
+
+    def __repr__(self):
+        return repr(dict(self.iteritems()))
+
+    """ Returns a _Snapshot of the table as it is right now, for writing to
+    disk.  Only the changes made since the file was opened are copied. """
+    def snapshot(self):
+        with self.lock:
+            overlay = dict((keyword, list(responses)) for (keyword,
+                responses) in self.resolved.iteritems())
+        return _Snapshot(self.mapped, self.keywords, self.offsets, overlay,
+            set(self.deleted), set(self.added))
+
+""" This class is a frozen copy of a LazyResponses table, which write() can
+write out without decoding the responses that haven't been looked up or
+changed; those are copied from the old file as they are.  The old file's
+memory map stays good after a new file is renamed on top of it. """
+class _Snapshot(object):
+    def __init__(self, mapped, keywords, offsets, overlay, deleted, added):
+        self.mapped = mapped
+        self.keywords = keywords
+        self.offsets = offsets
+        self.overlay = overlay
+        self.deleted = deleted
+        self.added = added
+
+    def iterkeys(self):
+        for keyword in self.keywords:
+            if keyword not in self.deleted:
+                yield keyword
+        for keyword in self.added:
+            yield keyword
+
+    """ Returns a keyword's list of responses as a UTF-8 JSON document. """
+    def raw(self, keyword):
+        responses = self.overlay.get(keyword)
+        if responses is not None:
+            return json.dumps(responses)
+        position = bisect_left(self.keywords, keyword)
+        return self.mapped[self.offsets[position]:self.offsets[position + 1]]
+
+    def __getitem__(self, keyword):
+        return json.loads(self.raw(keyword))
+
+    def iteritems(self):
+        for keyword in self.iterkeys():
+            yield (keyword, self[keyword])
+
+""" Returns True if a file is a response database. """
+def is_response_db(filename):
+    try:
+        responsefile = open(filename, 'rb')
+    except IOError:
+        return False
+    try:
+        return responsefile.read(len(MAGIC)) == MAGIC
+    finally:
+        responsefile.close()
+
+""" Write a response table to a file in this module's format.  The argument
+'responses' can be anything with iterkeys() and __getitem__() methods that
+yield keywords and lists of responses.  If it has a raw() method too (like a
+_Snapshot), that's used to get every keyword's responses already encoded. """
+def write(filename, responses):
+    keywords = sorted(responses.iterkeys())
+    raw = getattr(responses, 'raw', None)
+    offsets = array(OFFSET_TYPE)
+    outfile = open(filename, 'wb')
+    try:
+        # Leave room for the header, which can't be filled in until
+        # everything else has been written.
+        outfile.write(MAGIC)
+        outfile.write("\x00" * HEADER.size)
+
+        for keyword in keywords:
+            offsets.append(outfile.tell())
+            if raw:
+                outfile.write(raw(keyword))
+            else:
+                outfile.write(json.dumps(list(responses[keyword])))
+        offsets.append(outfile.tell())
+
+        keywords_offset = outfile.tell()
+        outfile.write(u'\x00'.join(keywords).encode('utf-8'))
+        offsets_offset = outfile.tell()
+        if sys.byteorder != 'little':
+            offsets.byteswap()
+        offsets.tofile(outfile)
+
+        outfile.seek(len(MAGIC))
+        outfile.write(HEADER.pack(len(keywords), keywords_offset,
+            offsets_offset, offsets.itemsize))
+        outfile.flush()
+        os.fsync(outfile.fileno())
+    finally:
+        outfile.close()
+
+""" Convert a JSON response file into a response database. """
+def convert(jsonfile, dbfile):
+    infile = open(jsonfile, 'r')
+    try:
+        responses = json.load(infile)
+    finally:
+        infile.close()
+    write(dbfile, responses)
+    return len(responses)
+
+""" Time how long it takes to open a response file of either kind and look up
+a handful of keywords, then print the time taken and the peak memory used
+by this process.  Used by the benchmark, which runs each loader in its own
+process so that their peak memory usage can be told apart. """
+def _time_load(kind, filename):
+    start = time.time()
+    if kind == 'json':
+        infile = open(filename, 'r')
+        responses = json.loads(infile.read())
+        infile.close()
+    else:
+        responses = LazyResponses(filename)
+    for keyword in (u"keyword0000000", u"keyword0500000", u"keyword0999999"):
+        if keyword in responses:
+            responses[keyword]
+    elapsed = time.time() - start
+    print "%f %d" % (elapsed, resource.getrusage(
+        resource.RUSAGE_SELF).ru_maxrss)
+
+""" Build a synthetic JSON response file with the given number of keywords,
+convert it, and compare how long the two formats take to open. """
+def benchmark(count):
+    directory = tempfile.mkdtemp()
+    try:
+        jsonfile = os.path.join(directory, "benchmark.responses")
+        dbfile = os.path.join(directory, "benchmark.responsedb")
+
+        outfile = open(jsonfile, 'w')
+        outfile.write("{")
+        for i in xrange(count):
+            if i:
+                outfile.write(", ")
+            outfile.write('"keyword%07d": ["response %d", "another response %d"]'
+                % (i, i, i))
+        outfile.write("}")
+        outfile.close()
+
+        start = time.time()
+        convert(jsonfile, dbfile)
+        print "Converted %d keywords in %.2f seconds." % (count,
+            time.time() - start)
+        print "JSON file: %d bytes.  Response database: %d bytes." % (
+            os.path.getsize(jsonfile), os.path.getsize(dbfile))
+
+        for (kind, filename) in (('json', jsonfile), ('db', dbfile)):
+            output = subprocess.check_output([sys.executable, __file__,
+                'load', kind, filename])
+            (elapsed, maxrss) = output.split()
+            print "%-5s startup: %6.2f seconds, peak memory %7d KB." % (kind,
+                float(elapsed), int(maxrss))
+    finally:
+        shutil.rmtree(directory)
+
+# Core code...
+if __name__ == '__main__':
+    if len(sys.argv) == 4 and sys.argv[1] == 'convert':
+        print "Converted %d keywords." % convert(sys.argv[2], sys.argv[3])
+        sys.exit(0)
+    if len(sys.argv) == 4 and sys.argv[1] == 'load':
+        _time_load(sys.argv[2], sys.argv[3])
+        sys.exit(0)
+    if len(sys.argv) >= 2 and sys.argv[1] == 'benchmark':
+        count = 1000000
+        if len(sys.argv) == 3:
+            count = int(sys.argv[2])
+        benchmark(count)
+        sys.exit(0)
+
+    # Self tests.
+    directory = tempfile.mkdtemp()
+    try:
+        dbfile = os.path.join(directory, "test.responsedb")
+        write(dbfile, {u"foo": [u"bar", u"baz"], u"larry": [u"moe"],
+            u"caf\xe9": [u"cr\xe8me"]})
+        assert is_response_db(dbfile)
+
+        responses = LazyResponses(dbfile)
+        assert len(responses) == 3 and not responses.resolved
+        assert responses[u"larry"] == [u"moe"]
+        assert responses[u"caf\xe9"] == [u"cr\xe8me"]
+        assert u"quux" not in responses
+
+        responses[u"quux"] = [u"xyzzy"]
+        del responses[u"foo"]
+        assert sorted(responses) == [u"caf\xe9", u"larry", u"quux"]
+        assert dict(responses.iteritems()) == {u"caf\xe9": [u"cr\xe8me"],
+            u"larry": [u"moe"], u"quux": [u"xyzzy"]}
+
+        # Writing a snapshot only decodes what was already looked up.
+        snapshot = responses.snapshot()
+        responses[u"larry"].add(u"curly")
+        copyfile = os.path.join(directory, "copy.responsedb")
+        write(copyfile, snapshot)
+        assert sorted(responses.resolved) == [u"caf\xe9", u"larry", u"quux"]
+        assert dict(LazyResponses(copyfile).iteritems()) == {
+            u"caf\xe9": [u"cr\xe8me"], u"larry": [u"moe"],
+            u"quux": [u"xyzzy"]}
+
+        write(dbfile, {})
+        assert len(LazyResponses(dbfile)) == 0
+        print "All tests passed."
+    finally:
+        shutil.rmtree(directory)
+    sys.exit(0)
+# Fin.
@@ -0,0 +1,341 @@
+#!/usr/bin/env python2
+# -*- coding: utf-8 -*-
+# vim: set expandtab tabstop=4 shiftwidth=4 :
+
+# This is an Exocortex helper class that keeps a bot's table of random
+# responses safe on disk.  Rather than rewriting the whole response file when
+# the bot shuts down, every change to the table is appended to a journal file
+# that sits next to the response file as it happens.
+# - When the bot starts up, the journal is replayed on top of the last
+#   snapshot of the response table (the response file itself).
+# - When the journal gets too big, a background thread writes out a new
+#   snapshot and starts the journal over.  If writing the snapshot fails, the
+#   old journal is kept, and the next compaction adds the current journal to
+#   the end of it instead of replacing it.
+# - Journal entries are one JSON list per line:
+#   ["add", keyword, response]
+#   ["delete", keyword, response]
+#   ["change", keyword, old response, new response]
+# - Snapshots can be JSON documents or response databases (see
+#   responsedb.py).  New snapshots are written in the same format as the one
+#   they replace.
+
+# TODO:
+# -
+
+# By: The Doctor <drwho at virtadpt dot net>
+#     0x807B17C1 / 7960 1CDC 85C9 0B63 8D9F  DD89 3BD8 FF2B 807B 17C1
+
+# License: GPLv3
+# Pre-requisite modules have their own licenses.
+
+# Load modules.
+import json
+import os
+import responsedb
+from responselist import ResponseList
+import shutil
+import sys
+import tempfile
+import threading
+import time
+
+# Classes.
+""" This class manages the snapshot and journal files for a response table.
+Callers should hold self.lock while they change the response table and
+record the change, so that compaction never sees a table that's halfway
+through being changed. """
+class ResponseJournal(object):
+    # Filenames of the snapshot, the live journal, and the journal that's in
+    # the middle of being folded into a new snapshot.
+    responsefile = ""
+    journalfile = ""
+    compactingfile = ""
+
+    # How big (in bytes) the journal is allowed to get before it gets
+    # compacted into a new snapshot.
+    threshold = 1024 * 1024
+
+    # The response table that this journal is recording changes to.
+    responses = None
+
+    # The open journal file.
+    journal = None
+
+    # Set while a compaction thread is running.
+    compacting = False
+
+    """ Set up the names of the files used by the journal. """
+    def __init__(self, responsefile, threshold=None):
+        self.responsefile = responsefile
+        self.journalfile = responsefile + ".journal"
+        self.compactingfile = responsefile + ".journal.compacting"
+        if threshold:
+            self.threshold = threshold
+        self.lock = threading.RLock()
+
+    """ Load the last snapshot of the response table from disk.  Raises
+    IOError if there isn't one. """
+    def load_snapshot(self):
+        return read_snapshot(self.responsefile)
+
+    """ Replay any journal files left over from the last run on top of a
+    response table, then open a fresh journal to record changes to it. If
+    the last run died in the middle of a compaction, write a new snapshot
+    right away so that the leftover journals can be cleaned up. """
+    def replay(self, responses):
+        with self.lock:
+            self.responses = responses
+            leftover_compaction = os.path.exists(self.compactingfile)
+            for filename in (self.compactingfile, self.journalfile):
+                if os.path.exists(filename):
+                    replay_journal(filename, responses)
+
+            if leftover_compaction:
+                write_snapshot(self.responsefile, _freeze(responses))
+                os.remove(self.compactingfile)
+                if os.path.exists(self.journalfile):
+                    os.remove(self.journalfile)
+            self.journal = open(self.journalfile, 'a')
+        return responses
+
+    """ Append a change to the response table to the journal.  The arguments
+    are the same as the journal entries described at the top of this file.
+    Kicks off a compaction if the journal has gotten too big. """
+    def record(self, operation, *args):
+        entry = json.dumps([operation] + list(args)) + "\n"
+        with self.lock:
+            self.journal.write(entry)
+            self.journal.flush()
+            os.fsync(self.journal.fileno())
+            if self.journal.tell() > self.threshold and not self.compacting:
+                self.compact()
+
+    """ Fold the journal into a new snapshot in a separate thread.  The
+    current journal gets renamed out of the way and a new one is started
+    before the thread is spawned, so changes can keep being recorded while
+    the snapshot is written.  If the last compaction failed, its journal is
+    still there and isn't in any snapshot, so the current journal is added
+    to the end of it instead. """
+    def compact(self):
+        with self.lock:
+            if self.compacting:
+                return
+            self.compacting = True
+            snapshot = _freeze(self.responses)
+            self.journal.close()
+            if os.path.exists(self.compactingfile):
+                _append_journal(self.journalfile, self.compactingfile)
+                os.remove(self.journalfile)
+            else:
+                os.rename(self.journalfile, self.compactingfile)
+            self.journal = open(self.journalfile, 'a')
+
+        compactor = threading.Thread(target=self._write_compaction,
+            name="ResponseJournalCompactor", args=(snapshot, ))
+        compactor.daemon = True
+        compactor.start()
+        return compactor
+
+    """ This is a helper method which runs in a separate thread.  It writes
+    the snapshot taken by compact() to disk and gets rid of the journal it
+    replaces. """
+    def _write_compaction(self, snapshot):
+        try:
+            write_snapshot(self.responsefile, snapshot)
+            os.remove(self.compactingfile)
+        except (IOError, OSError) as error:
+            print "ERROR: Unable to compact the response journal: %s" % error
+        finally:
+            self.compacting = False
+
+    """ Close the journal.  Everything in it is already on disk, so there's
+    nothing else to do. """
+    def close(self):
+        with self.lock:
+            if self.journal:
+                self.journal.close()
+                self.journal = None
+
+""" Add the entries in one journal file to the end of another.  If the other
+one ends with a partially written line, that line is finished off first so
+that it doesn't swallow the first new entry. """
+def _append_journal(filename, destination):
+    journal = open(filename, 'rb')
+    outfile = open(destination, 'ab+')
+    try:
+        outfile.seek(0, os.SEEK_END)
+        if outfile.tell():
+            outfile.seek(-1, os.SEEK_END)
+            if outfile.read(1) != "\n":
+                outfile.write("\n")
+        shutil.copyfileobj(journal, outfile)
+        outfile.flush()
+        os.fsync(outfile.fileno())
+    finally:
+        outfile.close()
+        journal.close()
+
+""" Returns a copy of a response table that can be written out while the
+table keeps changing.  Response databases are copied with their snapshot()
+method, which leaves the responses that haven't been looked up on disk;
+everything else is copied into a dict. """
+def _freeze(responses):
+    if hasattr(responses, 'snapshot'):
+        return responses.snapshot()
+    return dict((keyword, list(responses)) for (keyword, responses) in
+        responses.iteritems())
+
+""" Read a snapshot of a response table.  Response databases are opened
+lazily rather than read in.  The responses for each keyword are put into a
+ResponseList. """
+def read_snapshot(filename):
+    if responsedb.is_response_db(filename):
+        return responsedb.LazyResponses(filename)
+    snapshot = open(filename, 'r')
+    try:
+        responses = json.load(snapshot)
+    finally:
+        snapshot.close()
+    for keyword in responses:
+        responses[keyword] = ResponseList(responses[keyword])
+    return responses
+
+""" Write a snapshot of a response table.  The snapshot goes into a temporary
+file which is then renamed on top of the old one, so there is always a
+complete snapshot on disk. """
+def write_snapshot(filename, responses):
+    directory = os.path.dirname(os.path.abspath(filename))
+    (handle, temporary) = tempfile.mkstemp(dir=directory,
+        prefix=os.path.basename(filename) + ".")
+    outfile = os.fdopen(handle, 'w')
+    try:
+        if responsedb.is_response_db(filename):
+            outfile.close()
+            responsedb.write(temporary, responses)
+        else:
+            json.dump(responses, outfile, default=list)
+            outfile.flush()
+            os.fsync(outfile.fileno())
+    finally:
+        outfile.close()
+    os.rename(temporary, filename)
+
+""" Apply the entries in a journal file to a response table.  Every entry
+sets the final state of the responses it names regardless of what was there
+before, so replaying entries that are already reflected in a snapshot is
+harmless.  A partially written last line (from a crash in the middle of a
+write) is skipped. """
+def replay_journal(filename, responses):
+    journal = open(filename, 'r')
+    for line in journal:
+        try:
+            entry = json.loads(line)
+        except ValueError:
+            continue
+        operation = entry[0]
+        keyword = entry[1]
+        if operation == 'add':
+            _add(responses, keyword, entry[2])
+        elif operation == 'delete':
+            _delete(responses, keyword, entry[2])
+        elif operation == 'change':
+            _delete(responses, keyword, entry[2])
+            _add(responses, keyword, entry[3])
+    journal.close()
+    return responses
+
+def _add(responses, keyword, response):
+    if keyword not in responses:
+        responses[keyword] = ResponseList()
+    responses[keyword].add(response)
+
+def _delete(responses, keyword, response):
+    if keyword in responses:
+        responses[keyword].discard(response)
+        if not responses[keyword]:
+            del responses[keyword]
+
+# Core code...
+if __name__ == '__main__':
+    # Self tests.
+    directory = tempfile.mkdtemp()
+    try:
+        responsefile = os.path.join(directory, "test.responses")
+        write_snapshot(responsefile, {"foo": ["bar", "baz"]})
+
+        journal = ResponseJournal(responsefile, threshold=200)
+        responses = journal.replay(journal.load_snapshot())
+        responses["foo"].add("quux")
+        journal.record("add", "foo", "quux")
+        responses["larry"] = ResponseList(["moe"])
+        journal.record("add", "larry", "moe")
+        journal.close()
+
+        # Simulate a restart.
+        journal = ResponseJournal(responsefile, threshold=200)
+        responses = journal.replay(journal.load_snapshot())
+        assert responses == {"foo": ["bar", "baz", "quux"], "larry": ["moe"]}
+
+        # Push the journal past its threshold and wait for the compaction.
+        responses["larry"] = ResponseList(["curly"])
+        journal.record("change", "larry", "moe", "curly")
+        responses["foo"].remove("bar")
+        responses["foo"].add("bar")
+        journal.record("change", "foo", "bar", "bar")
+        for i in range(10):
+            responses["foo"].add(str(i))
+            journal.record("add", "foo", str(i))
+        while journal.compacting:
+            time.sleep(0.01)
+        journal.close()
+
+        journal = ResponseJournal(responsefile)
+        assert journal.replay(journal.load_snapshot()) == responses
+        journal.close()
+
+        # Do it again with a response database as the snapshot.  Compacting
+        # it doesn't decode the keywords that haven't been looked up.
+        for i in range(10000):
+            responses["keyword%d" % i] = ResponseList(["response %d" % i])
+        responsedb.write(responsefile, responses)
+        journal = ResponseJournal(responsefile)
+        lazy_responses = journal.replay(journal.load_snapshot())
+        lazy_responses["larry"].add("shemp")
+        journal.record("add", "larry", "shemp")
+        journal.compact().join()
+        journal.close()
+        assert sorted(lazy_responses.resolved) == ["foo", "larry"]
+        assert responsedb.is_response_db(responsefile)
+        journal = ResponseJournal(responsefile)
+        assert dict(journal.replay(journal.load_snapshot()).iteritems()) == \
+            dict(lazy_responses.iteritems())
+        journal.close()
+        # Two compactions in a row that can't write their snapshots lose
+        # nothing: the second one's journal goes on the end of the first's.
+        def broken_snapshot(filename, responses):
+            raise IOError("Disk full.")
+        working_snapshot = write_snapshot
+        responsefile = os.path.join(directory, "broken.responses")
+        write_snapshot(responsefile, {"foo": ["bar"]})
+        journal = ResponseJournal(responsefile)
+        responses = journal.replay(journal.load_snapshot())
+        write_snapshot = broken_snapshot
+        try:
+            for response in ("baz", "quux"):
+                responses["foo"].add(response)
+                journal.record("add", "foo", response)
+                journal.compact().join()
+                assert os.path.exists(journal.compactingfile)
+        finally:
+            write_snapshot = working_snapshot
+        journal.close()
+        journal = ResponseJournal(responsefile)
+        assert journal.replay(journal.load_snapshot()) == responses
+        assert not os.path.exists(journal.compactingfile)
+        journal.close()
+        print "All tests passed."
+    finally:
+        shutil.rmtree(directory)
+    sys.exit(0)
+# Fin.
@@ -0,0 +1,166 @@
+#!/usr/bin/env python2
+# -*- coding: utf-8 -*-
+# vim: set expandtab tabstop=4 shiftwidth=4 :
+
+# This is an Exocortex helper class that holds the list of responses for one
+# keyword in a bot's table of random responses.  Plain lists make checking
+# for, and deleting, a response linear in the number of responses.  This
+# class keeps a dict of where each response lives in the list so that those
+# are constant time, too.
+# - Deleted responses leave a hole in the list rather than shifting
+#   everything after them down, so the order responses were added in is
+#   kept.  Once half of the list is holes, it gets compacted.
+# - Picking a random response picks a random slot, and tries again if it
+#   landed on a hole.  Because no more than half of the slots are ever holes,
+#   that takes two tries at most on average.
+# - It serializes to JSON as a plain list, so response files keep the
+#   {"keyword": ["response0", "response1", ...]} schema.
+
+# TODO:
+# -
+
+# By: The Doctor <drwho at virtadpt dot net>
+#     0x807B17C1 / 7960 1CDC 85C9 0B63 8D9F  DD89 3BD8 FF2B 807B 17C1
+
+# License: GPLv3
+# Pre-requisite modules have their own licenses.
+
+# Load modules.
+import random
+import sys
+import time
+
+# Marks a slot in a ResponseList whose response has been deleted.
+_HOLE = object()
+
+# Classes.
+""" This class is an insertion-ordered set of responses with constant time
+random choice, membership testing, insertion, and deletion. """
+class ResponseList(object):
+    __slots__ = ('slots', 'positions')
+
+    """ Set up the list, optionally filling it from an iterable of
+    responses. """
+    def __init__(self, responses=()):
+        self.slots = []
+        self.positions = {}
+        for response in responses:
+            self.add(response)
+
+    """ Add a response to the end of the list.  Returns False if it was
+    already there. """
+    def add(self, response):
+        if response in self.positions:
+            return False
+        self.positions[response] = len(self.slots)
+        self.slots.append(response)
+        return True
+
+    # So that code written for plain lists keeps working.
+    append = add
+
+    """ Delete a response from the list.  Returns False if it wasn't
+    there. """
+    def discard(self, response):
+        position = self.positions.pop(response, None)
+        if position is None:
+            return False
+        self.slots[position] = _HOLE
+
+        # Trim holes off of the end of the list, and compact it if it's
+        # mostly holes.
+        while self.slots and self.slots[-1] is _HOLE:
+            self.slots.pop()
+        if len(self.positions) * 2 < len(self.slots):
+            self._compact()
+        return True
+
+    """ Delete a response from the list.  Like list.remove(), raises
+    ValueError if it isn't there. """
+    def remove(self, response):
+        if not self.discard(response):
+            raise ValueError("%r is not in the list of responses" % response)
+
+    """ Squeeze the holes out of the list. """
+    def _compact(self):
+        self.slots = [response for response in self.slots
+            if response is not _HOLE]
+        self.positions = dict((response, position) for (position, response)
+            in enumerate(self.slots))
+
+    """ Pick a response at random.  Raises IndexError if the list is
+    empty. """
+    def choice(self):
+        if not self.positions:
+            raise IndexError("no responses to choose from")
+        while True:
+            response = self.slots[random.randrange(len(self.slots))]
+            if response is not _HOLE:
+                return response
+
+    def __contains__(self, response):
+        return response in self.positions
+
+    def __len__(self):
+        return len(self.positions)
+
+    def __iter__(self):
+        for response in self.slots:
+            if response is not _HOLE:
+                yield response
+
+    def __eq__(self, other):
+        return list(self) == list(other)
+
+    def __ne__(self, other):
+        return not self == other
+
+    def __repr__(self):
+        return repr(list(self))
+
+# Core code...
+if __name__ == '__main__':
+    # Self tests.
+    responses = ResponseList(["foo!", "bar!", "baz!", "quux..."])
+    assert "bar!" in responses and len(responses) == 4
+    assert not responses.add("foo!")
+    responses.remove("bar!")
+    responses.add("xyzzy")
+    assert list(responses) == ["foo!", "baz!", "quux...", "xyzzy"]
+    assert responses == ["foo!", "baz!", "quux...", "xyzzy"]
+    for i in range(100):
+        assert responses.choice() in responses
+    for response in list(responses):
+        responses.remove(response)
+    assert not responses and not responses.slots
+    try:
+        responses.remove("foo!")
+        assert False
+    except ValueError:
+        pass
+
+    # Benchmark deleting and re-adding responses against a plain list.
+    count = 20000
+    plain = ["response %d" % i for i in range(count)]
+    responses = ResponseList(plain)
+    victims = ["response %d" % i for i in range(0, count, 7)]
+
+    start = time.time()
+    for victim in victims:
+        if victim in plain:
+            plain.remove(victim)
+            plain.append(victim)
+    plain_time = time.time() - start
+
+    start = time.time()
+    for victim in victims:
+        if victim in responses:
+            responses.remove(victim)
+            responses.add(victim)
+    responselist_time = time.time() - start
+
+    print "%d deletes and adds on %d responses:" % (len(victims), count)
+    print "list:         %.4f seconds." % plain_time
+    print "ResponseList: %.4f seconds." % responselist_time
+    sys.exit(0)
+# Fin.
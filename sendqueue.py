@@ -0,0 +1,398 @@
+#!/usr/bin/env python2
+# -*- coding: utf-8 -*-
+# vim: set expandtab tabstop=4 shiftwidth=4 :
+
+# This is an Exocortex helper class that schedules outbound XMPP messages.
+# Bots tend to send a lot of little messages at once (one per tweet in a
+# user's timeline, one per line of help text), and XMPP servers rate limit
+# clients that do that.  Instead of going straight to the server, messages go
+# into this queue, and a scheduler thread sends them:
+# - Messages to the same recipient (and of the same type) that are queued
+#   within a short window of each other are coalesced into one message, up to
+#   a size cap.  Messages are never split, so one that's bigger than the cap
+#   on its own goes out by itself.
+# - Messages with an HTML body are never coalesced.
+# - Every recipient has a token bucket, which limits how many messages per
+#   second they get once their burst allowance has been used up.
+# - Messages to the same recipient always go out in the order they were
+#   queued.
+# - The queue holds at most max_pending characters.  If the server stalls or
+#   a handler floods it, the oldest queued messages (or, with the drop-newest
+#   policy, the new ones) are thrown away and counted instead of piling up.
+
+# TODO:
+# -
+
+# By: The Doctor <drwho at virtadpt dot net>
+#     0x807B17C1 / 7960 1CDC 85C9 0B63 8D9F  DD89 3BD8 FF2B 807B 17C1
+
+# License: GPLv3
+# Pre-requisite modules have their own licenses.
+
+# Load modules.
+from collections import deque
+import sys
+import threading
+import time
+
+# Classes.
+""" This class is one outbound message, made up of one or more queued
+messages to the same recipient.  'queued' is when the oldest of them was
+queued, and 'times' is when each of them was. """
+class _Batch(object):
+    __slots__ = ('mto', 'parts', 'times', 'size', 'html', 'queued', 'sealed')
+
+    def __init__(self, mto, html, queued):
+        self.mto = mto
+        self.parts = []
+        self.times = []
+        self.size = 0
+        self.html = html
+        self.queued = queued
+        self.sealed = html is not None
+
+""" This class is the outbound message queue and its scheduler thread.  The
+function it's given is called with the same arguments as
+ClientXMPP.send_message() to actually send a message. """
+class SendQueue(object):
+    # Overflow policies.
+    DROP_OLDEST = 'drop-oldest'
+    DROP_NEWEST = 'drop-newest'
+    policies = (DROP_OLDEST, DROP_NEWEST)
+
+    # Function that sends a message.
+    send = None
+
+    # How long (in seconds) the queue waits for more messages to coalesce
+    # with the first one, and how big (in characters) a coalesced message can
+    # get.
+    window = 0.5
+    max_size = 8192
+
+    # How many messages per second each recipient can be sent, and how many
+    # can be sent in a burst before the rate kicks in.
+    rate = 1.0
+    burst = 5
+
+    # How many characters can be waiting to go out, and what happens to
+    # messages that don't fit.
+    max_pending = 1048576
+    policy = DROP_OLDEST
+
+    # Counters.
+    depth = 0
+    pending = 0
+    dropped = 0
+    high_water_mark = 0
+    queued = 0
+    sent_messages = 0
+    sent_stanzas = 0
+    send_errors = 0
+    total_latency = 0.0
+    max_latency = 0.0
+
+    def __init__(self, send, window=None, max_size=None, rate=None,
+        burst=None, max_pending=None, policy=None):
+        if policy is not None and policy not in self.policies:
+            raise ValueError("Unknown overflow policy '%s'.  Choose from %s." %
+                (policy, ", ".join(self.policies)))
+        self.send = send
+        if window is not None:
+            self.window = window
+        if max_size is not None:
+            self.max_size = max_size
+        if rate is not None:
+            self.rate = rate
+        if burst is not None:
+            self.burst = burst
+        if max_pending is not None:
+            self.max_pending = max_pending
+        if policy is not None:
+            self.policy = policy
+
+        # (recipient, type, subject, from, nick) -> deque of _Batches.
+        self.batches = {}
+
+        # Recipient -> [tokens, time the bucket was last refilled].
+        self.buckets = {}
+
+        self.condition = threading.Condition()
+        self.flushing = 0
+        self.stopping = False
+        self.depth = 0
+        self.pending = 0
+        self.dropped = 0
+        self.high_water_mark = 0
+        self.queued = 0
+        self.sent_messages = 0
+        self.sent_stanzas = 0
+        self.send_errors = 0
+        self.total_latency = 0.0
+        self.max_latency = 0.0
+
+        self.scheduler = threading.Thread(target=self._run,
+            name="SendQueueScheduler")
+        self.scheduler.daemon = True
+        self.scheduler.start()
+
+    """ Queue a message.  Takes the same arguments as
+    ClientXMPP.send_message().  If the queue has been shut down the message
+    is sent right away.  If it's full, the overflow policy decides which
+    messages are thrown away. """
+    def put(self, mto, mbody, msubject=None, mtype=None, mhtml=None,
+        mfrom=None, mnick=None):
+        mbody = mbody or ""
+        key = (str(mto), mtype, msubject, mfrom, mnick)
+        with self.condition:
+            if self.stopping:
+                self.send(mto, mbody, msubject, mtype, mhtml, mfrom, mnick)
+                return
+
+            size = len(mbody) + 1
+            if self.pending + size > self.max_pending:
+                if self.policy == self.DROP_NEWEST or size > self.max_pending:
+                    self.dropped += 1
+                    return
+                while self.pending + size > self.max_pending:
+                    self._drop_oldest()
+
+            now = time.time()
+            batches = self.batches.get(key)
+            if batches is None:
+                batches = self.batches[key] = deque()
+            batch = batches[-1] if batches else None
+            if batch is None or batch.sealed or mhtml is not None or \
+                batch.size + len(mbody) + 1 > self.max_size:
+                if batch is not None:
+                    batch.sealed = True
+                batch = _Batch(mto, mhtml, now)
+                batches.append(batch)
+
+            batch.parts.append(mbody)
+            batch.times.append(now)
+            batch.size += size
+            if batch.size >= self.max_size:
+                batch.sealed = True
+
+            self.queued += 1
+            self.depth += 1
+            self.pending += size
+            if self.depth > self.high_water_mark:
+                self.high_water_mark = self.depth
+            self.condition.notify_all()
+
+    """ Throw away the oldest message in the queue.  The caller has to hold
+    the lock. """
+    def _drop_oldest(self):
+        key = min(self.batches, key=lambda key: self.batches[key][0].queued)
+        batches = self.batches[key]
+        batch = batches[0]
+        size = len(batch.parts.pop(0)) + 1
+        batch.times.pop(0)
+        batch.size -= size
+        if batch.parts:
+            batch.queued = batch.times[0]
+        else:
+            batches.popleft()
+            if not batches:
+                del self.batches[key]
+        self.depth -= 1
+        self.pending -= size
+        self.dropped += 1
+
+    """ Returns the time at which the recipient's token bucket will next have
+    a token in it, refilling it along the way. """
+    def _next_token(self, recipient, now):
+        bucket = self.buckets.get(recipient)
+        if bucket is None:
+            bucket = self.buckets[recipient] = [float(self.burst), now]
+        bucket[0] = min(float(self.burst), bucket[0] + (now - bucket[1]) *
+            self.rate)
+        bucket[1] = now
+        if bucket[0] >= 1.0:
+            return now
+        return now + (1.0 - bucket[0]) / self.rate
+
+    """ This is a helper method which runs in a separate thread.  It sends the
+    oldest batch for each recipient when its window has closed and the
+    recipient has a token to spend. """
+    def _run(self):
+        with self.condition:
+            while True:
+                if self.stopping and not self.batches:
+                    return
+
+                # Find a batch that can go out now, or figure out how long
+                # until one can.
+                now = time.time()
+                ready = None
+                wait = None
+                for (key, batches) in self.batches.iteritems():
+                    batch = batches[0]
+                    due = batch.queued + self.window
+                    if batch.sealed or len(batches) > 1 or self.flushing or \
+                        self.stopping:
+                        due = now
+                    due = max(due, self._next_token(key[0], now))
+                    if due <= now:
+                        ready = key
+                        break
+                    if wait is None or due - now < wait:
+                        wait = due - now
+                if ready is None:
+                    self.condition.wait(wait)
+                    continue
+
+                batches = self.batches[ready]
+                batch = batches.popleft()
+                if not batches:
+                    del self.batches[ready]
+                self.buckets[ready[0]][0] -= 1.0
+                self.depth -= len(batch.parts)
+                self.pending -= batch.size
+
+                # Send it without holding the lock, so that handlers can
+                # keep queueing messages in the meantime.
+                self.condition.release()
+                try:
+                    try:
+                        self.send(batch.mto, "\n".join(batch.parts), ready[2],
+                            ready[1], batch.html, ready[3], ready[4])
+                        error = None
+                    except Exception as error:
+                        print "ERROR: Unable to send message to %s: %s" % (
+                            batch.mto, error)
+                finally:
+                    self.condition.acquire()
+
+                latency = time.time() - batch.queued
+                if error is None:
+                    self.sent_messages += len(batch.parts)
+                    self.sent_stanzas += 1
+                    self.total_latency += latency
+                    self.max_latency = max(self.max_latency, latency)
+                else:
+                    self.send_errors += 1
+                self.condition.notify_all()
+
+    """ Send everything in the queue without waiting for the coalescing
+    window to close (the rate limit still applies).  Waits until the queue is
+    empty or the timeout (in seconds) runs out, and returns True if the queue
+    was emptied. """
+    def flush(self, timeout=None):
+        deadline = None
+        if timeout is not None:
+            deadline = time.time() + timeout
+        with self.condition:
+            self.flushing += 1
+            self.condition.notify_all()
+            try:
+                while self.batches:
+                    if deadline is None:
+                        self.condition.wait()
+                        continue
+                    remaining = deadline - time.time()
+                    if remaining <= 0:
+                        break
+                    self.condition.wait(remaining)
+                return not self.batches
+            finally:
+                self.flushing -= 1
+
+    """ Flush the queue and stop the scheduler thread.  Anything queued after
+    this is sent right away. """
+    def close(self, timeout=None):
+        flushed = self.flush(timeout)
+        with self.condition:
+            self.stopping = True
+            self.condition.notify_all()
+        if flushed:
+            self.scheduler.join(timeout)
+        return flushed
+
+    """ Return a dict of the queue's counters. """
+    def statistics(self):
+        with self.condition:
+            average_latency = 0.0
+            if self.sent_stanzas:
+                average_latency = self.total_latency / self.sent_stanzas
+            return {'depth': self.depth, 'pending': self.pending,
+                'max_pending': self.max_pending, 'policy': self.policy,
+                'dropped': self.dropped,
+                'high_water_mark': self.high_water_mark,
+                'queued': self.queued, 'sent_messages': self.sent_messages,
+                'sent_stanzas': self.sent_stanzas,
+                'send_errors': self.send_errors,
+                'average_latency': average_latency * 1000,
+                'max_latency': self.max_latency * 1000}
+
+    """ Return the queue's counters as something that can be sent to the
+    user. """
+    def status_report(self):
+        stats = self.statistics()
+        report = "The outbound message queue holds %(depth)d messages (%(pending)d of at most %(max_pending)d characters) and has held as many as %(high_water_mark)d.  %(dropped)d messages have been dropped because it was full (%(policy)s overflow policy).\n" % stats
+        report = report + "%(sent_messages)d messages have been sent in %(sent_stanzas)d stanzas, %(average_latency).0f ms after being queued on average (%(max_latency).0f ms at worst).  %(send_errors)d stanzas could not be sent." % stats
+        return report
+
+# Core code...
+if __name__ == '__main__':
+    # Self tests.
+    sent = []
+    def record(mto, mbody, msubject, mtype, mhtml, mfrom, mnick):
+        sent.append((time.time(), mto, mbody, mtype, mhtml))
+
+    # A burst of messages to one recipient is coalesced, in order, and
+    # doesn't go over the size cap.
+    queue = SendQueue(record, window=0.05, max_size=1000, rate=20, burst=2)
+    for i in range(3200):
+        queue.put("owner@example.com", "Tweet number %d." % i)
+    queue.put("room@example.com", "To the room.", mtype='groupchat')
+    queue.put("owner@example.com", "Formatted.", mhtml="<b>Formatted.</b>")
+    assert queue.flush(30)
+    to_owner = [message for message in sent
+        if message[1] == "owner@example.com"]
+    bodies = "\n".join(message[2] for message in to_owner
+        if message[4] is None).split("\n")
+    assert bodies == ["Tweet number %d." % i for i in range(3200)]
+    assert max(len(message[2]) for message in to_owner) <= 1000
+    assert to_owner[-1][2] == "Formatted." and to_owner[-1][4]
+    assert [message[2] for message in sent
+        if message[3] == 'groupchat'] == ["To the room."]
+
+    # After the burst, the recipient gets no more than the rate allows.
+    elapsed = to_owner[-1][0] - to_owner[0][0]
+    assert elapsed >= (len(to_owner) - 2) / 20.0 * 0.9
+    print "%d messages went out in %d stanzas over %.2f seconds." % (
+        queue.sent_messages, queue.sent_stanzas, elapsed)
+    print queue.status_report()
+
+    # A queue that isn't sending anything yet holds no more than max_pending
+    # characters.  Drop-oldest keeps the newest messages and drop-newest
+    # keeps the oldest.
+    for policy in SendQueue.policies:
+        stalled = SendQueue(record, window=60, max_pending=100, policy=policy)
+        for i in range(100):
+            stalled.put("owner@example.com", "Message %d" % (i % 10))
+            stalled.put("room@example.com", "Message %d" % (i % 10),
+                mtype='groupchat')
+        stats = stalled.statistics()
+        assert stats['pending'] <= 100 and stats['depth'] == 10
+        assert stats['dropped'] == 190 and stats['queued'] == 200 - (
+            190 if policy == SendQueue.DROP_NEWEST else 0)
+        kept = sorted(part for batches in stalled.batches.values()
+            for batch in batches for part in batch.parts)
+        if policy == SendQueue.DROP_OLDEST:
+            assert kept == sorted(["Message 5", "Message 6", "Message 7",
+                "Message 8", "Message 9"] * 2)
+        else:
+            assert kept == sorted(["Message %d" % i for i in range(5)] * 2)
+        assert stalled.close(5) and stalled.statistics()['pending'] == 0
+    print stalled.status_report()
+
+    # Messages queued after the scheduler stops go out right away.
+    queue.close(5)
+    del sent[:]
+    queue.put("owner@example.com", "Shutting down.")
+    assert sent[0][2] == "Shutting down."
+    sys.exit(0)
+# Fin.
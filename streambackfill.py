@@ -0,0 +1,179 @@
+#!/usr/bin/env python2
+# -*- coding: utf-8 -*-
+# vim: set expandtab tabstop=4 shiftwidth=4 :
+
+# This is an Exocortex helper class that fills in the tweets the stream missed
+# while it was disconnected.
+# - The ID of the newest tweet delivered for every search term is remembered.
+# - When the stream (re)connects, Twitter's search API is asked for every
+#   term's tweets newer than that (since_id), a page at a time going back
+#   from the newest (max_id), until there are no more or the page limit is
+#   reached.  Terms that haven't delivered anything yet are skipped; there's
+#   no gap to fill for them.
+# - The tweets that turn up are pushed into the same queue as the stream's,
+#   oldest first, as JSON, so they go through the same deduplication (which
+#   throws away the ones the stream did deliver), decoding, and term routing
+#   as everything else.
+# - Searches are background calls, so they wait their turn behind anything
+#   the bot's owner is asking for.
+
+# TODO:
+# - Twitter's search API only goes back about a week.
+
+# By: The Doctor <drwho at virtadpt dot net>
+#     0x807B17C1 / 7960 1CDC 85C9 0B63 8D9F  DD89 3BD8 FF2B 807B 17C1
+
+# License: GPLv3
+# Pre-requisite modules have their own licenses.
+
+# Load modules.
+import json
+import sys
+import threading
+
+# Classes.
+""" This class does the backfilling.  It's given a tweepy API object (or
+anything else with a search() method) and the queue that the stream pushes
+raw tweets into. """
+class StreamBackfill(object):
+    # How many tweets to ask for per search, and how many pages of them at
+    # most per term.
+    page_size = 100
+    max_pages = 10
+
+    api = None
+    queue = None
+
+    # Search term -> ID of the newest tweet delivered for it (as an int).
+    last_ids = None
+
+    # Counters.
+    backfills = 0
+    searches = 0
+    backfilled = 0
+
+    def __init__(self, api, queue, page_size=None, max_pages=None):
+        self.api = api
+        self.queue = queue
+        if page_size:
+            self.page_size = page_size
+        if max_pages:
+            self.max_pages = max_pages
+        self.last_ids = {}
+        self.backfills = 0
+        self.searches = 0
+        self.backfilled = 0
+        self.lock = threading.Lock()
+
+    """ Remember a delivered tweet as the newest one for the terms it was
+    tagged with. """
+    def record(self, tweet):
+        if not tweet.terms or not tweet.id_str:
+            return
+        id_number = int(tweet.id_str)
+        with self.lock:
+            for term in tweet.terms:
+                if id_number > self.last_ids.get(term, 0):
+                    self.last_ids[term] = id_number
+
+    """ Forget the terms that aren't being tracked any more. """
+    def forget(self, terms):
+        with self.lock:
+            for term in self.last_ids.keys():
+                if term not in terms:
+                    del self.last_ids[term]
+
+    """ Search for every term's tweets since the newest one delivered and push
+    them into the queue.  Returns how many tweets were pushed. """
+    def backfill(self, terms):
+        with self.lock:
+            since = [(term, self.last_ids[term]) for term in terms
+                if term in self.last_ids]
+            self.backfills += 1
+        pushed = 0
+        for (term, since_id) in since:
+            tweets = self._search(term, since_id)
+            for tweet in reversed(tweets):
+                self.queue.put(json.dumps(tweet))
+            pushed += len(tweets)
+        with self.lock:
+            self.backfilled += pushed
+        return pushed
+
+    """ Returns a term's tweets newer than since_id as dicts, newest first. """
+    def _search(self, term, since_id):
+        tweets = []
+        max_id = None
+        for page in xrange(self.max_pages):
+            kwargs = {'q': term, 'count': self.page_size,
+                'result_type': 'recent', 'since_id': since_id}
+            if max_id is not None:
+                kwargs['max_id'] = max_id
+            results = self.api.search(**kwargs)
+            with self.lock:
+                self.searches += 1
+            results = [getattr(status, '_json', status) for status in
+                results]
+            results = [status for status in results if
+                isinstance(status, dict)]
+            if not results:
+                break
+            tweets.extend(results)
+            max_id = min(int(status['id_str']) for status in results) - 1
+            if len(results) < self.page_size or max_id <= since_id:
+                break
+        return tweets
+
+    """ Return a dict of the backfiller's counters. """
+    def statistics(self):
+        with self.lock:
+            return {'backfills': self.backfills, 'searches': self.searches,
+                'backfilled': self.backfilled, 'terms': len(self.last_ids)}
+
+    """ Return the backfiller's counters as something that can be sent to the
+    user. """
+    def status_report(self):
+        return "The stream has been backfilled %(backfills)d times, which took %(searches)d searches and turned up %(backfilled)d tweets (before duplicates were thrown away)." % self.statistics()
+
+# Core code...
+if __name__ == '__main__':
+    # Self tests, with a fake search API that has 250 tweets about "foo".
+    class FakeTweet(object):
+        def __init__(self, id_str, terms):
+            self.id_str = id_str
+            self.terms = terms
+
+    class FakeStatus(object):
+        def __init__(self, id_number):
+            self._json = {'id_str': str(id_number), 'text': "foo %d" %
+                id_number}
+
+    class FakeAPI(object):
+        calls = []
+
+        def search(self, q, count, result_type, since_id, max_id=None):
+            self.calls.append((q, since_id, max_id))
+            ids = [i for i in range(250, 0, -1) if i > since_id and
+                (max_id is None or i <= max_id)]
+            return [FakeStatus(i) for i in ids[:count]] if q == "foo" else []
+
+    import Queue
+    queue = Queue.Queue()
+    api = FakeAPI()
+    backfill = StreamBackfill(api, queue)
+    backfill.record(FakeTweet("10", ("foo", "bar")))
+    backfill.record(FakeTweet("5", ("foo", )))
+    backfill.record(FakeTweet("20", None))
+    assert backfill.last_ids == {"foo": 10, "bar": 10}
+
+    assert backfill.backfill(["foo", "bar", "baz"]) == 240
+    assert [call for call in api.calls if call[0] == "foo"] == \
+        [("foo", 10, None), ("foo", 10, 150), ("foo", 10, 50)]
+    ids = [int(json.loads(queue.get())['id_str']) for i in range(240)]
+    assert ids == range(11, 251)
+
+    backfill.forget(["foo"])
+    assert backfill.last_ids == {"foo": 10}
+    print backfill.status_report()
+    sys.exit(0)
+# Fin.
@@ -0,0 +1,391 @@
+#!/usr/bin/env python2
+# -*- coding: utf-8 -*-
+# vim: set expandtab tabstop=4 shiftwidth=4 :
+
+# This is an Exocortex helper class that owns the connection to Twitter's
+# streaming API.  Twitter's filter stream can't change what it's tracking
+# once it's connected, so whenever the list of search terms changes the
+# stream has to be reconnected with the new list.  The supervisor does that
+# without touching anything downstream of the stream listener (the queue of
+# monitored tweets and the thread that processes it keep running).
+# - Changes to the list of terms are debounced: the supervisor waits until
+#   the list has stopped changing for a moment before reconnecting, so that
+#   adding several terms in a row only reconnects once.
+# - Every connection gets its own listener.  A listener that's been replaced
+#   stops passing tweets along, even if its stream is slow to notice that
+#   it's been disconnected.
+# - How long every reconnection takes (from the decision to reconnect to
+#   Twitter accepting the new connection) is recorded.
+# - If the stream drops on its own (a network error, or an HTTP error from
+#   Twitter), it's reconnected after a delay that doubles every time it
+#   happens again, with some randomness thrown in so that a lot of clients
+#   that were dropped at once don't all come back at once.  How long the
+#   first delay is depends on what went wrong, following Twitter's advice:
+#   short for network errors, longer for HTTP errors, and a minute for being
+#   rate limited (HTTP 420).  The delay goes back to the start once a
+#   connection has stayed up for a while.
+# - When the stream comes back after dropping, a backfill function (if
+#   there is one) is called in another thread with the terms being tracked,
+#   so that the tweets that went by while the stream was down can be picked
+#   up some other way.  Reconnections because the terms changed don't count.
+
+# TODO:
+# -
+
+# By: The Doctor <drwho at virtadpt dot net>
+#     0x807B17C1 / 7960 1CDC 85C9 0B63 8D9F  DD89 3BD8 FF2B 807B 17C1
+
+# License: GPLv3
+# Pre-requisite modules have their own licenses.
+
+# Load modules.
+from collections import deque
+import random
+import sys
+import threading
+import time
+
+# Classes.
+""" This class supervises the stream.  It's given two functions: one that
+makes a new listener (it's passed the supervisor, which the listener should
+tell when it connects by calling connected()), and one that makes a stream
+for a listener (for example, lambda listener: tweepy.Stream(auth,
+listener)). """
+class StreamSupervisor(object):
+    # How long (in seconds) the list of terms has to stay the same before
+    # the stream is reconnected, and how long to wait for the old stream's
+    # thread to finish after it's told to disconnect.
+    debounce = 2.0
+    disconnect_timeout = 5.0
+
+    # Functions that make listeners and streams.
+    make_listener = None
+    connect = None
+
+    # The terms the stream was last connected with, and the ones it's
+    # supposed to be connected with.
+    terms = []
+    wanted = []
+
+    # The current stream, its listener, and the thread it's running in.
+    stream = None
+    listener = None
+    stream_thread = None
+
+    # When the current reconnection started, or None.
+    reconnect_started = None
+
+    # How long the last several reconnections took (in seconds), and how
+    # many there have been.
+    reconnect_times = None
+    reconnects = 0
+
+    # How long (in seconds) to wait before reconnecting the first time after
+    # a network error, an HTTP error, and being rate limited, the longest to
+    # wait, and how long a connection has to stay up before the delay starts
+    # over.
+    network_backoff = 0.25
+    http_backoff = 5.0
+    rate_limit_backoff = 60.0
+    max_backoff = 320.0
+    stable_time = 60.0
+
+    # Function that's called with the terms being tracked when the stream
+    # comes back after dropping, and how many drops it's been called for.
+    backfill = None
+    backfilled_drops = 0
+
+    def __init__(self, make_listener, connect, debounce=None, backfill=None):
+        self.make_listener = make_listener
+        self.connect = connect
+        if debounce is not None:
+            self.debounce = debounce
+        self.backfill = backfill
+        self.terms = []
+        self.wanted = []
+        self.last_change = 0
+        self.stream = None
+        self.listener = None
+        self.stream_thread = None
+        self.reconnect_started = None
+        self.reconnect_times = deque(maxlen=100)
+        self.reconnects = 0
+        self.connected_at = None
+        self.drops = 0
+        self.backfilled_drops = 0
+        self.failures = 0
+        self.last_error = None
+        self.retry_at = 0
+        self.stopping = False
+        self.condition = threading.Condition()
+
+        self.supervisor = threading.Thread(target=self._run,
+            name="StreamSupervisor")
+        self.supervisor.daemon = True
+        self.supervisor.start()
+
+    """ Change the list of terms the stream is tracking.  The stream is
+    reconnected once the list stops changing.  An empty list disconnects the
+    stream. """
+    def set_terms(self, terms):
+        with self.condition:
+            self.wanted = list(terms)
+            self.last_change = time.time()
+            self.condition.notify_all()
+
+    """ Returns True if the listener belongs to the current stream. """
+    def is_current(self, listener):
+        return listener is self.listener
+
+    """ Called by the current stream's listener when Twitter accepts the
+    connection. """
+    def connected(self, listener):
+        with self.condition:
+            if listener is not self.listener or \
+                self.reconnect_started is None:
+                return
+            self.connected_at = time.time()
+            self.reconnect_times.append(self.connected_at -
+                self.reconnect_started)
+            self.reconnect_started = None
+            self.condition.notify_all()
+            terms = list(self.terms)
+            dropped = self.drops > self.backfilled_drops
+            self.backfilled_drops = self.drops
+        if self.backfill and dropped:
+            thread = threading.Thread(target=self._backfill, args=(terms, ),
+                name="StreamBackfill")
+            thread.daemon = True
+            thread.start()
+
+    """ This is a helper method which runs the backfill function in a separate
+    thread. """
+    def _backfill(self, terms):
+        try:
+            self.backfill(terms)
+        except Exception as error:
+            print "ERROR: Unable to backfill the Twitter stream: %s" % error
+
+    """ Called by the current stream's listener when Twitter sends an HTTP
+    error, which will make the stream disconnect. """
+    def disconnected(self, listener, status):
+        with self.condition:
+            if listener is self.listener:
+                self.last_error = status
+
+    """ This is a helper method which runs in a separate thread.  It waits for
+    the list of terms to change and settle down, then reconnects. """
+    def _run(self):
+        with self.condition:
+            while not self.stopping:
+                if self.wanted == self.terms:
+                    self.condition.wait()
+                    continue
+                now = time.time()
+                settled = max(self.last_change + self.debounce - now,
+                    self.retry_at - now)
+                if settled > 0:
+                    self.condition.wait(settled)
+                    continue
+                self._reconnect(list(self.wanted))
+
+    """ Disconnect the current stream, if there is one, and connect a new one
+    that tracks the given terms, if there are any.  Called with the lock
+    held. """
+    def _reconnect(self, terms):
+        self.reconnect_started = time.time()
+        self.last_error = None
+        stream = self.stream
+        thread = self.stream_thread
+        self.stream = None
+        self.listener = None
+        self.stream_thread = None
+        self.terms = terms
+
+        # Shut the old stream down without holding the lock, because that
+        # can take a while.
+        if stream is not None:
+            self.condition.release()
+            try:
+                stream.disconnect()
+                thread.join(self.disconnect_timeout)
+            finally:
+                self.condition.acquire()
+
+        if not terms:
+            self.reconnect_started = None
+            return
+
+        self.listener = self.make_listener(self)
+        self.stream = self.connect(self.listener)
+        self.stream_thread = threading.Thread(target=self._filter,
+            args=(self.stream, terms), name="TwitterBotStreamListener")
+        self.stream_thread.daemon = True
+        self.stream_thread.start()
+        self.reconnects += 1
+
+    """ This is a helper method which runs the stream in a separate thread
+    until it's disconnected. """
+    def _filter(self, stream, terms):
+        error = None
+        try:
+            stream.filter(track=terms)
+        except Exception as error:
+            print "ERROR: The Twitter stream tracking %s died: %s" % (terms,
+                error)
+        self._dropped(stream, error)
+
+    """ Called when a stream stops.  If it's still the current stream, it
+    dropped on its own, so schedule a reconnection.  The current stream's
+    listener has already passed along any HTTP error. """
+    def _dropped(self, stream, error):
+        with self.condition:
+            if stream is not self.stream or self.stopping:
+                return
+            now = time.time()
+            status = self.last_error
+            if status == 420:
+                backoff = self.rate_limit_backoff
+            elif status is not None:
+                backoff = self.http_backoff
+            else:
+                backoff = self.network_backoff
+                self.last_error = str(error) if error else "disconnected"
+            if self.connected_at is not None and \
+                now - self.connected_at >= self.stable_time:
+                self.failures = 0
+            delay = min(self.max_backoff, backoff * (2 ** self.failures))
+            delay = delay / 2 + random.uniform(0, delay / 2)
+            self.failures += 1
+            self.drops += 1
+            self.retry_at = now + delay
+            print "ERROR: The Twitter stream dropped (%s).  Reconnecting in %.1f seconds." % (self.last_error, delay)
+
+            # Forgetting the terms makes the supervisor thread reconnect.
+            self.stream = None
+            self.listener = None
+            self.stream_thread = None
+            self.connected_at = None
+            self.terms = []
+            self.condition.notify_all()
+
+    """ Disconnect the stream and stop supervising it. """
+    def stop(self):
+        with self.condition:
+            self.stopping = True
+            stream = self.stream
+            self.stream = None
+            self.listener = None
+            self.condition.notify_all()
+        if stream is not None:
+            stream.disconnect()
+        self.supervisor.join(self.disconnect_timeout)
+
+    """ Return a dict of the supervisor's counters. """
+    def statistics(self):
+        with self.condition:
+            times = list(self.reconnect_times)
+            return {'terms': list(self.terms), 'connected': self.stream
+                is not None and self.reconnect_started is None,
+                'reconnects': self.reconnects, 'drops': self.drops,
+                'last_error': self.last_error,
+                'retry_in': max(0.0, self.retry_at - time.time()),
+                'last_reconnect': times[-1] * 1000 if times else 0.0,
+                'average_reconnect': sum(times) / len(times) * 1000 if times
+                    else 0.0,
+                'max_reconnect': max(times) * 1000 if times else 0.0}
+
+    """ Return the supervisor's counters as something that can be sent to the
+    user. """
+    def status_report(self):
+        stats = self.statistics()
+        if stats['retry_in'] and self.wanted and not stats['terms']:
+            report = "The Twitter stream dropped (%(last_error)s) and will reconnect in %(retry_in).0f seconds.\n" % stats
+        elif stats['terms']:
+            report = "The Twitter stream is %s tracking %s.\n" % (
+                "connected and" if stats['connected'] else "connecting,",
+                ", ".join(stats['terms']))
+        else:
+            report = "The Twitter stream is not connected.\n"
+        report = report + "It has been (re)connected %(reconnects)d times and has dropped %(drops)d times.  The last reconnection took %(last_reconnect).0f ms (%(average_reconnect).0f ms on average, %(max_reconnect).0f ms at worst)." % stats
+        return report
+
+# Core code...
+if __name__ == '__main__':
+    # Self tests, with a fake stream that "connects" after a short delay.
+    class FakeListener(object):
+        def __init__(self, supervisor):
+            self.supervisor = supervisor
+
+    class FakeStream(object):
+        def __init__(self, listener):
+            self.listener = listener
+            self.running = threading.Event()
+            self.running.error = None
+            self.tracked = None
+
+        def filter(self, track):
+            self.tracked = track
+            time.sleep(0.05)
+            if failing:
+                failing.pop()
+                raise IOError("Connection reset by peer")
+            self.listener.supervisor.connected(self.listener)
+            self.running.wait()
+            if self.running.error:
+                raise IOError(self.running.error)
+
+        def disconnect(self):
+            self.running.set()
+
+    streams = []
+    failing = []
+    backfilled = []
+    def connect(listener):
+        streams.append(FakeStream(listener))
+        return streams[-1]
+
+    supervisor = StreamSupervisor(FakeListener, connect, debounce=0.2,
+        backfill=backfilled.append)
+    supervisor.network_backoff = 0.1
+    for term in ["foo", "bar", "baz"]:
+        supervisor.set_terms(supervisor.wanted + [term])
+        time.sleep(0.05)
+    time.sleep(0.5)
+
+    # Three changes in quick succession only reconnect once.
+    assert len(streams) == 1 and streams[0].tracked == ["foo", "bar", "baz"]
+    assert supervisor.statistics()['connected']
+    old_listener = supervisor.listener
+
+    supervisor.set_terms(["foo", "baz"])
+    time.sleep(0.5)
+    assert len(streams) == 2 and streams[1].tracked == ["foo", "baz"]
+    assert streams[0].running.is_set()
+    assert not supervisor.is_current(old_listener)
+
+    # Reconnecting because the terms changed doesn't need a backfill.
+    assert backfilled == []
+
+    # A stream that drops on its own is reconnected after a delay that
+    # doubles every time the reconnection fails, and then backfilled once.
+    failing.extend([True, True])
+    start = time.time()
+    streams[1].running.error = "Connection reset by peer"
+    streams[1].running.set()
+    while not backfilled and time.time() - start < 5:
+        time.sleep(0.01)
+    elapsed = time.time() - start
+    assert len(streams) == 5 and streams[4].tracked == ["foo", "baz"]
+    assert supervisor.drops == 3 and backfilled == [["foo", "baz"]]
+    print "Reconnected after three drops in %.2f seconds." % elapsed
+    assert 0.05 + 0.1 + 0.2 < elapsed < 0.1 + 0.2 + 0.4 + 0.5
+
+    supervisor.set_terms([])
+    time.sleep(0.5)
+    assert len(streams) == 5 and streams[4].running.is_set()
+    assert not supervisor.statistics()['connected']
+    print supervisor.status_report()
+    supervisor.stop()
+    sys.exit(0)
+# Fin.
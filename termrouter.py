@@ -0,0 +1,214 @@
+#!/usr/bin/env python2
+# -*- coding: utf-8 -*-
+# vim: set expandtab tabstop=4 shiftwidth=4 :
+
+# This is an Exocortex helper class that figures out which of the search
+# terms the bot is monitoring Twitter for a tweet matched.  Twitter's filter
+# stream sends every tweet that matches any of the terms without saying which
+# one, so the bot has to work that out for itself.
+# - Every term is a rule made of one or more words, all of which have to be
+#   in the tweet (in any order), like Twitter's own track parameter.
+# - Matching is case insensitive.
+# - "Quoted phrases" have to appear word for word.
+# - #hashtags and @mentions only match hashtags and mentions.  Plain words
+#   match hashtags and mentions too, so "exocortex" matches "#exocortex".
+# - Words and phrases with a minus sign in front of them (-word, -"some
+#   phrase") must not be in the tweet.
+# - The rules are compiled into a table keyed by the first word of every
+#   word and phrase, so a tweet is matched against all of them in one pass
+#   over its words.  The cost of matching depends on how long the tweet is,
+#   not on how many rules there are.
+# - Changing the rules compiles a new table and swaps it in, so a tweet is
+#   always matched against one complete set of rules.
+
+# TODO:
+# - Match against expanded URLs and the screen name of the tweet's author,
+#   like Twitter does.
+
+# By: The Doctor <drwho at virtadpt dot net>
+#     0x807B17C1 / 7960 1CDC 85C9 0B63 8D9F  DD89 3BD8 FF2B 807B 17C1
+
+# License: GPLv3
+# Pre-requisite modules have their own licenses.
+
+# Load modules.
+import re
+import sys
+import time
+
+# Splits text into words, keeping the # or @ in front of hashtags and
+# mentions.
+_WORDS = re.compile(r'([#@]?)(\w+)', re.UNICODE)
+
+# Splits a rule into its parts: an optional minus sign, followed by either a
+# quoted phrase or a word.
+_PARTS = re.compile(r'(-?)(?:"([^"]*)"|(\S+))')
+
+# Classes.
+""" This class is a compiled set of rules.  It's never changed after it's
+built. """
+class _Matcher(object):
+    __slots__ = ('atoms', 'rules', 'by_atom')
+
+    def __init__(self, terms):
+        # First word -> list of (atom number, rest of the words).  An atom is
+        # a word or phrase that a rule either needs or rules out.
+        self.atoms = {}
+
+        # (term, atom numbers it needs, atom numbers it rules out)
+        self.rules = []
+
+        # Atom number -> rule numbers that need it.
+        self.by_atom = {}
+
+        numbers = {}
+        for term in terms:
+            required = set()
+            excluded = set()
+            for (negated, phrase, word) in _PARTS.findall(term):
+                words = tuple(prefix + word.lower() for (prefix, word) in
+                    _WORDS.findall(phrase or word))
+                if not words:
+                    continue
+                number = numbers.get(words)
+                if number is None:
+                    number = numbers[words] = len(numbers)
+                    self.atoms.setdefault(words[0], []).append((number,
+                        words[1:]))
+                if negated:
+                    excluded.add(number)
+                else:
+                    required.add(number)
+
+            # A rule with nothing but exclusions can't match anything.
+            if not required:
+                continue
+            rule = len(self.rules)
+            self.rules.append((term, frozenset(required), frozenset(excluded)))
+            for number in required:
+                self.by_atom.setdefault(number, []).append(rule)
+
+    """ Returns the terms that a string of text matches, in the order they
+    were given to the constructor. """
+    def match(self, text):
+        words = _WORDS.findall(text.lower())
+        found = set()
+        atoms = self.atoms
+        for (position, (prefix, word)) in enumerate(words):
+            candidates = atoms.get(word, [])
+            if prefix:
+                candidates = candidates + atoms.get(prefix + word, [])
+            for (number, rest) in candidates:
+                if number in found:
+                    continue
+                if rest and not _follows(words, position + 1, rest):
+                    continue
+                found.add(number)
+        if not found:
+            return ()
+
+        matched = set()
+        for number in found:
+            for rule in self.by_atom.get(number, ()):
+                if rule in matched:
+                    continue
+                (term, required, excluded) = self.rules[rule]
+                if required <= found and not (excluded & found):
+                    matched.add(rule)
+        return tuple(self.rules[rule][0] for rule in sorted(matched))
+
+""" This class holds the current set of rules and matches tweets against
+them. """
+class TermRouter(object):
+    # The compiled rules, and the terms they were compiled from.
+    matcher = None
+    terms = ()
+
+    def __init__(self, terms=()):
+        self.compile(terms)
+
+    """ Replace the rules with a new set of terms. """
+    def compile(self, terms):
+        terms = tuple(terms)
+        matcher = _Matcher(terms)
+        self.terms = terms
+        self.matcher = matcher
+
+    """ Returns the terms that a string of text matches. """
+    def match(self, text):
+        if not text:
+            return ()
+        return self.matcher.match(text)
+
+    """ Returns the terms in the form that Twitter's streaming API expects:
+    the words and phrases a term needs, without quotes, and without the ones
+    it rules out (the router takes care of those). """
+    def track_terms(self):
+        return [track for track in map(_track_term, self.terms) if track]
+
+    """ Returns the terms that a stream tracking the given track terms (what
+    track_terms() returned when it connected) is listening for. """
+    def tracked_by(self, track_terms):
+        track_terms = set(track_terms)
+        return [term for term in self.terms if _track_term(term) in
+            track_terms]
+
+""" Returns a term in the form that Twitter's streaming API expects, or None
+if it doesn't need anything. """
+def _track_term(term):
+    parts = [phrase or word for (negated, phrase, word) in
+        _PARTS.findall(term) if not negated]
+    if parts:
+        return " ".join(parts)
+    return None
+
+""" Returns True if the words starting at a position in a list of (prefix,
+word) tuples are the given words.  Plain words match hashtags and mentions
+too. """
+def _follows(words, position, rest):
+    if position + len(rest) > len(words):
+        return False
+    for (offset, wanted) in enumerate(rest):
+        (prefix, word) = words[position + offset]
+        if wanted != word and wanted != prefix + word:
+            return False
+    return True
+
+# Core code...
+if __name__ == '__main__':
+    # Self tests.
+    router = TermRouter(["Exocortex", "#python", "quick fox",
+        '"lazy dog" -cat', "@drwho", "-nothing", 'brown -"red fox"'])
+    assert router.match("I'm working on my #exocortex") == ("Exocortex", )
+    assert router.match("python is fun") == ()
+    assert router.match("#Python is fun") == ("#python", )
+    assert router.match("The fox is quick") == ("quick fox", )
+    assert router.match("The lazy dog sleeps") == ('"lazy dog" -cat', )
+    assert router.match("The dog is lazy") == ()
+    assert router.match("The lazy dog and the cat") == ()
+    assert router.match("@DrWho wrote an exocortex") == ("Exocortex",
+        "@drwho")
+    assert router.match("drwho") == ()
+    assert router.match("nothing") == ()
+    assert router.match("The brown fox") == ('brown -"red fox"', )
+    assert router.match("The brown and red fox") == ()
+    assert router.match(None) == ()
+    assert router.track_terms() == ["Exocortex", "#python", "quick fox",
+        "lazy dog", "@drwho", "brown"]
+    assert router.tracked_by(["lazy dog", "brown", "gone"]) == [
+        '"lazy dog" -cat', 'brown -"red fox"']
+
+    # The cost of matching shouldn't depend on how many rules there are.
+    tweet = "This is test tweet number 42 about the #exocortex project. " \
+        "http://t.co/boing"
+    for count in (10, 1000, 100000):
+        router.compile(["term%d" % i for i in range(count)] +
+            ["exocortex project"])
+        assert router.match(tweet) == ("exocortex project", )
+        start = time.time()
+        for i in range(10000):
+            router.match(tweet)
+        print "%6d rules: %5.1f us per tweet." % (count + 1,
+            (time.time() - start) * 100)
+    sys.exit(0)
+# Fin.
@@ -0,0 +1,569 @@
+#!/usr/bin/env python2
+# -*- coding: utf-8 -*-
+# vim: set expandtab tabstop=4 shiftwidth=4 :
+
+# This is an Exocortex helper class that finds the words and hashtags that are
+# spiking in the stream right now, without asking Twitter's trends API (which
+# is slow and has a small quota).
+# - Every tweet's distinct words and hashtags (minus stop words, numbers, and
+#   URLs) are counted twice over: once in a short window (how much is being
+#   said about them right now) and once in a long one (how much is usually
+#   said about them).
+# - The windows are exponentially decaying counters: every count fades away
+#   with a half-life (five minutes and six hours by default).  Rather than
+#   shrinking every counter all the time, new counts are made bigger the
+#   later they arrive ("forward decay"), and everything is scaled back down
+#   once in a while so the numbers don't get too big.
+# - The short window is a Space-Saving table: the few hundred terms with the
+#   biggest counts are tracked exactly, and a new term takes the place of the
+#   smallest one (inheriting its count as a possible error).  The long window
+#   is a Count-Min sketch, a small table of counters that every term is
+#   hashed into, which never underestimates.  Both take a fixed amount of
+#   memory no matter how many different terms go by.
+# - A term is spiking if its share of the short window is much bigger than
+#   its share of the long one: the count it "should" have right now is
+#   worked out from the long window, and if the count it does have is
+#   several times that, and far enough above it that it isn't noise, it's
+#   spiking.  Because the long window counts what's in the short window too,
+#   nothing spikes until the bot has been listening for a while.
+# - That can't work for the bot's own search terms: the stream is filtered
+#   on them, so they're in nearly every tweet and their share of it hardly
+#   moves.  Their rates are watched instead, with an exact pair of decaying
+#   counts per term (of the tweets the term router matched to it).  A search
+#   term is bursting if the tweets matching it are coming in several times as
+#   fast as they usually do.  A decaying count only settles at rate * tau
+#   once it's been counting for a few half-lives, so both counts are
+#   divided by what they'd have reached by now at a steady rate, and a term
+#   that was just added doesn't look like it's bursting.
+# - Every so often the spiking terms are checked, and a function is called
+#   for every term that has just started spiking.
+# - Benchmark it with:
+#   python trenddetector.py [number of tweets]
+
+# TODO:
+# -
+
+# By: The Doctor <drwho at virtadpt dot net>
+#     0x807B17C1 / 7960 1CDC 85C9 0B63 8D9F  DD89 3BD8 FF2B 807B 17C1
+
+# License: GPLv3
+# Pre-requisite modules have their own licenses.
+
+# Load modules.
+import heapq
+import math
+import re
+import sys
+import threading
+import time
+from tweetstats import STOP_WORDS
+
+# Splits text into words and hashtags, and finds URLs so they can be skipped.
+_TERMS = re.compile(r'#?\w+', re.UNICODE)
+_URLS = re.compile(r'https?://\S+')
+
+# Counters are scaled back down when forward decay has made new counts this
+# many times (e**_RESCALE) bigger than they started out.
+_RESCALE = 30.0
+
+# Classes.
+""" This class is a pair of exact decaying counts (short and long windows) of
+the tweets that matched one search term. """
+class _Rates(object):
+    __slots__ = ('short', 'long', 'updated', 'started')
+
+    def __init__(self, now):
+        self.short = 0.0
+        self.long = 0.0
+        self.updated = now
+        self.started = now
+
+    """ Count a tweet at a given time.  Late tweets count for less, as if
+    they'd been counted when they were posted. """
+    def add(self, timestamp, short_tau, long_tau):
+        if timestamp >= self.updated:
+            self.short = self.short * math.exp((self.updated - timestamp) /
+                short_tau) + 1.0
+            self.long = self.long * math.exp((self.updated - timestamp) /
+                long_tau) + 1.0
+            self.updated = timestamp
+        else:
+            self.short += math.exp((timestamp - self.updated) / short_tau)
+            self.long += math.exp((timestamp - self.updated) / long_tau)
+
+    """ Returns the (short, long) counts as of a given time. """
+    def counts(self, now, short_tau, long_tau):
+        age = min(0.0, self.updated - now)
+        return (self.short * math.exp(age / short_tau),
+            self.long * math.exp(age / long_tau))
+
+""" This class is a Count-Min sketch of decaying counts.  It's a table of
+'depth' rows of 'width' counters (width has to be a power of two), and every
+term adds to one counter per row.  Counts are estimated by taking the
+smallest of a term's counters.  Updates are conservative: a counter is only
+made as big as the term's new estimate, which cuts down on the
+overestimating that collisions cause. """
+class CountMinSketch(object):
+    width = 4096
+    depth = 4
+
+    def __init__(self, half_life, width=None, depth=None, now=None):
+        if width:
+            self.width = width
+        if depth:
+            self.depth = depth
+        self.mask = self.width - 1
+        self.tau = half_life / math.log(2)
+        self.landmark = now if now is not None else time.time()
+        self.rows = [[0.0] * self.width for i in xrange(self.depth)]
+        self.total = 0.0
+
+    """ Returns the columns a term hashes into, one per row (by double
+    hashing). """
+    def _columns(self, term):
+        number = hash(term)
+        step = ((number >> 32) & 0xffffffff) | 1
+        mask = self.mask
+        return [(number + i * step) & mask for i in xrange(self.depth)]
+
+    """ Returns how much a count made at a given time weighs. """
+    def _weight(self, timestamp):
+        exponent = (timestamp - self.landmark) / self.tau
+        if exponent > _RESCALE:
+            self._rescale(timestamp)
+            exponent = 0.0
+        return math.exp(exponent)
+
+    """ Move the landmark up to a given time, scaling every counter down to
+    match. """
+    def _rescale(self, timestamp):
+        factor = math.exp((self.landmark - timestamp) / self.tau)
+        self.rows = [[count * factor for count in row] for row in self.rows]
+        self.total *= factor
+        self.landmark = timestamp
+
+    """ Count a bunch of terms, each once, at a given time. """
+    def add(self, terms, timestamp):
+        weight = self._weight(timestamp)
+        rows = self.rows
+        for term in terms:
+            columns = self._columns(term)
+            counts = map(list.__getitem__, rows, columns)
+            estimate = min(counts) + weight
+            for (row, column, count) in zip(rows, columns, counts):
+                if count < estimate:
+                    row[column] = estimate
+        self.total += weight
+
+    """ Returns the estimated count of a term as of a given time. """
+    def estimate(self, term, now):
+        return min(map(list.__getitem__, self.rows, self._columns(term))) * \
+            math.exp((self.landmark - now) / self.tau)
+
+    """ Returns the total count (of tweets, not terms) as of a given time. """
+    def total_count(self, now):
+        return self.total * math.exp((self.landmark - now) / self.tau)
+
+""" This class is a Space-Saving table of decaying counts.  It tracks the
+'size' terms with the biggest counts.  A term that isn't being tracked takes
+the place of the one with the smallest count, and starts out with that count
+plus its own, the old count being how far off the new one might be. """
+class SpaceSaving(object):
+    size = 500
+
+    def __init__(self, half_life, size=None, now=None):
+        if size:
+            self.size = size
+        self.tau = half_life / math.log(2)
+        self.landmark = now if now is not None else time.time()
+
+        # Term -> [count, error], and a min-heap of (count, term) that has
+        # stale entries in it; an entry is only good if its count is the
+        # term's count.
+        self.counts = {}
+        self.heap = []
+        self.total = 0.0
+
+    """ Returns how much a count made at a given time weighs. """
+    def _weight(self, timestamp):
+        exponent = (timestamp - self.landmark) / self.tau
+        if exponent > _RESCALE:
+            self._rescale(timestamp)
+            exponent = 0.0
+        return math.exp(exponent)
+
+    """ Move the landmark up to a given time, scaling every count down to
+    match. """
+    def _rescale(self, timestamp):
+        factor = math.exp((self.landmark - timestamp) / self.tau)
+        for counter in self.counts.itervalues():
+            counter[0] *= factor
+            counter[1] *= factor
+        self.total *= factor
+        self.landmark = timestamp
+        self._rebuild()
+
+    """ Rebuild the heap from the counts, throwing away the stale entries. """
+    def _rebuild(self):
+        self.heap = [(counter[0], term) for (term, counter) in
+            self.counts.iteritems()]
+        heapq.heapify(self.heap)
+
+    """ Count a bunch of terms, each once, at a given time. """
+    def add(self, terms, timestamp):
+        weight = self._weight(timestamp)
+        counts = self.counts
+        for term in terms:
+            counter = counts.get(term)
+            if counter is None:
+                if len(counts) < self.size:
+                    counter = counts[term] = [0.0, 0.0]
+                else:
+                    # Throw out the term with the smallest count.
+                    while True:
+                        (count, smallest) = heapq.heappop(self.heap)
+                        if counts[smallest][0] == count:
+                            break
+                    del counts[smallest]
+                    counter = counts[term] = [count, count]
+            counter[0] += weight
+            heapq.heappush(self.heap, (counter[0], term))
+        self.total += weight
+        if len(self.heap) > 4 * self.size:
+            self._rebuild()
+
+    """ Returns (term, count, error) for every tracked term, as of a given
+    time. """
+    def items(self, now):
+        factor = math.exp((self.landmark - now) / self.tau)
+        return [(term, counter[0] * factor, counter[1] * factor) for
+            (term, counter) in self.counts.iteritems()]
+
+    """ Returns the total count (of tweets, not terms) as of a given time. """
+    def total_count(self, now):
+        return self.total * math.exp((self.landmark - now) / self.tau)
+
+""" This class is the detector.  It's safe to use from several threads. """
+class TrendDetector(object):
+    # Half-lives (in seconds) of the short and long windows.
+    short_half_life = 300
+    long_half_life = 21600
+
+    # A term is spiking if its count in the short window is at least
+    # 'min_count', at least 'min_ratio' times what it usually is, and at
+    # least 'threshold' standard deviations above that.
+    min_count = 5
+    min_ratio = 3.0
+    threshold = 4.0
+
+    # How often (in seconds) to check for terms that have started spiking,
+    # and the function that's called with every one of them and its
+    # statistics.
+    check_interval = 30
+    alert = None
+
+    # How many spiking terms to list.
+    top = 10
+
+    short = None
+    long = None
+
+    # Search terms -> _Rates, for the terms whose rates are watched.
+    watched = None
+
+    # The terms that were spiking (or bursting) the last time they were
+    # checked.
+    spiking_terms = None
+
+    # Counters.
+    tweets = 0
+    terms = 0
+
+    def __init__(self, alert=None, short_half_life=None, long_half_life=None,
+        size=None, width=None, depth=None, now=None):
+        self.alert = alert
+        if short_half_life:
+            self.short_half_life = short_half_life
+        if long_half_life:
+            self.long_half_life = long_half_life
+        now = now if now is not None else time.time()
+        self.short = SpaceSaving(self.short_half_life, size, now)
+        self.long = CountMinSketch(self.long_half_life, width, depth, now)
+        self.watched = {}
+        self.spiking_terms = set()
+        self.last_check = now
+        self.tweets = 0
+        self.terms = 0
+        self.lock = threading.Lock()
+
+    """ Set the search terms whose rates are watched.  Terms that were already
+    being watched keep their counts. """
+    def watch(self, terms, now=None):
+        now = now if now is not None else time.time()
+        with self.lock:
+            self.watched = dict((term, self.watched.get(term) or _Rates(now))
+                for term in terms)
+
+    """ Count a TweetRecord's terms, and the search terms it matched (its
+    'terms' attribute, if it has one).  Tweets are counted as of when they
+    were posted (unless that's in the future), so old ones that turn up late
+    (e.g., by backfilling) don't look like they're spiking. """
+    def add(self, tweet, now=None):
+        if tweet.text is None:
+            return
+        now = now if now is not None else time.time()
+        timestamp = min(tweet.created_at or now, now)
+        terms = set(term for term in _TERMS.findall(_URLS.sub(" ",
+            tweet.text.lower())) if len(term) > 1 and
+            term.lstrip('#') not in STOP_WORDS and not term.isdigit())
+        with self.lock:
+            self.short.add(terms, timestamp)
+            self.long.add(terms, timestamp)
+            for term in getattr(tweet, 'terms', None) or ():
+                rates = self.watched.get(term)
+                if rates is not None:
+                    rates.add(timestamp, self.short.tau, self.long.tau)
+            self.tweets += 1
+            self.terms += len(terms)
+            check = now - self.last_check >= self.check_interval
+            if check:
+                self.last_check = now
+        if check:
+            self.check(now)
+
+    """ Returns a list of dicts describing the terms that are spiking as of a
+    given time, most spiking first. """
+    def spiking(self, now=None):
+        now = now if now is not None else time.time()
+        results = []
+        with self.lock:
+            short_total = self.short.total_count(now)
+            long_total = self.long.total_count(now)
+            if not long_total:
+                return results
+            for (term, count, error) in self.short.items(now):
+                # Only count what it's sure of.
+                count = count - error
+                if count < self.min_count:
+                    continue
+                expected = self.long.estimate(term, now) / long_total * \
+                    short_total
+                ratio = (count + 1) / (expected + 1)
+                score = (count - expected) / math.sqrt(expected + 1)
+                if ratio >= self.min_ratio and score >= self.threshold:
+                    results.append({'term': term, 'count': count,
+                        'expected': expected, 'ratio': ratio,
+                        'score': score})
+        results.sort(key=lambda result: -result['score'])
+        return results
+
+    """ Returns a list of dicts like spiking()'s describing the watched search
+    terms that are bursting as of a given time, most bursting first.  The
+    count a term is expected to have in the short window is what it would
+    have if tweets had kept coming in at the rate the long window says. """
+    def bursting(self, now=None):
+        now = now if now is not None else time.time()
+        short_tau = self.short.tau
+        long_tau = self.long.tau
+        results = []
+        with self.lock:
+            for (term, rates) in self.watched.iteritems():
+                (count, long_count) = rates.counts(now, short_tau, long_tau)
+                age = now - rates.started
+                if count < self.min_count or age <= 0:
+                    continue
+                expected = long_count / (long_tau * (1.0 - math.exp(-age /
+                    long_tau))) * short_tau * (1.0 - math.exp(-age /
+                    short_tau))
+                ratio = (count + 1) / (expected + 1)
+                score = (count - expected) / math.sqrt(expected + 1)
+                if ratio >= self.min_ratio and score >= self.threshold:
+                    results.append({'term': term, 'count': count,
+                        'expected': expected, 'ratio': ratio,
+                        'score': score})
+        results.sort(key=lambda result: -result['score'])
+        return results
+
+    """ Returns spiking() and bursting() together, most unusual first. """
+    def unusual(self, now=None):
+        results = self.spiking(now) + self.bursting(now)
+        results.sort(key=lambda result: -result['score'])
+        return results
+
+    """ Returns a list of (term, count) for the terms with the biggest counts
+    in the short window as of a given time. """
+    def busiest(self, now=None):
+        now = now if now is not None else time.time()
+        with self.lock:
+            items = self.short.items(now)
+        return [(term, count - error) for (term, count, error) in
+            heapq.nlargest(self.top, items, key=lambda item: item[1] -
+                item[2])]
+
+    """ Look for terms that have started spiking or bursting since the last
+    check, and call the alert function with every one of them. """
+    def check(self, now=None):
+        results = self.unusual(now)
+        terms = set(result['term'] for result in results)
+        with self.lock:
+            new = [result for result in results if result['term'] not in
+                self.spiking_terms]
+            self.spiking_terms = terms
+        if not self.alert:
+            return
+        for result in new:
+            try:
+                self.alert(result['term'], result)
+            except Exception as error:
+                print "ERROR: Unable to send the alert for %s: %s" % (
+                    result['term'], error)
+
+    """ Return a dict of the detector's counters. """
+    def statistics(self):
+        with self.lock:
+            return {'tweets': self.tweets, 'terms': self.terms,
+                'tracked': len(self.short.counts),
+                'watched': len(self.watched),
+                'spiking': len(self.spiking_terms)}
+
+    """ Return the detector's counters as something that can be sent to the
+    user. """
+    def status_report(self):
+        return "The trend detector has counted %(terms)d terms in %(tweets)d tweets from the stream, is keeping track of %(tracked)d of them (and the rates of %(watched)d search terms), and %(spiking)d were spiking the last time it checked." % self.statistics()
+
+    """ Return what's spiking right now as something that can be sent to the
+    user. """
+    def report(self, now=None):
+        results = self.unusual(now)[:self.top]
+        if results:
+            report = "Spiking in the stream right now (the last few minutes compared to the last few hours):\n"
+            for result in results:
+                report = report + "%(term)s: %(count).0f tweets, %(ratio).1f times as many as usual.\n" % result
+            return report.rstrip()
+        busiest = self.busiest(now)
+        if not busiest:
+            return "I haven't seen any tweets from the stream lately."
+        return "Nothing is spiking in the stream right now.  The busiest terms are: %s." % ", ".join("%s (%.0f)" % (term, count) for (term, count) in busiest)
+
+# Core code...
+if __name__ == '__main__':
+    # Self tests, with an hour of steady chatter (from a vocabulary of 50,000
+    # words) followed by a burst of one hashtag.
+    import random
+    from tweetrecord import TweetRecord
+
+    random.seed(42)
+    start = 1409144925
+    vocabulary = [u"word%d" % i for i in range(50000)]
+
+    def chatter(number, timestamp):
+        words = [random.choice(vocabulary[:100]) for i in range(3)] + \
+            [random.choice(vocabulary) for i in range(5)]
+        tweet = TweetRecord(str(number), timestamp, u" ".join(words) +
+            u" #exocortex http://t.co/abc%d the 2014" % number)
+        tweet.terms = (u"#exocortex", )
+        return tweet
+
+    # The stream is filtered on #exocortex, like the bot's would be.
+    alerts = []
+    detector = TrendDetector(lambda term, result: alerts.append(term),
+        size=200, width=2048, now=start)
+    detector.watch([u"#exocortex"], start)
+    number = 0
+    for second in range(3600):
+        for i in range(5):
+            number += 1
+            detector.add(chatter(number, start + second), start + second)
+    assert not detector.spiking(start + 3600)
+    assert not detector.bursting(start + 3600)
+    assert not alerts
+    assert detector.statistics()['tracked'] == 200
+    assert len(detector.short.heap) <= 4 * 200
+    busiest = detector.busiest(start + 3600)
+    assert busiest[0][0] == u"#exocortex"
+    assert [term for (term, count) in busiest[1:] if term in vocabulary[:100]] \
+        == [term for (term, count) in busiest[1:]]
+    busiest = dict(busiest)
+    assert not [term for term in busiest if term in (u"the", u"2014",
+        u"http", u"t", u"co")]
+    print detector.report(start + 3600)
+
+    # The burst.
+    for second in range(3600, 3900):
+        for i in range(5):
+            number += 1
+            tweet = chatter(number, start + second)
+            if i < 2:
+                tweet.text = tweet.text + u" #breakingnews"
+            detector.add(tweet, start + second)
+    spiking = detector.spiking(start + 3900)
+    assert [result['term'] for result in spiking] == [u"#breakingnews"]
+    assert alerts == [u"#breakingnews"]
+    print detector.report(start + 3900)
+
+    # Old tweets that turn up late don't spike.
+    for i in range(1000):
+        number += 1
+        tweet = chatter(number, start + 600)
+        tweet.text = tweet.text + u" #oldnews"
+        detector.add(tweet, start + 3900)
+    assert u"#oldnews" not in [result['term'] for result in
+        detector.spiking(start + 3900)]
+
+    # The burst dies down, and nothing is spiking a while later.
+    for second in range(3900, 7500):
+        number += 1
+        detector.add(chatter(number, start + second), start + second)
+    assert not detector.unusual(start + 7500)
+    assert not detector.spiking_terms
+
+    # A burst of tweets about the search term, six times as fast as the
+    # busiest part of the last two hours.  It's in every tweet, so its share
+    # of the stream doesn't change, but its rate does.
+    for second in range(7500, 7800):
+        for i in range(30):
+            number += 1
+            detector.add(chatter(number, start + second), start + second)
+    assert [result['term'] for result in detector.bursting(start + 7800)] \
+        == [u"#exocortex"]
+    assert u"#exocortex" not in [result['term'] for result in
+        detector.spiking(start + 7800)]
+    assert alerts == [u"#breakingnews", u"#exocortex"]
+    print detector.report(start + 7800)
+    print detector.status_report()
+
+    # A search term that was only just added doesn't look like it's
+    # bursting.
+    detector.watch([u"#exocortex", u"word1"], start + 7800)
+    for second in range(7800, 7900):
+        number += 1
+        tweet = chatter(number, start + second)
+        tweet.terms = (u"#exocortex", u"word1")
+        detector.add(tweet, start + second)
+    assert u"word1" not in [result['term'] for result in
+        detector.bursting(start + 7900)]
+
+    # Forward decay rescales without changing the estimates.
+    sketch = CountMinSketch(10, width=64, now=0)
+    sketch.add([u"a"], 0)
+    sketch.add([u"a"], 10)
+    assert abs(sketch.estimate(u"a", 10) - 1.5) < 1e-9
+    sketch.add([u"a"], 1000)
+    assert sketch.landmark == 1000
+    assert abs(sketch.estimate(u"a", 1000) - 1.0) < 1e-9
+
+    # Benchmark.
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 200000
+    detector = TrendDetector(now=start)
+    tweets = [chatter(i, start + i / 100) for i in xrange(count)]
+    began = time.time()
+    for tweet in tweets:
+        detector.add(tweet, tweet.created_at)
+    elapsed = time.time() - began
+    print "%d tweets counted in %.2f seconds (%.0f per second)." % (count,
+        elapsed, count / elapsed)
+    began = time.time()
+    detector.spiking(start + count / 100)
+    print "Spiking terms found in %.1f ms." % ((time.time() - began) * 1000)
+    sys.exit(0)
+# Fin.
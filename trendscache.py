@@ -0,0 +1,162 @@
+#!/usr/bin/env python2
+# -*- coding: utf-8 -*-
+# vim: set expandtab tabstop=4 shiftwidth=4 :
+
+# This is an Exocortex helper class that caches what Twitter's API says about
+# trending topics.
+# - The list of places that have trending topics (trends_available(), about
+#   100 KB) is downloaded once a day at most, and indexed by the lowercase
+#   name of every country and place in it.  Looking up the WOEIDs of a place
+#   is a dict lookup.
+# - The trending topics of every place (trends_place()) are cached for five
+#   minutes, which is how often Twitter updates them.
+# - When the trends of several places are needed, the ones that aren't
+#   cached are fetched at the same time by a small pool of threads.
+
+# TODO:
+# -
+
+# By: The Doctor <drwho at virtadpt dot net>
+#     0x807B17C1 / 7960 1CDC 85C9 0B63 8D9F  DD89 3BD8 FF2B 807B 17C1
+
+# License: GPLv3
+# Pre-requisite modules have their own licenses.
+
+# Load modules.
+from multiprocessing.pool import ThreadPool
+import sys
+import threading
+import time
+
+# Classes.
+""" This class is the cache.  It's given a tweepy API object (or anything
+else with trends_available() and trends_place() methods).  Errors from the
+API are passed along to the caller. """
+class TrendsCache(object):
+    # How long (in seconds) the list of places and the trends of every place
+    # are kept, and how many trends_place() calls can be made at once.
+    locations_ttl = 86400
+    trends_ttl = 300
+    workers = 4
+
+    api = None
+
+    # Lowercase country or place name -> list of WOEIDs, and when it
+    # expires.
+    locations = {}
+    locations_expire = 0
+
+    # WOEID -> (time it expires, trends).
+    trends_cache = {}
+
+    def __init__(self, api, locations_ttl=None, trends_ttl=None,
+        workers=None):
+        self.api = api
+        if locations_ttl is not None:
+            self.locations_ttl = locations_ttl
+        if trends_ttl is not None:
+            self.trends_ttl = trends_ttl
+        if workers:
+            self.workers = workers
+        self.locations = {}
+        self.locations_expire = 0
+        self.trends_cache = {}
+        self.lock = threading.Lock()
+        self.pool = None
+
+    """ Download the list of places with trending topics and index it, if the
+    copy on hand has expired. """
+    def _refresh_locations(self):
+        with self.lock:
+            if time.time() < self.locations_expire:
+                return
+        trending_locations = self.api.trends_available()
+
+        # A place can show up under its country's name and its own name.
+        locations = {}
+        for locale in trending_locations:
+            for name in (locale.get('country'), locale.get('name')):
+                if not name:
+                    continue
+                woeids = locations.setdefault(name.lower(), [])
+                if locale['woeid'] not in woeids:
+                    woeids.append(locale['woeid'])
+        with self.lock:
+            self.locations = locations
+            self.locations_expire = time.time() + self.locations_ttl
+
+    """ Returns the WOEIDs of every place with trending topics that's in a
+    country or has a name (case insensitive). """
+    def woeids(self, location):
+        self._refresh_locations()
+        return list(self.locations.get(location.strip().lower(), ()))
+
+    """ Returns a list of (WOEID, trends) for a list of WOEIDs, in the same
+    order.  The trends are whatever trends_place() returns for the WOEID. """
+    def trends(self, woeids):
+        now = time.time()
+        results = {}
+        missing = []
+        with self.lock:
+            for woeid in woeids:
+                cached = self.trends_cache.get(woeid)
+                if cached and cached[0] > now:
+                    results[woeid] = cached[1]
+                elif woeid not in missing:
+                    missing.append(woeid)
+
+        if missing:
+            if len(missing) == 1:
+                fetched = [self.api.trends_place(id=missing[0])]
+            else:
+                if self.pool is None:
+                    self.pool = ThreadPool(self.workers)
+                fetched = self.pool.map(lambda woeid:
+                    self.api.trends_place(id=woeid), missing)
+            expires = time.time() + self.trends_ttl
+            with self.lock:
+                for (woeid, trends) in zip(missing, fetched):
+                    self.trends_cache[woeid] = (expires, trends)
+                    results[woeid] = trends
+        return [(woeid, results[woeid]) for woeid in woeids]
+
+# Core code...
+if __name__ == '__main__':
+    # Self tests, with a fake API that takes a while to answer.
+    class FakeAPI(object):
+        calls = {'trends_available': 0, 'trends_place': 0}
+
+        def trends_available(self):
+            self.calls['trends_available'] += 1
+            return [{'country': 'United States', 'name': 'United States',
+                'woeid': 23424977}] + [{'country': 'United States',
+                'name': 'City %d' % i, 'woeid': i} for i in range(1, 6)] + \
+                [{'country': 'Canada', 'name': 'Toronto', 'woeid': 4118}]
+
+        def trends_place(self, id):
+            self.calls['trends_place'] += 1
+            time.sleep(0.2)
+            return [{'trends': [{'name': '#trend%d' % id,
+                'url': 'http://twitter.com/search?q=%d' % id}]}]
+
+    api = FakeAPI()
+    cache = TrendsCache(api)
+    woeids = cache.woeids("united states")
+    assert woeids == [23424977, 1, 2, 3, 4, 5]
+    assert cache.woeids("TORONTO") == [4118] and cache.woeids("nowhere") == []
+    assert api.calls['trends_available'] == 1
+
+    start = time.time()
+    trends = cache.trends(woeids)
+    elapsed = time.time() - start
+    assert [woeid for (woeid, trend) in trends] == woeids
+    assert trends[1][1][0]['trends'][0]['name'] == '#trend1'
+    print "Fetched the trends of %d places in %.2f seconds (%.2f one at a time)." % (len(woeids), elapsed, 0.2 * len(woeids))
+    assert elapsed < 0.2 * len(woeids)
+
+    start = time.time()
+    cache.trends(woeids)
+    assert time.time() - start < 0.01
+    assert api.calls['trends_place'] == len(woeids)
+    sys.exit(0)
+# Fin.
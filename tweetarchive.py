@@ -0,0 +1,367 @@
+#!/usr/bin/env python2
+# -*- coding: utf-8 -*-
+# vim: set expandtab tabstop=4 shiftwidth=4 :
+
+# This is an Exocortex helper class that loads the tweets.csv file from the
+# archive Twitter lets people download of their own tweets into an SQLite
+# database, so the bot's owner can search their own timeline.
+# - The file is read a row at a time, so importing it takes the same amount
+#   of memory no matter how big it is.
+# - Rows are inserted in batches, each in its own transaction.  Tweets that
+#   are already in the database (from an earlier import) are replaced, so
+#   importing a newer archive on top of an older one is fine.
+# - The index on the tweets' timestamps and the full-text index of their
+#   text are dropped before the load and built again after it, which is a lot
+#   faster than keeping them up to date one row at a time.  If the copy of
+#   SQLite that Python was built with doesn't have full-text search (FTS4),
+#   searches fall back to LIKE.
+# - Progress (rows, bytes, and how far through the file the import is) is
+#   passed to a callback every few seconds.
+# - Columns are found by the names in the file's header, so it doesn't
+#   matter what order they're in.  Timestamps are stored as seconds since the
+#   epoch (UTC).
+# - Converting the rows is kept to a minimum, because that's where most of
+#   the time goes: text goes into the database as the UTF-8 it's already in,
+#   SQLite turns IDs into numbers by itself (the columns are INTEGER), blank
+#   fields are turned into NULLs by the INSERT, and only timestamps are
+#   parsed in Python (with the start of every day they fall on cached).
+# - Benchmark it with:
+#   python tweetarchive.py [tweets.csv]
+
+# TODO:
+# -
+
+# By: The Doctor <drwho at virtadpt dot net>
+#     0x807B17C1 / 7960 1CDC 85C9 0B63 8D9F  DD89 3BD8 FF2B 807B 17C1
+
+# License: GPLv3
+# Pre-requisite modules have their own licenses.
+
+# Load modules.
+import calendar
+import csv
+import itertools
+import operator
+import os
+import sqlite3
+import sys
+import threading
+import time
+
+# The columns of tweets.csv, in the order they're stored in.
+COLUMNS = ('tweet_id', 'in_reply_to_status_id', 'in_reply_to_user_id',
+    'timestamp', 'source', 'text', 'retweeted_status_id',
+    'retweeted_status_user_id', 'retweeted_status_timestamp',
+    'expanded_urls')
+
+# Seconds since the epoch at the start of every date ("2014-08-27") that's
+# been parsed.
+_days = {}
+
+_SCHEMA = """CREATE TABLE IF NOT EXISTS tweets (tweet_id INTEGER PRIMARY KEY,
+    in_reply_to_status_id INTEGER, in_reply_to_user_id INTEGER,
+    timestamp INTEGER, source TEXT, text TEXT, retweeted_status_id INTEGER,
+    retweeted_status_user_id INTEGER, retweeted_status_timestamp INTEGER,
+    expanded_urls TEXT)"""
+
+# Classes.
+""" This class is the database.  It's safe to use from several threads, but
+only one import runs at a time. """
+class TweetArchive(object):
+    # How many rows go into each transaction, and how often (in seconds)
+    # progress is reported.
+    batch_size = 10000
+    progress_interval = 5.0
+
+    # The database file.
+    filename = ""
+
+    # Whether the full-text index can be used.
+    fts = False
+
+    def __init__(self, filename, batch_size=None, progress_interval=None):
+        self.filename = filename
+        if batch_size:
+            self.batch_size = batch_size
+        if progress_interval:
+            self.progress_interval = progress_interval
+        self.import_lock = threading.Lock()
+        self.importing = None
+        self.last_import = None
+
+        database = self._connect()
+        try:
+            database.execute(_SCHEMA)
+            self.fts = self._has_fts(database)
+            database.commit()
+        finally:
+            database.close()
+
+    """ Returns a new connection to the database.  SQLite connections can't be
+    shared between threads.  Text is stored as UTF-8, and anything that isn't
+    valid UTF-8 is replaced when it's read back. """
+    def _connect(self):
+        database = sqlite3.connect(self.filename)
+        database.text_factory = lambda value: value.decode('utf-8', 'replace')
+        return database
+
+    """ Returns True if the full-text index exists or can be made. """
+    def _has_fts(self, database):
+        try:
+            database.execute("CREATE VIRTUAL TABLE IF NOT EXISTS tweets_fts USING fts4(text, content='tweets')")
+            return True
+        except sqlite3.OperationalError:
+            return False
+
+    """ Import a tweets.csv file (a filename or an open file).  'progress' is
+    called every so often with the number of rows imported so far, the
+    number of bytes read, and the size of the file (or None if it isn't
+    known).  Returns (number of rows imported, seconds it took).  Raises
+    ValueError if the file doesn't look like a tweets.csv file. """
+    def import_csv(self, source, progress=None):
+        if isinstance(source, basestring):
+            csvfile = open(source, 'rb')
+        else:
+            csvfile = source
+        try:
+            total = os.fstat(csvfile.fileno()).st_size
+        except (AttributeError, OSError, ValueError):
+            total = None
+
+        with self.import_lock:
+            start = time.time()
+            counter = _LineCounter(csvfile)
+            self.importing = counter
+            database = self._connect()
+            try:
+                rows = self._load(database, counter, progress, total)
+            finally:
+                self.importing = None
+                database.close()
+                if csvfile is not source:
+                    csvfile.close()
+            elapsed = time.time() - start
+            self.last_import = (rows, counter.bytes, elapsed)
+            return (rows, elapsed)
+
+    """ Do the actual work of an import. """
+    def _load(self, database, counter, progress, total):
+        reader = csv.reader(counter)
+        try:
+            header = reader.next()
+        except StopIteration:
+            raise ValueError("The file is empty.")
+        positions = dict((name.strip(), i) for (i, name) in enumerate(header))
+        if 'tweet_id' not in positions or 'text' not in positions:
+            raise ValueError("This isn't a tweets.csv file from a Twitter archive (there's no tweet_id or text column).")
+
+        # Pick out the columns the file has in the order they're stored in.
+        present = [name for name in COLUMNS if name in positions]
+        pick = operator.itemgetter(*[positions[name] for name in present])
+        times = [i for (i, name) in enumerate(present) if
+            name.endswith('timestamp')]
+        width = max(positions.values()) + 1
+        id_position = positions['tweet_id']
+        def convert(row):
+            if len(row) < width:
+                row = row + [''] * (width - len(row))
+            values = list(pick(row))
+            for i in times:
+                values[i] = _parse_time(values[i])
+            return values
+
+        # Nobody's going to read the database while it's being loaded, so
+        # don't wait for the disk after every transaction.  SQLite's journal
+        # still makes every batch all-or-nothing if the bot crashes.
+        database.execute("PRAGMA synchronous = OFF")
+        database.execute("PRAGMA cache_size = -65536")
+        database.execute("DROP INDEX IF EXISTS tweets_timestamp")
+
+        insert = "INSERT OR REPLACE INTO tweets (%s) VALUES (%s)" % (
+            ", ".join(present), ", ".join("?" if name == 'tweet_id' or i in
+            times else "NULLIF(?, '')" for (i, name) in enumerate(present)))
+        rows = 0
+        last_report = time.time()
+        try:
+            while True:
+                rows_read = list(itertools.islice(reader, self.batch_size))
+                if not rows_read:
+                    break
+                batch = [convert(row) for row in rows_read if row and
+                    row[id_position:id_position + 1] != ['']]
+                with database:
+                    database.executemany(insert, batch)
+                rows += len(batch)
+                if progress and time.time() - last_report >= \
+                    self.progress_interval:
+                    last_report = time.time()
+                    progress(rows, counter.bytes, total)
+        finally:
+            # Build the indexes, even if the import failed part of the way
+            # through: the batches before that are in the database, and
+            # searches need the indexes either way.
+            with database:
+                database.execute("CREATE INDEX IF NOT EXISTS tweets_timestamp ON tweets (timestamp)")
+                if self.fts:
+                    database.execute("INSERT INTO tweets_fts(tweets_fts) VALUES ('rebuild')")
+            database.execute("PRAGMA synchronous = FULL")
+        return rows
+
+    """ Returns up to 'limit' of the tweets that match a query, newest first,
+    as (tweet_id, timestamp, text) tuples.  With full-text search the query
+    can use its syntax (e.g., "some phrase", OR, prefix*); otherwise it's
+    a string to look for. """
+    def search(self, query, limit=10):
+        database = self._connect()
+        try:
+            if self.fts:
+                cursor = database.execute("SELECT tweets.tweet_id, tweets.timestamp, tweets.text FROM tweets_fts JOIN tweets ON tweets.tweet_id = tweets_fts.rowid WHERE tweets_fts MATCH ? ORDER BY tweets.timestamp DESC LIMIT ?", (query, limit))
+            else:
+                cursor = database.execute("SELECT tweet_id, timestamp, text FROM tweets WHERE text LIKE ? ORDER BY timestamp DESC LIMIT ?", ("%" + query + "%", limit))
+            return cursor.fetchall()
+        finally:
+            database.close()
+
+    """ Returns how many tweets are in the database. """
+    def __len__(self):
+        database = self._connect()
+        try:
+            return database.execute("SELECT COUNT(*) FROM tweets").fetchone()[0]
+        finally:
+            database.close()
+
+    """ Return the state of the database as something that can be sent to
+    the user. """
+    def status_report(self):
+        importing = self.importing
+        if importing is not None:
+            return "Your tweet archive is being imported: %d MB read so far." % (importing.bytes / 1048576)
+        report = "Your tweet archive holds %d tweets." % len(self)
+        if self.last_import:
+            report = report + "  The last import loaded %d tweets (%.1f MB) in %.1f seconds." % (self.last_import[0], self.last_import[1] / 1048576.0, self.last_import[2])
+        return report
+
+""" This class passes the lines of a file along to the CSV reader and keeps
+track of how many bytes have gone by.  (File objects won't say where they
+are while they're being iterated over.) """
+class _LineCounter(object):
+    def __init__(self, csvfile):
+        self.csvfile = iter(csvfile)
+        self.bytes = 0
+
+    def __iter__(self):
+        return self
+
+    def next(self):
+        line = self.csvfile.next()
+        self.bytes += len(line)
+        return line
+
+""" Turn a timestamp in the archive's format ("2014-08-27 13:08:45 +0000")
+into seconds since the epoch.  Returns None if it can't be parsed. """
+def _parse_time(value):
+    if not value:
+        return None
+    try:
+        day = _days.get(value[0:10])
+        if day is None:
+            day = _days[value[0:10]] = calendar.timegm((int(value[0:4]),
+                int(value[5:7]), int(value[8:10]), 0, 0, 0, 0, 0, 0))
+        seconds = day + int(value[11:13]) * 3600 + int(value[14:16]) * 60 + \
+            int(value[17:19])
+        offset = value[20:]
+        if offset:
+            offset = int(offset)
+            sign = -1 if offset < 0 else 1
+            offset = abs(offset)
+            seconds -= sign * ((offset // 100) * 3600 + (offset % 100) * 60)
+        return seconds
+    except ValueError:
+        return None
+
+# Core code...
+if __name__ == '__main__':
+    # Self tests.
+    import shutil
+    import tempfile
+    directory = tempfile.mkdtemp()
+    try:
+        sample = os.path.join(directory, "sample.csv")
+        with open(sample, 'wb') as csvfile:
+            writer = csv.writer(csvfile)
+            writer.writerow(COLUMNS)
+            writer.writerow(['500', '', '', '2014-08-27 13:08:45 +0000',
+                '<a href="http://twitter.com">web</a>',
+                'Working on my "exocortex",\nagain. \xe2\x98\x83', '', '', '',
+                ''])
+            writer.writerow(['501', '500', '42', '2014-08-27 14:08:45 -0130',
+                'web', 'Replying about exocortex things', '', '', '',
+                'http://example.com'])
+        archive = TweetArchive(os.path.join(directory, "tweets.sqlite"))
+        assert archive.import_csv(sample)[0] == 2 and len(archive) == 2
+        assert archive.import_csv(sample)[0] == 2 and len(archive) == 2
+        results = archive.search("exocortex")
+        assert [result[0] for result in results] == [501, 500]
+        assert results[0][1] == 1409148525 + 5400
+        assert results[1][2] == u'Working on my "exocortex",\nagain. ☃'
+        assert archive.search("nothing") == []
+        try:
+            archive.import_csv(__file__)
+            assert False
+        except ValueError:
+            pass
+
+        # An import that fails part of the way through keeps the batches
+        # before the failure, and the indexes.
+        broken = os.path.join(directory, "broken.csv")
+        with open(broken, 'wb') as csvfile:
+            writer = csv.writer(csvfile)
+            writer.writerow(COLUMNS)
+            writer.writerow(['600', '', '', '2014-08-28 13:08:45 +0000', 'web',
+                'Before the exocortex broke', '', '', '', ''])
+            writer.writerow(['not a number', '', '', '', '', 'Broken', '', '',
+                '', ''])
+        archive.batch_size = 1
+        try:
+            archive.import_csv(broken)
+            assert False
+        except sqlite3.Error:
+            pass
+        archive.batch_size = TweetArchive.batch_size
+        database = archive._connect()
+        assert database.execute("SELECT name FROM sqlite_master WHERE type = 'index' AND name = 'tweets_timestamp'").fetchone()
+        database.close()
+        assert len(archive) == 3 and archive.search("broke")[0][0] == 600
+
+        # Benchmark: import a big synthetic archive.
+        count = int(sys.argv[2]) if len(sys.argv) > 2 else 500000
+        big = sys.argv[1] if len(sys.argv) > 1 else os.path.join(directory,
+            "big.csv")
+        if len(sys.argv) < 2:
+            with open(big, 'wb') as csvfile:
+                writer = csv.writer(csvfile)
+                writer.writerow(COLUMNS)
+                for i in xrange(count, 0, -1):
+                    writer.writerow([str(10 ** 17 + i), '', '',
+                        time.strftime('%Y-%m-%d %H:%M:%S +0000',
+                        time.gmtime(1200000000 + i * 600)),
+                        '<a href="http://twitter.com" rel="nofollow">Twitter Web Client</a>',
+                        "This is tweet number %d about the exocortex, with a link and some more words to make it a realistic length." % i,
+                        '', '', '', 'http://example.com/%d' % i])
+        archive = TweetArchive(os.path.join(directory, "big.sqlite"),
+            progress_interval=1.0)
+        def progress(rows, read, total):
+            print "  %d rows, %.0f MB of %.0f MB (%.0f%%)" % (rows,
+                read / 1048576.0, total / 1048576.0, 100.0 * read / total)
+        (rows, elapsed) = archive.import_csv(big, progress)
+        megabytes = os.path.getsize(big) / 1048576.0
+        print "Imported %d tweets (%.0f MB) in %.1f seconds: %.0f tweets/s, %.1f MB/s." % (rows, megabytes, elapsed, rows / elapsed, megabytes / elapsed)
+        start = time.time()
+        results = archive.search("number 12345")
+        print "Searched %d tweets in %.1f ms." % (len(archive),
+            (time.time() - start) * 1000)
+        print archive.status_report()
+    finally:
+        shutil.rmtree(directory)
+    sys.exit(0)
+# Fin.
@@ -0,0 +1,431 @@
+#!/usr/bin/env python2
+# -*- coding: utf-8 -*-
+# vim: set expandtab tabstop=4 shiftwidth=4 :
+
+# This is an Exocortex helper class that throws away duplicate tweets from the
+# stream before they're decoded.  When something goes viral the stream is
+# mostly retweets and copy-and-pastes of the same few tweets, and every copy
+# would otherwise be decoded, archived, and sent to the bot's owner.
+# - Tweet IDs (and the IDs of the tweets that retweets are retweets of) go
+#   into a rotating Bloom filter.  A tweet whose ID has been seen, or which
+#   is a retweet of a tweet that's been seen, is a duplicate.
+# - The IDs are pulled out of the raw JSON with regular expressions, because
+#   this runs serially in front of the decode workers and has to cost much
+#   less than decoding does.  Twitter sends created_at, id, and id_str ahead
+#   of everything else, so the ID is almost always found before the first
+#   brace, where it can only be the tweet's own.  Otherwise a slower
+#   expression that steps over strings and nested objects finds it, in
+#   whatever order the keys are in.  A tweet neither can make sense of is
+#   kept.
+# - Optionally (it's off by default, because it needs the text of every
+#   tweet and so costs about as much as decoding it), the text of every
+#   tweet is normalized (lowercased, with URLs, the "RT
+#   @someone:" prefix, and punctuation stripped out) and turned into a
+#   MinHash signature.  The signature is cut into bands, and the bands go
+#   into another rotating Bloom filter (locality sensitive hashing).  A tweet
+#   that shares a band with one that's already been seen is a near
+#   duplicate.  Tweets with only a few words are never near duplicates.
+# - A rotating Bloom filter is two Bloom filters.  New keys go into the
+#   newer one, and when it's full the older one is thrown away and a new one
+#   takes its place.  Keys are checked against both.  That bounds the
+#   memory used, and the bot forgets tweets it hasn't seen in a while
+#   instead of filling up.
+# - The false positive rate (the chance of throwing away a tweet that isn't a
+#   duplicate because of a hash collision) is configurable.  It's split
+#   between the two halves of each filter.
+# - Benchmark it with:
+#   python tweetdedup.py [file of captured stream payloads, one per line]
+
+# TODO:
+# -
+
+# By: The Doctor <drwho at virtadpt dot net>
+#     0x807B17C1 / 7960 1CDC 85C9 0B63 8D9F  DD89 3BD8 FF2B 807B 17C1
+
+# License: GPLv3
+# Pre-requisite modules have their own licenses.
+
+# Load modules.
+import math
+import random
+import re
+import sys
+import time
+from tweetview import TweetView
+
+# The ID at the start of an object, before anything nested in it.  Quotes
+# inside JSON strings are always escaped, so this can't match inside one.
+_FIRST_ID = re.compile(r'\s*\{[^{}]*?"id_str"\s*:\s*"(\d+)"')
+_RETWEETED_STATUS = re.compile(r'"retweeted_status"\s*:\s*')
+
+# Pieces of raw JSON: a string, a run of anything that isn't a string or an
+# object, and an object nested up to _DEPTH deep (tweets don't go deeper than
+# about seven; a tweet that does simply never matches).  The lazy loop over
+# them in _member() tries the key it's looking for before every piece, so it
+# only finds keys of the outermost object.  Strings and objects can only be
+# read one way, so a tweet that doesn't match fails quickly instead of
+# backtracking through every way of cutting it up.
+_STRING = r'"[^"\\]*(?:\\.[^"\\]*)*"'
+_OTHER = r'[^{}"]*'
+_DEPTH = 10
+_OBJECT = r'\{%s(?:%s%s)*\}' % (_OTHER, _STRING, _OTHER)
+for depth in xrange(_DEPTH - 1):
+    _OBJECT = r'\{%s(?:(?:%s|%s)%s)*\}' % (_OTHER, _STRING, _OBJECT, _OTHER)
+
+""" Returns a regular expression that matches from the start of an object up
+to one of its own members. """
+def _member(key):
+    return r'\{%s(?:(?:%s|%s)%s)*?"%s"\s*:\s*' % (_OTHER, _STRING, _OBJECT,
+        _OTHER, key)
+
+# The ID of a raw tweet, and the ID of the tweet it's a retweet of, wherever
+# they are.
+_TWEET_ID = re.compile(r'\s*' + _member('id_str') + r'"(\d+)"')
+_RETWEETED_ID = re.compile(r'\s*' + _member('retweeted_status') +
+    _member('id_str') + r'"(\d+)"')
+
+""" Returns the ID of a raw tweet, or None if it hasn't got one. """
+def _tweet_id(raw):
+    match = _FIRST_ID.match(raw) or _TWEET_ID.match(raw)
+    if match:
+        return match.group(1)
+    return None
+
+""" Returns the ID of the tweet a raw tweet is a retweet of, or None if it
+isn't a retweet.  If the tweet doesn't quote another one and only has one
+retweeted_status, it has to be the tweet's own. """
+def _retweeted_id(raw):
+    if '"retweeted_status"' not in raw:
+        return None
+    match = None
+    if raw.count('"retweeted_status"') == 1 and '"quoted_status"' not in raw:
+        status = _RETWEETED_STATUS.search(raw)
+        if status:
+            match = _FIRST_ID.match(raw, status.end())
+    match = match or _RETWEETED_ID.match(raw)
+    if match:
+        return match.group(1)
+    return None
+
+# Bits of text normalization.
+_URLS = re.compile(r'https?://\S+', re.UNICODE)
+_RETWEET_PREFIX = re.compile(r'^rt @\w+:?', re.UNICODE)
+_WORDS = re.compile(r'\w+', re.UNICODE)
+
+# The MinHash permutations are of the form (a * x + b) mod this prime, which
+# is small enough that the arithmetic never leaves machine integers.
+_PRIME = (1 << 31) - 1
+
+# Classes.
+""" This class is a rotating Bloom filter with room for about 'capacity' keys
+in each half, which together have a false positive rate of about
+'error_rate'. """
+class RotatingBloomFilter(object):
+    # Size of each half in bits, and how many hash functions are used.
+    bits = 0
+    hashes = 0
+
+    # How many keys go into the newer half before the filter rotates.
+    capacity = 0
+
+    def __init__(self, capacity, error_rate):
+        self.capacity = capacity
+        half_rate = error_rate / 2.0
+        self.bits = int(math.ceil(-capacity * math.log(half_rate) /
+            (math.log(2) ** 2)))
+        self.hashes = max(1, int(round(float(self.bits) / capacity *
+            math.log(2))))
+        self.current = bytearray((self.bits + 7) // 8)
+        self.previous = bytearray((self.bits + 7) // 8)
+        self.count = 0
+        self.rotations = 0
+        self._multipliers = range(self.hashes)
+
+    """ Returns the bits that a key maps to, using double hashing on the two
+    halves of the key's hash.  Keys only have to hash the same way for as
+    long as the bot is running, so the built-in hash() will do. """
+    def _positions(self, key):
+        value = hash(key)
+        first = value & 0xffffffff
+        second = ((value >> 32) & 0xffffffff) | 1
+        bits = self.bits
+        return [(first + i * second) % bits for i in self._multipliers]
+
+    def __contains__(self, key):
+        return self._check(self._positions(key))
+
+    def _check(self, positions):
+        for half in (self.current, self.previous):
+            for position in positions:
+                if not half[position >> 3] & (1 << (position & 7)):
+                    break
+            else:
+                return True
+        return False
+
+    """ Add a key.  Returns True if it was (probably) already there. """
+    def add(self, key):
+        positions = self._positions(key)
+        if self._check(positions):
+            return True
+        current = self.current
+        for position in positions:
+            current[position >> 3] |= 1 << (position & 7)
+        self.count += 1
+        if self.count >= self.capacity:
+            self.previous = self.current
+            self.current = bytearray(len(self.previous))
+            self.count = 0
+            self.rotations += 1
+        return False
+
+    """ How much memory the filter's bits take up, in bytes. """
+    def size(self):
+        return len(self.current) + len(self.previous)
+
+""" This class finds near duplicates of texts it's seen recently with
+MinHash and locality sensitive hashing.  Every word trigram of a text is
+hashed once, and the hash is run through bands * rows random permutations;
+the smallest value from each permutation makes up the signature. """
+class NearDuplicateDetector(object):
+    # How many bands the signature is cut into and how many rows each band
+    # has.  Two texts are likely to share a band if the Jaccard similarity
+    # of their trigrams is over about (1 / bands) ** (1 / rows).
+    bands = 5
+    rows = 4
+
+    # Texts with fewer words than this are never near duplicates.
+    min_words = 5
+
+    def __init__(self, capacity, error_rate, bands=None, rows=None):
+        if bands:
+            self.bands = bands
+        if rows:
+            self.rows = rows
+        generator = random.Random(0x807B17C1)
+        self.permutations = [(generator.randint(1, _PRIME - 1),
+            generator.randint(0, _PRIME - 1))
+            for i in xrange(self.bands * self.rows)]
+        self.seen = RotatingBloomFilter(capacity * self.bands, error_rate)
+
+    """ Returns the words of a normalized text. """
+    def normalize(self, text):
+        text = _URLS.sub(' ', text.lower())
+        text = _RETWEET_PREFIX.sub(' ', text.strip())
+        return _WORDS.findall(text)
+
+    """ Returns the MinHash signature of a list of words. """
+    def signature(self, words):
+        hashes = [hash((words[i], words[i + 1], words[i + 2])) & _PRIME
+            for i in xrange(len(words) - 2)]
+        return [min([(a * value + b) % _PRIME for value in hashes])
+            for (a, b) in self.permutations]
+
+    """ Remember a text.  Returns True if a near duplicate of it has (probably)
+    been seen already. """
+    def add(self, text):
+        words = self.normalize(text)
+        if len(words) < self.min_words:
+            return False
+        signature = self.signature(words)
+        rows = self.rows
+        duplicate = False
+        for band in xrange(self.bands):
+            key = (band, ) + tuple(signature[band * rows:(band + 1) * rows])
+            if self.seen.add(key):
+                duplicate = True
+        return duplicate
+
+""" This class is the dedup stage of the tweet pipeline.  It's called with
+every raw tweet from the stream and returns False for the ones that should
+be thrown away.  Near duplicates are only looked for if 'near_duplicates'
+is True; 'bands' and 'rows' tune how alike two texts have to be. """
+class TweetDeduplicator(object):
+    # Counters.
+    checked = 0
+    duplicates = 0
+    retweets = 0
+    near_duplicates = 0
+    bytes_skipped = 0
+    check_time = 0.0
+
+    # Finds near duplicates, if that's turned on.
+    texts = None
+
+    def __init__(self, capacity=100000, error_rate=0.001,
+        near_duplicates=False, bands=None, rows=None):
+        self.ids = RotatingBloomFilter(capacity, error_rate)
+        self.texts = None
+        if near_duplicates:
+            self.texts = NearDuplicateDetector(capacity, error_rate, bands,
+                rows)
+        self.checked = 0
+        self.duplicates = 0
+        self.retweets = 0
+        self.near_duplicates = 0
+        self.bytes_skipped = 0
+        self.check_time = 0.0
+
+    """ Returns True if a raw tweet should be kept and False if it's a
+    duplicate. """
+    def __call__(self, raw):
+        start = time.time()
+        try:
+            self.checked += 1
+            id_str = _tweet_id(raw)
+            if id_str is None:
+                # Not a tweet (e.g., a deletion notice), or not one that can
+                # be made sense of without decoding it.  Let the pipeline
+                # deal with it.
+                return True
+
+            if self.ids.add(id_str):
+                self.duplicates += 1
+                self.bytes_skipped += len(raw)
+                return False
+
+            retweeted = _retweeted_id(raw)
+            if retweeted is not None and self.ids.add(retweeted):
+                self.retweets += 1
+                self.bytes_skipped += len(raw)
+                return False
+
+            if self.texts is None:
+                return True
+            try:
+                text = TweetView(raw).text
+            except ValueError:
+                return True
+            if text and self.texts.add(text):
+                self.near_duplicates += 1
+                self.bytes_skipped += len(raw)
+                return False
+            return True
+        finally:
+            self.check_time += time.time() - start
+
+    """ Return a dict of the deduplicator's counters. """
+    def statistics(self):
+        skipped = self.duplicates + self.retweets + self.near_duplicates
+        return {'checked': self.checked, 'skipped': skipped,
+            'percent': 100.0 * skipped / self.checked if self.checked else 0.0,
+            'duplicates': self.duplicates, 'retweets': self.retweets,
+            'near_duplicates': self.near_duplicates,
+            'megabytes': self.bytes_skipped / 1048576.0,
+            'check_time': 1000000.0 * self.check_time / self.checked
+                if self.checked else 0.0,
+            'memory': (self.ids.size() +
+                (self.texts.seen.size() if self.texts else 0)) / 1024}
+
+    """ Return the deduplicator's counters as something that can be sent to
+    the user. """
+    def status_report(self):
+        stats = self.statistics()
+        report = "%(skipped)d of %(checked)d tweets from the stream (%(percent).1f%%) were thrown away as duplicates before being decoded: %(duplicates)d repeats and %(retweets)d retweets of tweets already seen" % stats
+        if self.texts is None:
+            report = report + ".  Near duplicates aren't being looked for.\n"
+        else:
+            report = report + ", and %(near_duplicates)d near duplicates.\n" % stats
+        report = report + "That's %(megabytes).1f MB of JSON that didn't have to be decoded, archived, or sent.  Checking took %(check_time).0f us per tweet, and the filters use %(memory)d KB of memory." % stats
+        return report
+
+# Core code...
+if __name__ == '__main__':
+    # Self tests.
+    bloom = RotatingBloomFilter(1000, 0.01)
+    assert not bloom.add("foo") and bloom.add("foo") and "foo" in bloom
+    for i in range(1100):
+        bloom.add("key%d" % i)
+    assert "foo" in bloom and bloom.rotations == 1
+    for i in range(1100):
+        bloom.add("other%d" % i)
+    assert "foo" not in bloom and bloom.rotations == 2
+    false_positives = len([i for i in range(100000) if "missing%d" % i in
+        bloom])
+    print "Bloom filter false positive rate: %.3f%% (asked for 1%%)." % (
+        false_positives / 1000.0)
+
+    detector = NearDuplicateDetector(1000, 0.001)
+    assert not detector.add("The quick brown fox jumps over the lazy dog")
+    assert detector.add("RT @someone: The quick brown fox jumps over the lazy dog! http://t.co/x")
+    assert not detector.add("Something else entirely, about another subject")
+    assert not detector.add("Good morning")
+    assert not detector.add("Good morning")
+
+    # The IDs are found whatever order the keys are in, and IDs in nested
+    # objects or inside strings are never mistaken for the tweet's own.
+    import collections
+    import json
+    from tweetpipeline import load_payloads
+    from tweetrecord import record_tweet
+    originals = load_payloads(sys.argv[1] if len(sys.argv) > 1 else None)
+    tweet = json.loads(originals[0])
+    user = json.dumps(tweet['user'])
+    tweet['text'] = '} "id_str": "1" {"id_str": "2", \\"id_str\\": "3"'
+    text = json.dumps(tweet['text'])
+    assert _tweet_id('{"id_str": "41", "user": %s}' % user) == "41"
+    assert _tweet_id('{"user": %s, "text": %s, "id_str": "42"}' % (user,
+        text)) == "42"
+    assert _tweet_id('{"delete": {"status": {"id_str": "5"}}}') is None
+    for first in (True, False):
+        status = '{"id_str": "%s", "user": %s, "text": %s}' % (
+            tweet['id_str'], user, text)
+        if not first:
+            status = '{"user": %s, "text": %s, "id_str": "%s"}' % (user, text,
+                tweet['id_str'])
+        raw = '{"user": %s, "retweeted_status": %s, "id_str": "43"}' % (user,
+            status)
+        assert _tweet_id(raw) == "43"
+        assert _retweeted_id(raw) == tweet['id_str']
+        raw = '{"id_str": "44", "quoted_status": %s}' % raw
+        assert _retweeted_id(raw) is None
+    assert _retweeted_id(originals[0]) is None
+
+    # Replay a stream in which every tweet shows up again as a retweet and
+    # a copy-and-paste with a different link, with the keys in the order
+    # Twitter sends them.
+    payloads = []
+    for (i, payload) in enumerate(originals):
+        tweet = json.loads(payload, object_pairs_hook=collections.OrderedDict)
+        tweet['text'] = "Something different about item %d, %s" % (i,
+            " ".join("word%d" % (i * 8 + j) for j in range(8)))
+        payloads.append(json.dumps(tweet))
+        if i % 2:
+            retweet = collections.OrderedDict(tweet)
+            retweet['id_str'] = str(int(tweet['id_str']) + 10 ** 12)
+            retweet['text'] = "RT @someone: " + tweet['text']
+            retweet['retweeted_status'] = tweet
+            payloads.append(json.dumps(retweet))
+            copy = collections.OrderedDict(tweet)
+            copy['id_str'] = str(int(tweet['id_str']) + 2 * 10 ** 12)
+            copy['text'] = tweet['text'] + " http://t.co/other"
+            payloads.append(json.dumps(copy))
+
+    start = time.time()
+    for payload in payloads:
+        record_tweet(payload)
+    decode_time = time.time() - start
+    print "Decoding every tweet: %.2f s." % decode_time
+
+    # Only retweets are caught unless near duplicates are looked for.
+    copies = len(originals) // 2
+    for near_duplicates in (False, True):
+        expected = len(originals) + (0 if near_duplicates else copies)
+        dedup = TweetDeduplicator(len(payloads), near_duplicates=near_duplicates)
+        start = time.time()
+        kept = [payload for payload in payloads if dedup(payload)]
+        dedup_time = time.time() - start
+        assert len(kept) >= expected * 0.99 and len(kept) <= expected
+        assert dedup.retweets >= copies * 0.99
+        print dedup.status_report()
+        print "Dedup, then decoding the rest: %.2f s." % (dedup_time +
+            decode_time * len(kept) / len(payloads))
+
+    # How many tweets that are all different (but come from the same
+    # template) look like near duplicates.
+    dedup = TweetDeduplicator(len(originals), near_duplicates=True)
+    kept = [payload for payload in originals if dedup(payload)]
+    print "%d of %d different tweets were taken for near duplicates." % (
+        len(originals) - len(kept), len(originals))
+    sys.exit(0)
+# Fin.
@@ -0,0 +1,245 @@
+#!/usr/bin/env python2
+# -*- coding: utf-8 -*-
+# vim: set expandtab tabstop=4 shiftwidth=4 :
+
+# This is an Exocortex helper class that turns the tweets matching the terms
+# the bot is monitoring Twitter for into periodic digests.  Instead of
+# sending every tweet to the bot's owner as it arrives, the bot sends one
+# summary per search term per interval.
+# - Every term gets a sliding window counter (a ring of buckets that covers
+#   one interval), and the top few matches by retweet count and by time.
+#   That's a fixed amount of memory per term no matter how many tweets match
+#   it.
+# - A tweet counts toward every term it's been tagged with by the term
+#   router.  Tweets that haven't been tagged count toward every term that
+#   appears in their text.
+# - Terms that are no longer being monitored are forgotten the next time
+#   digests are sent.
+
+# TODO:
+# -
+
+# By: The Doctor <drwho at virtadpt dot net>
+#     0x807B17C1 / 7960 1CDC 85C9 0B63 8D9F  DD89 3BD8 FF2B 807B 17C1
+
+# License: GPLv3
+# Pre-requisite modules have their own licenses.
+
+# Load modules.
+from collections import deque
+import heapq
+import sys
+import threading
+import time
+
+# Classes.
+""" This class holds the running totals and top matches of a single search
+term. """
+class TermDigest(object):
+    __slots__ = ('buckets', 'bucket_width', 'current', 'current_start',
+        'since_digest', 'total', 'top', 'recent', 'size')
+
+    def __init__(self, interval, buckets, size, now):
+        self.buckets = [0] * buckets
+        self.bucket_width = float(interval) / buckets
+        self.current = 0
+        self.current_start = now
+        self.since_digest = 0
+        self.total = 0
+
+        # Min-heap of (retweet count, id_str, tweet), and the most recent
+        # tweets.
+        self.top = []
+        self.recent = deque(maxlen=size)
+        self.size = size
+
+    """ Move the window forward to the present, zeroing the buckets it moves
+    past. """
+    def _advance(self, now):
+        steps = int((now - self.current_start) / self.bucket_width)
+        if steps <= 0:
+            return
+        for i in xrange(min(steps, len(self.buckets))):
+            self.current = (self.current + 1) % len(self.buckets)
+            self.buckets[self.current] = 0
+        self.current_start += steps * self.bucket_width
+
+    """ Count a matching tweet. """
+    def add(self, tweet, now):
+        self._advance(now)
+        self.buckets[self.current] += 1
+        self.since_digest += 1
+        self.total += 1
+        self.recent.append(tweet)
+        entry = (tweet.retweet_count or 0, tweet.id_str, tweet)
+        if len(self.top) < self.size:
+            heapq.heappush(self.top, entry)
+        elif entry[:2] > self.top[0][:2]:
+            heapq.heapreplace(self.top, entry)
+
+    """ How many matching tweets there have been in the last interval. """
+    def window_count(self, now):
+        self._advance(now)
+        return sum(self.buckets)
+
+    """ Start the top matches over for the next digest. """
+    def reset(self):
+        self.since_digest = 0
+        self.top = []
+        self.recent.clear()
+
+""" This class keeps a TermDigest for every monitored search term, and sends
+their summaries out every interval from a thread of its own. """
+class TweetDigest(object):
+    # How often (in seconds) digests are sent, how many buckets the sliding
+    # window is divided into, and how many of the top matches go into each
+    # digest.
+    interval = 300
+    buckets = 60
+    size = 5
+
+    # Function that returns the list of terms being monitored, and function
+    # that's called with every term and its summary.
+    terms = None
+    report = None
+
+    # Term -> TermDigest.
+    digests = {}
+
+    def __init__(self, terms, report, interval=None, buckets=None,
+        size=None):
+        self.terms = terms
+        self.report = report
+        if interval:
+            self.interval = interval
+        if buckets:
+            self.buckets = buckets
+        if size:
+            self.size = size
+        self.digests = {}
+        self.lock = threading.Lock()
+        self.wakeup = threading.Event()
+        self.stopping = False
+
+        self.timer = threading.Thread(target=self._run, name="TweetDigest")
+        self.timer.daemon = True
+        self.timer.start()
+
+    """ Count a TweetRecord toward every term it matched. """
+    def add(self, tweet):
+        if tweet.text is None:
+            return
+        terms = tweet.terms
+        if terms is None:
+            text = tweet.text.lower()
+            terms = [term for term in self.terms() if term.lower() in text]
+        now = time.time()
+        with self.lock:
+            for term in terms:
+                digest = self.digests.get(term)
+                if digest is None:
+                    digest = self.digests[term] = TermDigest(self.interval,
+                        self.buckets, self.size, now)
+                digest.add(tweet, now)
+
+    """ Change how often digests are sent.  The sliding windows start over. """
+    def set_interval(self, interval):
+        with self.lock:
+            self.interval = interval
+            self.digests = {}
+        self.wakeup.set()
+
+    """ Forget everything. """
+    def clear(self):
+        with self.lock:
+            self.digests = {}
+
+    """ Build the summaries of every term that's had matches since the last
+    digest, and start them over.  Returns a list of (term, summary). """
+    def summarize(self):
+        now = time.time()
+        summaries = []
+        with self.lock:
+            terms = set(self.terms())
+            for term in self.digests.keys():
+                if term not in terms:
+                    del self.digests[term]
+            for (term, digest) in sorted(self.digests.iteritems()):
+                if not digest.since_digest:
+                    continue
+                summaries.append((term, self._summary(term, digest, now)))
+                digest.reset()
+        return summaries
+
+    """ Turn a term's digest into something that can be sent to the user. """
+    def _summary(self, term, digest, now):
+        count = digest.window_count(now)
+        summary = "Digest for '%s': %d matching tweets in the last %d seconds (%.2f per second), %d since the last digest, %d in total.\n" % (term, count, self.interval, float(count) / self.interval, digest.since_digest, digest.total)
+        summary = summary + "Most retweeted:\n"
+        for (retweets, id_str, tweet) in sorted(digest.top, reverse=True):
+            summary = summary + "@%s (retweeted %d times): %s\n" % (
+                tweet.screen_name, retweets, tweet.text)
+        summary = summary + "Most recent:\n"
+        for tweet in reversed(digest.recent):
+            summary = summary + "@%s (%s): %s\n" % (tweet.screen_name,
+                tweet.created_at_string(), tweet.text)
+        return summary
+
+    """ This is a helper method which runs in a separate thread.  It sends the
+    digests every interval. """
+    def _run(self):
+        while not self.stopping:
+            self.wakeup.wait(self.interval)
+            if self.wakeup.is_set():
+                # The interval changed, so start it over.
+                self.wakeup.clear()
+                continue
+            for (term, summary) in self.summarize():
+                try:
+                    self.report(term, summary)
+                except Exception as error:
+                    print "ERROR: Unable to send the digest for %s: %s" % (
+                        term, error)
+
+    """ Stop the digest thread. """
+    def stop(self):
+        self.stopping = True
+        self.wakeup.set()
+
+# Core code...
+if __name__ == '__main__':
+    # Self tests.
+    from tweetrecord import TweetRecord
+
+    reports = []
+    digest = TweetDigest(lambda: ["foo", "Bar"],
+        lambda term, summary: reports.append((term, summary)), interval=60,
+        buckets=10, size=3)
+    for i in range(100000):
+        digest.add(TweetRecord(str(i), 1409144925 + i,
+            "Tweet number %d about foo%s" % (i, " and #bar" if i % 2 else ""),
+            retweet_count=i % 1000, screen_name="user%d" % (i % 10)))
+    assert len(digest.digests["foo"].top) == 3
+    assert len(digest.digests["foo"].recent) == 3
+    summaries = digest.summarize()
+    assert [term for (term, summary) in summaries] == ["Bar", "foo"]
+    summary = dict(summaries)["foo"]
+    assert "100000 since the last digest" in summary
+    assert "(retweeted 999 times): Tweet number 99999 about foo" in summary
+    assert summary.index("number 99999") < summary.index("number 99998")
+    assert "50000 since the last digest" in dict(summaries)["Bar"]
+    print summary
+
+    # Nothing is sent for terms that haven't had any matches since the last
+    # digest.
+    assert not digest.summarize()
+
+    # Digests go out every interval.
+    digest.set_interval(0.5)
+    digest.add(TweetRecord("1", 1409144925, "More", screen_name="user",
+        terms=("foo", )))
+    time.sleep(1.2)
+    assert [term for (term, summary) in reports] == ["foo"]
+    digest.stop()
+    sys.exit(0)
+# Fin.
@@ -0,0 +1,626 @@
+#!/usr/bin/env python2
+# -*- coding: utf-8 -*-
+# vim: set expandtab tabstop=4 shiftwidth=4 :
+
+# This is an Exocortex helper class that implements a full-text index of the
+# tweets the bot has seen, so they can be searched later without asking
+# Twitter for them again.
+# - New tweets are indexed in memory.  Every so often the in-memory index is
+#   written to disk as a segment file, and segments are never changed after
+#   that.
+# - Segment files are mmap()'d, not loaded.  A search only reads the
+#   postings of the terms it's looking for and the stored fields of the
+#   tweets it returns, so the index can be much bigger than RAM.
+# - When there are too many segments, a background thread merges the
+#   smallest ones into a single bigger one, streaming them from disk.
+# - Searches are ranked with Okapi BM25.
+# - Segment files are little-endian, and laid out as:
+#   header: magic, # of docs, # of terms, total doc length, then the offsets
+#       of the doc table, lengths, IDs, term table and sources.
+#   stored fields: marshal dumps of (id_str, created_at, screen_name, text)
+#   postings: for each term, its UTF-8 bytes followed by uint32 pairs of
+#       (doc number, term frequency).
+#   doc table: uint64 offset of each doc's stored fields, plus one for the
+#       end of the last one.
+#   lengths: uint32 number of terms in each doc.
+#   IDs: sorted uint64 tweet IDs, so that duplicates can be found with a
+#       binary search instead of keeping every ID in memory.
+#   term table: sorted (term offset, term length, postings offset, # of
+#       postings) records.
+#   sources: marshal dump of the filenames of the segments that were merged
+#       into it.  If the bot goes down in the middle of a merge, they're
+#       cleaned up the next time the index is opened.
+# - Segments written by older versions, which were marshal dumps that had to
+#   be loaded whole, are rewritten in this format when the index is opened.
+
+# TODO:
+# - Delete tweets from the index.
+
+# By: The Doctor <drwho at virtadpt dot net>
+#     0x807B17C1 / 7960 1CDC 85C9 0B63 8D9F  DD89 3BD8 FF2B 807B 17C1
+
+# License: GPLv3
+# Pre-requisite modules have their own licenses.
+
+# Load modules.
+import array
+import bisect
+import glob
+import heapq
+import itertools
+import marshal
+import math
+import mmap
+import os
+import re
+import struct
+import sys
+import threading
+import time
+
+# Splits text into search terms.
+_TERMS = re.compile(r'\w+', re.UNICODE)
+
+# Segment file header.
+_MAGIC = "TWEETIX2"
+_HEADER = struct.Struct("<8sIIQQQQQQ")
+
+# How many numbers or strings to write at a time to a segment file.
+_CHUNK = 4096
+
+# Doc lengths in a segment file.
+_LENGTH = struct.Struct("<I")
+
+# Postings are kept in arrays of uint32, which have to be byte swapped on
+# big-endian machines.
+_SWAP = sys.byteorder != "little"
+
+# Classes.
+""" This class is a read-only array of fixed-size records in a segment file,
+so that it can be indexed and binary searched without loading it. """
+class _Table(object):
+    def __init__(self, data, offset, count, record):
+        self.data = data
+        self.offset = offset
+        self.count = count
+        self.record = struct.Struct(record)
+        self.single = len(record.lstrip("<")) == 1
+
+    def __len__(self):
+        return self.count
+
+    def __getitem__(self, index):
+        if index < 0:
+            index += self.count
+        if not 0 <= index < self.count:
+            raise IndexError(index)
+        record = self.record.unpack_from(self.data, self.offset +
+            index * self.record.size)
+        return record[0] if self.single else record
+
+""" This class is the segment that's still being built in memory.  It's added
+to until it's written out, and then it's replaced by a SegmentFile. """
+class Segment(object):
+    # Stored fields of every tweet in the segment, and how many terms each
+    # one has.
+    docs = []
+    lengths = []
+
+    # Term -> flat array of doc numbers and term frequencies.
+    postings = {}
+
+    # IDs of the tweets in the segment.
+    ids = set()
+
+    def __init__(self):
+        self.docs = []
+        self.lengths = []
+        self.postings = {}
+        self.ids = set()
+        self.total_length = 0
+
+    """ Add a tweet to the segment. """
+    def add(self, id_str, created_at, screen_name, text):
+        docnum = len(self.docs)
+        frequencies = {}
+        for term in tokenize(text):
+            frequencies[term] = frequencies.get(term, 0) + 1
+        for (term, frequency) in frequencies.iteritems():
+            postings = self.postings.get(term)
+            if postings is None:
+                postings = self.postings[term] = array.array('I')
+            postings.append(docnum)
+            postings.append(frequency)
+        length = sum(frequencies.itervalues())
+        self.docs.append((id_str, created_at, screen_name, text))
+        self.lengths.append(length)
+        self.ids.add(id_str)
+        self.total_length += length
+
+    def __len__(self):
+        return len(self.docs)
+
+    def __contains__(self, id_str):
+        return id_str in self.ids
+
+    """ Returns the flat array of doc numbers and frequencies of a term. """
+    def lookup(self, term):
+        return self.postings.get(term, ())
+
+    def length(self, docnum):
+        return self.lengths[docnum]
+
+    def doc(self, docnum):
+        return self.docs[docnum]
+
+    """ Write the segment to disk. """
+    def write(self, filename, sources=None):
+        _write_segment(filename, (marshal.dumps(doc) for doc in self.docs),
+            self.lengths, sorted(int(id_str) for id_str in self.ids),
+            sorted((_key(term), postings) for (term, postings) in
+                self.postings.iteritems()), sources or [])
+
+""" This class is a segment that's been written to disk.  The file is
+mmap()'d, and the postings and stored fields are only read when a search
+needs them. """
+class SegmentFile(object):
+    # Filename of the segment, and the filenames of the segments that were
+    # merged to make it.
+    filename = None
+    sources = []
+
+    # How many tweets are in the segment, and how many terms they have
+    # between them.
+    count = 0
+    total_length = 0
+
+    def __init__(self, filename):
+        infile = open(filename, 'rb')
+        try:
+            self.data = mmap.mmap(infile.fileno(), 0, access=mmap.ACCESS_READ)
+        finally:
+            infile.close()
+        (magic, self.count, terms, self.total_length, docs, lengths, ids,
+            entries, sources) = _HEADER.unpack_from(self.data, 0)
+        if magic != _MAGIC:
+            raise IOError("%s is not a tweet index segment." % filename)
+        self.offsets = _Table(self.data, docs, self.count + 1, "<Q")
+        self.lengths = _Table(self.data, lengths, self.count, "<I")
+        self.ids = _Table(self.data, ids, self.count, "<Q")
+        self.terms = _Table(self.data, entries, terms, "<QIQI")
+        self.sources = marshal.loads(self.data[sources:])
+        self.filename = filename
+        self.last = self.ids[-1] if self.count else -1
+
+    def __len__(self):
+        return self.count
+
+    """ Looks a tweet ID up in the segment.  Tweet IDs mostly go up over
+    time, so new tweets are usually past the end and don't need a search. """
+    def __contains__(self, id_str):
+        id_number = int(id_str)
+        if id_number > self.last:
+            return False
+        index = bisect.bisect_left(self.ids, id_number)
+        return index < self.count and self.ids[index] == id_number
+
+    """ Returns the flat array of doc numbers and frequencies of a term,
+    using a binary search of the term table. """
+    def lookup(self, term):
+        term = _key(term)
+        (data, entries) = (self.data, self.terms)
+        (low, high) = (0, len(entries))
+        while low < high:
+            middle = (low + high) // 2
+            (start, size, offset, count) = entries.record.unpack_from(data,
+                entries.offset + middle * entries.record.size)
+            found = data[start:start + size]
+            if found < term:
+                low = middle + 1
+            elif found > term:
+                high = middle
+            else:
+                return _read_postings(self.data, offset, count)
+        return ()
+
+    def length(self, docnum):
+        return _LENGTH.unpack_from(self.data, self.lengths.offset +
+            docnum * _LENGTH.size)[0]
+
+    def doc(self, docnum):
+        return marshal.loads(self.data[self.offsets[docnum]:
+            self.offsets[docnum + 1]])
+
+    """ Helper methods for merging: the raw stored fields of each tweet, and
+    every term with its postings, in order. """
+    def raw_docs(self):
+        for docnum in xrange(self.count):
+            yield self.data[self.offsets[docnum]:self.offsets[docnum + 1]]
+
+    def postings(self):
+        for (start, size, offset, count) in self.terms:
+            yield (self.data[start:start + size],
+                _read_postings(self.data, offset, count))
+
+""" This class is the index itself: a directory of segment files, plus the
+segment that's still being built in memory. """
+class TweetIndex(object):
+    # BM25 parameters.
+    k1 = 1.2
+    b = 0.75
+
+    # Directory that the segment files live in.
+    directory = ""
+
+    # How many tweets go into a segment before it's written to disk, and how
+    # many segments there can be before the smallest ones are merged.
+    flush_size = 1000
+    merge_factor = 8
+
+    # Segments on disk, and the one still being built.
+    segments = []
+    pending = None
+
+    # Set while a merge thread is running.
+    merging = False
+
+    """ Open the index in a directory, creating the directory if it doesn't
+    exist yet. """
+    def __init__(self, directory, flush_size=None, merge_factor=None):
+        self.directory = directory
+        if flush_size:
+            self.flush_size = flush_size
+        if merge_factor:
+            self.merge_factor = merge_factor
+        self.lock = threading.RLock()
+        self.merging = False
+        self.merger = None
+        self.pending = Segment()
+
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+        # Open the segments, throwing away any that were left behind by a
+        # merge that didn't get to clean up after itself.
+        segments = []
+        for filename in sorted(glob.glob(os.path.join(directory, "*.seg"))):
+            _upgrade(filename)
+            segments.append(SegmentFile(filename))
+        merged = set()
+        for segment in segments:
+            merged.update(segment.sources)
+        self.segments = []
+        for segment in segments:
+            if os.path.basename(segment.filename) in merged:
+                os.remove(segment.filename)
+                continue
+            self.segments.append(segment)
+        self.next_segment = len(segments) and \
+            int(os.path.basename(segments[-1].filename).split('.')[0]) + 1
+
+    """ Add a TweetRecord to the index.  Returns False if it was already
+    there. """
+    def add(self, record):
+        if record.text is None:
+            return False
+        with self.lock:
+            if record.id_str in self.pending or any(record.id_str in segment
+                    for segment in self.segments):
+                return False
+            self.pending.add(record.id_str, record.created_at,
+                record.screen_name, record.text)
+            if len(self.pending) >= self.flush_size:
+                self.flush()
+        return True
+
+    """ Add a bunch of TweetRecords to the index.  Returns how many of them
+    were new. """
+    def add_all(self, records):
+        return len([record for record in records if self.add(record)])
+
+    """ Write the in-memory segment to disk, and start merging segments if
+    there are too many of them. """
+    def flush(self):
+        with self.lock:
+            if not len(self.pending):
+                return
+            filename = os.path.join(self.directory, "%08d.seg" %
+                self.next_segment)
+            self.next_segment += 1
+            self.pending.write(filename)
+            self.segments.append(SegmentFile(filename))
+            self.pending = Segment()
+
+            if len(self.segments) >= self.merge_factor and not self.merging:
+                self.merging = True
+                self.merger = threading.Thread(target=self._merge,
+                    name="TweetIndexMerger")
+                self.merger.daemon = True
+                self.merger.start()
+
+    """ This is a helper method which runs in a separate thread.  It merges
+    the smallest half of the segments into one new segment, then swaps it in
+    for them.  The segments are streamed from disk, so only the new doc and
+    term tables are held in memory while it runs. """
+    def _merge(self):
+        try:
+            with self.lock:
+                victims = sorted(self.segments, key=len)[:max(2,
+                    len(self.segments) // 2)]
+                filename = os.path.join(self.directory, "%08d.seg" %
+                    self.next_segment)
+                self.next_segment += 1
+
+            offsets = [0]
+            for segment in victims:
+                offsets.append(offsets[-1] + len(segment))
+            terms = heapq.merge(*[_renumber(segment.postings(), offset)
+                for (segment, offset) in zip(victims, offsets)])
+            _write_segment(filename,
+                itertools.chain(*[segment.raw_docs() for segment in victims]),
+                itertools.chain(*[segment.lengths for segment in victims]),
+                heapq.merge(*[segment.ids for segment in victims]),
+                ((term, sum((postings for (_, postings) in group),
+                    array.array('I'))) for (term, group) in
+                    itertools.groupby(terms, key=lambda item: item[0])),
+                [os.path.basename(segment.filename) for segment in victims])
+            merged = SegmentFile(filename)
+
+            with self.lock:
+                self.segments = [segment for segment in self.segments
+                    if segment not in victims] + [merged]
+            for segment in victims:
+                os.remove(segment.filename)
+        except (IOError, OSError) as error:
+            print "ERROR: Unable to merge tweet index segments: %s" % error
+        finally:
+            self.merging = False
+
+    """ Search the index.  Returns a list of up to 'limit' tuples of (score,
+    id_str, created_at, screen_name, text), best match first. """
+    def search(self, query, limit=10):
+        terms = set(tokenize(query))
+        with self.lock:
+            segments = self.segments + [self.pending]
+        if not terms:
+            return []
+
+        # Collection-wide statistics.  The postings of each term are only
+        # read once, and used again for scoring.
+        total_docs = sum(len(segment) for segment in segments)
+        if not total_docs:
+            return []
+        average_length = float(sum(segment.total_length
+            for segment in segments)) / total_docs
+        postings = [dict((term, segment.lookup(term)) for term in terms)
+            for segment in segments]
+        idf = {}
+        for term in terms:
+            frequency = sum(len(found[term]) // 2 for found in postings)
+            idf[term] = math.log(1.0 + (total_docs - frequency + 0.5) /
+                (frequency + 0.5))
+
+        # Score every tweet that has at least one of the terms.
+        k1 = self.k1
+        b = self.b
+        results = []
+        for (segment, found) in zip(segments, postings):
+            scores = {}
+            length = segment.length
+            for term in terms:
+                numbers = found[term]
+                weight = idf[term]
+                for i in xrange(0, len(numbers), 2):
+                    docnum = numbers[i]
+                    frequency = numbers[i + 1]
+                    norm = k1 * (1.0 - b + b * length(docnum) /
+                        average_length)
+                    scores[docnum] = scores.get(docnum, 0.0) + weight * \
+                        frequency * (k1 + 1.0) / (frequency + norm)
+            for (docnum, score) in heapq.nlargest(limit, scores.iteritems(),
+                key=lambda item: item[1]):
+                results.append((score, segment, docnum))
+
+        # Only the tweets that made the cut get read.
+        return [(score, ) + tuple(segment.doc(docnum)) for (score, segment,
+            docnum) in heapq.nlargest(limit, results,
+            key=lambda result: result[0])]
+
+    """ Returns how many tweets are in the index. """
+    def __len__(self):
+        with self.lock:
+            return sum(len(segment) for segment in self.segments) + \
+                len(self.pending)
+
+    """ Write out anything that's still in memory and wait for any merge
+    that's running to finish. """
+    def close(self):
+        with self.lock:
+            merger = self.merger
+        if merger:
+            merger.join()
+        self.flush()
+        with self.lock:
+            merger = self.merger
+        if merger:
+            merger.join()
+
+""" Split a string into lowercase search terms. """
+def tokenize(text):
+    return _TERMS.findall(text.lower())
+
+""" Segment files used to be marshal dumps of dicts of the docs, lengths,
+postings and sources, which had to be loaded into memory.  Rewrite one of
+those in the current format. """
+def _upgrade(filename):
+    infile = open(filename, 'rb')
+    try:
+        if infile.read(len(_MAGIC)) == _MAGIC:
+            return
+        infile.seek(0)
+        old = marshal.load(infile)
+    finally:
+        infile.close()
+    segment = Segment()
+    for doc in old['docs']:
+        segment.add(*doc)
+    segment.write(filename, old.get('sources'))
+
+""" Terms are kept in segment files as UTF-8, and sorted that way. """
+def _key(term):
+    if isinstance(term, unicode):
+        return term.encode("utf-8")
+    return term
+
+""" Add an offset to the doc numbers in a stream of (term, postings). """
+def _renumber(postings, offset):
+    for (term, numbers) in postings:
+        numbers[0::2] = array.array('I', [docnum + offset
+            for docnum in numbers[0::2]])
+        yield (term, numbers)
+
+""" Read the postings of a term from a segment file. """
+def _read_postings(data, offset, count):
+    numbers = array.array('I', data[offset:offset + count * 8])
+    if _SWAP:
+        numbers.byteswap()
+    return numbers
+
+""" Pack the numbers from an iterable into a file a chunk at a time.  Returns
+how many there were and what they added up to. """
+def _pack(outfile, code, numbers):
+    (count, total) = (0, 0)
+    numbers = iter(numbers)
+    while True:
+        chunk = list(itertools.islice(numbers, _CHUNK))
+        if not chunk:
+            return (count, total)
+        outfile.write(struct.pack("<%d%s" % (len(chunk), code), *chunk))
+        count += len(chunk)
+        total += sum(chunk)
+
+""" Write a segment file from streams of raw stored fields, lengths, sorted
+IDs and sorted (term, postings).  It goes into a temporary file first, so
+there's never half of a segment lying around. """
+def _write_segment(filename, docs, lengths, ids, terms, sources):
+    temporary = filename + ".tmp"
+    outfile = open(temporary, 'wb')
+    try:
+        outfile.write("\0" * _HEADER.size)
+        position = _HEADER.size
+        offsets = []
+        pieces = []
+        for doc in docs:
+            offsets.append(position)
+            pieces.append(doc)
+            position += len(doc)
+            if len(pieces) >= _CHUNK:
+                outfile.write("".join(pieces))
+                pieces = []
+        offsets.append(position)
+
+        entries = []
+        for (term, postings) in terms:
+            pieces.append(term)
+            if _SWAP:
+                postings = array.array('I', postings)
+                postings.byteswap()
+            pieces.append(postings.tostring())
+            entries.append((position, len(term), position + len(term),
+                len(postings) // 2))
+            position += len(term) + len(postings) * 4
+            if len(pieces) >= _CHUNK:
+                outfile.write("".join(pieces))
+                pieces = []
+        outfile.write("".join(pieces))
+
+        docs_offset = outfile.tell()
+        _pack(outfile, "Q", offsets)
+        lengths_offset = outfile.tell()
+        (count, total_length) = _pack(outfile, "I", lengths)
+        ids_offset = outfile.tell()
+        _pack(outfile, "Q", ids)
+        entries_offset = outfile.tell()
+        outfile.write("".join(struct.pack("<QIQI", *entry)
+            for entry in entries))
+        sources_offset = outfile.tell()
+        marshal.dump(sources, outfile)
+
+        outfile.seek(0)
+        outfile.write(_HEADER.pack(_MAGIC, count, len(entries), total_length,
+            docs_offset, lengths_offset, ids_offset, entries_offset,
+            sources_offset))
+        outfile.flush()
+        os.fsync(outfile.fileno())
+    finally:
+        outfile.close()
+    os.rename(temporary, filename)
+
+# Core code...
+if __name__ == '__main__':
+    # Self tests and a quick benchmark.
+    import random
+    import shutil
+    import tempfile
+    from tweetrecord import TweetRecord
+
+    directory = tempfile.mkdtemp()
+    try:
+        index = TweetIndex(directory, flush_size=500, merge_factor=4)
+        random.seed(0)
+        vocabulary = ["word%d" % i for i in range(5000)]
+        start = time.time()
+        for i in range(20000):
+            text = " ".join(random.choice(vocabulary) for j in range(12))
+            if i == 12345:
+                text = "The quick brown fox jumps over the lazy dog #exocortex"
+            index.add(TweetRecord(str(i), 1409144925 + i, text,
+                screen_name="user%d" % (i % 100)))
+        assert not index.add(TweetRecord("12345", 0, "duplicate"))
+        index.close()
+        print "Indexed %d tweets into %d segments in %.2f seconds." % (
+            len(index), len(index.segments), time.time() - start)
+
+        # Pretend that the bot went down before a merge could clean up.
+        merged = [segment for segment in index.segments if segment.sources][0]
+        leftover = os.path.join(directory, merged.sources[0])
+        segment = Segment()
+        segment.add(*merged.doc(0))
+        segment.write(leftover)
+
+        # Segments in the old format get upgraded.
+        outfile = open(os.path.join(directory, "%08d.seg" %
+            index.next_segment), 'wb')
+        marshal.dump({'docs': [("123456789", 0, "user", u"legacy segment")],
+            'lengths': [2], 'postings': {u"legacy": [0, 1],
+            u"segment": [0, 1]}, 'sources': []}, outfile)
+        outfile.close()
+
+        start = time.time()
+        index = TweetIndex(directory)
+        print "Opened the index in %.2f ms." % ((time.time() - start) * 1000)
+        assert len(index) == 20001 and not os.path.exists(leftover)
+        assert index.search("legacy")[0][1] == "123456789"
+        assert all(isinstance(segment, SegmentFile)
+            for segment in index.segments)
+        results = index.search("lazy fox exocortex")
+        assert results[0][1] == "12345"
+        assert results[0][4] == \
+            "The quick brown fox jumps over the lazy dog #exocortex"
+
+        # Duplicates are found on disk, in the middle of a segment as well
+        # as past the end of it.
+        assert not index.add(TweetRecord("12345", 0, "duplicate"))
+        assert not index.add(TweetRecord("0", 0, "duplicate"))
+        assert index.add(TweetRecord("99999", 0, u"caf\xe9 unicode"))
+        index.close()
+        assert index.search(u"CAF\xc9")[0][1] == "99999"
+
+        start = time.time()
+        for i in range(100):
+            index.search("%s %s" % (random.choice(vocabulary),
+                random.choice(vocabulary)))
+        print "Average search time: %.2f ms." % ((time.time() - start) * 10)
+    finally:
+        shutil.rmtree(directory)
+    sys.exit(0)
+# Fin.
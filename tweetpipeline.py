@@ -0,0 +1,319 @@
+#!/usr/bin/env python2
+# -*- coding: utf-8 -*-
+# vim: set expandtab tabstop=4 shiftwidth=4 :
+
+# This is an Exocortex helper class that decodes the raw tweets that
+# TwitterStreamListener pushes into the queue of monitored tweets and hands
+# them off to whatever is going to do something with them.  Decoding JSON is
+# where the queue processor spends most of its time, so it's done by a pool
+# of workers.
+# - In thread mode the workers are threads.  They share the GIL with the rest
+#   of the bot, but they keep decoding while a tweet is being delivered.
+# - In process mode the workers are separate processes, so decoding can use
+#   more than one CPU core.  The decode function has to be picklable (i.e.,
+#   defined at the top level of a module) and so does whatever it returns.
+# - In ordered mode, tweets are delivered in the order they came off of the
+#   stream, which keeps the tweets for every search term in order.  In
+#   unordered mode, tweets are delivered as soon as they're decoded.
+# - An optional prefilter is run on every raw tweet before it's handed to the
+#   workers, in the pipeline's own process.  Tweets it turns down are never
+#   decoded (see tweetdedup.py).
+# - Only a few raw tweets (by default, one chunk per worker) are taken out of
+#   the queue ahead of the one being delivered.  The rest wait in the queue,
+#   so its size limit and overflow policy (see tweetqueue.py) still apply
+#   when delivery is slow.
+# - task_done() is called on the queue for every raw tweet once it's been
+#   delivered (or thrown away), in the order they were taken out of the
+#   queue, even in unordered mode.  A queue that keeps its tweets on disk
+#   (see durablequeue.py) uses that to know which ones are safe to forget.
+# - If delivering a tweet raises an exception, the error is printed and
+#   counted, and the tweet is finished with anyway, so one bad tweet can't
+#   stall the pipeline.
+# - Benchmark the pipeline with:
+#   python tweetpipeline.py [file of captured stream payloads, one per line]
+
+# TODO:
+# -
+
+# By: The Doctor <drwho at virtadpt dot net>
+#     0x807B17C1 / 7960 1CDC 85C9 0B63 8D9F  DD89 3BD8 FF2B 807B 17C1
+
+# License: GPLv3
+# Pre-requisite modules have their own licenses.
+
+# Load modules.
+import collections
+import json
+import multiprocessing
+from multiprocessing.pool import ThreadPool
+import Queue
+import sys
+import threading
+import time
+
+# Classes.
+""" This class runs tweets from a queue through a pool of decode workers and
+passes the results to a delivery function, one at a time, in the thread that
+calls run().  A None in the queue shuts the pipeline down. """
+class TweetPipeline(object):
+    # Worker modes.
+    THREAD = 'thread'
+    PROCESS = 'process'
+    modes = (THREAD, PROCESS)
+
+    # Queue of raw tweets to pull from, and the function to call with every
+    # decoded tweet.
+    queue = None
+    deliver = None
+
+    # Function that the workers run on every raw tweet.  Whatever it returns
+    # is passed to self.deliver() unless it's None.
+    decode = None
+
+    # How many workers there are, what kind they are, whether or not tweets
+    # are delivered in order, how many raw tweets are handed to a worker at a
+    # time, and how many can be out of the queue but not delivered yet.
+    workers = 1
+    mode = THREAD
+    ordered = True
+    chunksize = 1
+    read_ahead = 1
+
+    # Function that's called with every raw tweet before it's decoded.  Raw
+    # tweets that it returns False for are thrown away.
+    prefilter = None
+
+    # Counters.
+    received = 0
+    delivered = 0
+    undecodable = 0
+    undeliverable = 0
+    filtered = 0
+
+    """ Set up the pipeline.  Raises ValueError if the mode isn't one of the
+    ones listed above. """
+    def __init__(self, queue, deliver, workers=1, mode=THREAD, ordered=True,
+        decode=None, chunksize=1, prefilter=None, read_ahead=None):
+        if mode not in self.modes:
+            raise ValueError("Unknown worker mode '%s'.  Choose from %s." %
+                (mode, ", ".join(self.modes)))
+        self.queue = queue
+        self.deliver = deliver
+        self.workers = max(1, workers)
+        self.mode = mode
+        self.ordered = ordered
+        self.decode = decode or decode_tweet
+        self.chunksize = max(1, chunksize)
+        # Less than a chunk per worker would leave the workers waiting for
+        # chunks that can never fill up.
+        self.read_ahead = max(read_ahead or 0, self.workers * self.chunksize)
+        self.prefilter = prefilter
+        self.received = 0
+        self.delivered = 0
+        self.undecodable = 0
+        self.undeliverable = 0
+        self.filtered = 0
+
+    """ Generator that pulls raw tweets out of the queue until it finds the
+    termination sentinel, numbering them as it goes.  The worker pool's task
+    handler runs it.  It waits for a free slot before every raw tweet, so it
+    never gets more than self.read_ahead of them ahead of delivery. """
+    def _raw_tweets(self):
+        number = 0
+        while True:
+            self.slots.acquire()
+            raw_tweet = self.queue.get()
+            number += 1
+            if raw_tweet is None:
+                self._done(number)
+                break
+            self.received += 1
+            if self.prefilter is not None and not self.prefilter(raw_tweet):
+                self.filtered += 1
+                self._done(number)
+                continue
+            yield (self.decode, number, raw_tweet)
+
+    """ Mark a raw tweet as finished with, freeing its slot.  The queue is
+    told about finished tweets in the order they came out of it. """
+    def _done(self, number):
+        with self.lock:
+            self.finished.add(number)
+            while self.acknowledged + 1 in self.finished:
+                self.acknowledged += 1
+                self.finished.discard(self.acknowledged)
+                self.queue.task_done()
+        self.slots.release()
+
+    """ Run the pipeline until it reads a None from the queue.  Tweets are
+    delivered in the calling thread. """
+    def run(self):
+        self.slots = threading.Semaphore(self.read_ahead)
+        self.lock = threading.Lock()
+        self.finished = set()
+        self.acknowledged = 0
+        if self.mode == self.PROCESS:
+            pool = multiprocessing.Pool(self.workers)
+        else:
+            pool = ThreadPool(self.workers)
+
+        if self.ordered:
+            results = pool.imap(_decode_numbered, self._raw_tweets(),
+                self.chunksize)
+        else:
+            results = pool.imap_unordered(_decode_numbered,
+                self._raw_tweets(), self.chunksize)
+
+        try:
+            for (number, tweet) in results:
+                try:
+                    if tweet is None:
+                        self.undecodable += 1
+                    else:
+                        self.deliver(tweet)
+                        self.delivered += 1
+                except Exception as error:
+                    self.undeliverable += 1
+                    print "ERROR: Unable to deliver tweet %d: %s" % (number,
+                        error)
+                finally:
+                    self._done(number)
+        finally:
+            pool.close()
+            pool.join()
+
+""" Runs a decode function on a numbered raw tweet in a worker.  Returns the
+number along with the result, so results can be matched up with raw tweets
+even when they come back out of order. """
+def _decode_numbered(task):
+    (decode, number, raw_tweet) = task
+    return (number, decode(raw_tweet))
+
+""" Default decode function.  Turns a raw tweet into a dict, or returns None
+if it isn't valid JSON. """
+def decode_tweet(raw_tweet):
+    try:
+        return json.loads(raw_tweet)
+    except ValueError:
+        return None
+
+""" Make up a raw tweet shaped like the ones that come off of the streaming
+API, complete with a user object and entities and with the keys in the order
+Twitter sends them, for benchmarking. """
+def synthetic_payload(number):
+    user = collections.OrderedDict([("id", 1000 + number % 500),
+        ("id_str", str(1000 + number % 500)),
+        ("name", "Test User %d" % (number % 500)),
+        ("screen_name", "testuser%d" % (number % 500)),
+        ("location", "Somewhere, USA"), ("url", "http://example.com/"),
+        ("description", "Just another account that tweets about things. " * 3),
+        ("protected", False), ("followers_count", number % 1000),
+        ("friends_count", 100), ("listed_count", 3),
+        ("created_at", "Mon Jan 01 00:00:00 +0000 2007"),
+        ("favourites_count", 10), ("utc_offset", -28800),
+        ("time_zone", "Pacific Time (US & Canada)"), ("geo_enabled", False),
+        ("verified", False), ("statuses_count", 1234), ("lang", "en"),
+        ("profile_background_color", "C0DEED"),
+        ("profile_image_url", "http://pbs.twimg.com/profile_images/1/a.png"),
+        ("profile_link_color", "0084B4"), ("default_profile", True)])
+    return json.dumps(collections.OrderedDict([
+        ("created_at", "Wed Aug 27 13:08:45 +0000 2014"),
+        ("id", 504611402080000000 + number),
+        ("id_str", str(504611402080000000 + number)),
+        ("text", "This is test tweet number %d. #foo #bar http://t.co/boing" %
+            number),
+        ("source", "<a href=\"http://twitter.com\" rel=\"nofollow\">Twitter Web Client</a>"),
+        ("truncated", False), ("in_reply_to_status_id", None),
+        ("in_reply_to_user_id", None), ("in_reply_to_screen_name", None),
+        ("user", user), ("geo", None), ("coordinates", None), ("place", None),
+        ("contributors", None), ("retweet_count", number % 50),
+        ("favorite_count", number % 20),
+        ("entities", {"hashtags": [{"text": "foo", "indices": [30, 34]},
+            {"text": "bar", "indices": [35, 39]}], "symbols": [],
+            "urls": [{"url": "http://t.co/boing",
+            "expanded_url": "http://boingboing.net/",
+            "display_url": "boingboing.net", "indices": [40, 57]}],
+            "user_mentions": []}),
+        ("favorited", False), ("retweeted", False),
+        ("possibly_sensitive", False), ("filter_level", "low"),
+        ("lang", "en"), ("timestamp_ms", "1409144925000")]))
+
+""" Read captured stream payloads from a file, one per line.  If no file is
+given, make up the given number of synthetic ones instead. """
+def load_payloads(filename=None, count=20000):
+    if filename:
+        payloads = open(filename, 'r')
+        try:
+            return [line for line in payloads if line.strip()]
+        finally:
+            payloads.close()
+    return [synthetic_payload(i) for i in xrange(count)]
+
+# Core code...
+if __name__ == '__main__':
+    # Self tests: a slow consumer doesn't pull the queue into the pipeline,
+    # so the queue's overflow policy still kicks in, and every raw tweet is
+    # acknowledged once it's delivered.
+    from tweetqueue import BoundedTweetQueue
+    for ordered in (True, False):
+        queue = BoundedTweetQueue(100)
+        delivered = []
+        pipeline = TweetPipeline(queue,
+            lambda tweet: (delivered.append(tweet), time.sleep(0.001)), 2,
+            ordered=ordered, chunksize=4)
+        consumer = threading.Thread(target=pipeline.run)
+        consumer.start()
+        for i in xrange(2000):
+            queue.put(json.dumps(i))
+            assert pipeline.received <= len(delivered) + pipeline.read_ahead
+        queue.put(None)
+        consumer.join()
+        assert queue.statistics()['dropped'] > 1000
+        assert len(delivered) + queue.statistics()['dropped'] == 2000
+        assert queue.unfinished_tasks == 0
+        if ordered:
+            assert delivered == sorted(delivered)
+
+    # A deliver function that blows up doesn't stall the pipeline.
+    for mode in TweetPipeline.modes:
+        queue = BoundedTweetQueue(100)
+        delivered = []
+        def deliver(tweet):
+            if tweet % 7 == 0:
+                raise ValueError("Unlucky tweet.")
+            delivered.append(tweet)
+        pipeline = TweetPipeline(queue, deliver, 2, mode)
+        consumer = threading.Thread(target=pipeline.run)
+        consumer.start()
+        for i in xrange(1, 51):
+            queue.put(json.dumps(i))
+        queue.put(None)
+        consumer.join(30)
+        assert not consumer.is_alive()
+        assert pipeline.undeliverable == 7 and len(delivered) == 43
+        assert queue.unfinished_tasks == 0
+
+    payloads = load_payloads(sys.argv[1] if len(sys.argv) > 1 else None)
+    print "Replaying %d payloads (%d bytes on average)." % (len(payloads),
+        sum(len(payload) for payload in payloads) / len(payloads))
+
+    for mode in TweetPipeline.modes:
+        for workers in (1, 2, 4):
+            queue = Queue.Queue()
+            for payload in payloads:
+                queue.put(payload)
+            queue.put(None)
+
+            delivered = []
+            pipeline = TweetPipeline(queue, delivered.append, workers, mode,
+                ordered=True, chunksize=64)
+            start = time.time()
+            pipeline.run()
+            elapsed = time.time() - start
+            assert len(delivered) == len(payloads)
+            assert delivered[0]['text'] == json.loads(payloads[0])['text']
+            assert delivered[-1]['text'] == json.loads(payloads[-1])['text']
+            print "%-7s mode, %d workers: %8.0f tweets per second." % (mode,
+                workers, len(payloads) / elapsed)
+    sys.exit(0)
+# Fin.
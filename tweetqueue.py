@@ -0,0 +1,154 @@
+#!/usr/bin/env python2
+# -*- coding: utf-8 -*-
+# vim: set expandtab tabstop=4 shiftwidth=4 :
+
+# This is an Exocortex helper class that extends Queue.Queue with a size
+# limit that doesn't necessarily block the producer.  TwitterStreamListener
+# pushes raw tweets into it as fast as Twitter sends them, and if the queue
+# processor falls behind on a hot search term something has to give.  What
+# gives depends on the overflow policy:
+# - block: The stream listener waits for room in the queue (which eventually
+#   makes Twitter disconnect the stream if it goes on long enough).
+# - drop-oldest: The oldest tweet in the queue is thrown away to make room.
+# - drop-newest: The incoming tweet is thrown away.
+# - sample: The incoming tweet replaces the oldest one with a given
+#   probability, and is thrown away otherwise.
+# None is used as a termination sentinel by the queue processor, so it's never
+# thrown away no matter what the policy is.
+
+# TODO:
+# -
+
+# By: The Doctor <drwho at virtadpt dot net>
+#     0x807B17C1 / 7960 1CDC 85C9 0B63 8D9F  DD89 3BD8 FF2B 807B 17C1
+
+# License: GPLv3
+# Pre-requisite modules have their own licenses.
+
+# Load modules.
+import Queue
+import random
+import sys
+
+# Classes.
+""" This class is a bounded queue with a choice of overflow policies, which
+keeps count of what it's thrown away and how deep it's gotten. """
+class BoundedTweetQueue(Queue.Queue):
+    # Overflow policies.
+    BLOCK = 'block'
+    DROP_OLDEST = 'drop-oldest'
+    DROP_NEWEST = 'drop-newest'
+    SAMPLE = 'sample'
+    policies = (BLOCK, DROP_OLDEST, DROP_NEWEST, SAMPLE)
+
+    # The overflow policy in effect, and the probability that the sample
+    # policy will let an incoming tweet in.
+    policy = DROP_OLDEST
+    sample_rate = 0.5
+
+    # Counters.
+    enqueued = 0
+    dropped = 0
+    high_water_mark = 0
+
+    """ Set up the queue.  A maxsize of zero means the queue is unbounded,
+    like Queue.Queue.  Raises ValueError if the policy isn't one of the
+    ones listed above. """
+    def __init__(self, maxsize=10000, policy=DROP_OLDEST, sample_rate=0.5):
+        if policy not in self.policies:
+            raise ValueError("Unknown overflow policy '%s'.  Choose from %s." %
+                (policy, ", ".join(self.policies)))
+        Queue.Queue.__init__(self, maxsize)
+        self.policy = policy
+        self.sample_rate = sample_rate
+        self.enqueued = 0
+        self.dropped = 0
+        self.high_water_mark = 0
+
+    """ Put an item into the queue, applying the overflow policy if the
+    queue is full.  Returns True if the item went into the queue and False
+    if it was thrown away. """
+    def put(self, item, block=True, timeout=None):
+        if self.policy == self.BLOCK or self.maxsize <= 0:
+            Queue.Queue.put(self, item, block, timeout)
+            return True
+
+        with self.not_full:
+            if self._qsize() >= self.maxsize:
+                # Figure out whether the new item or the oldest one goes.
+                drop_newest = (self.policy == self.DROP_NEWEST) or \
+                    (self.policy == self.SAMPLE and
+                    random.random() >= self.sample_rate)
+                if item is None:
+                    drop_newest = False
+                if self.queue[0] is None:
+                    drop_newest = True
+
+                if drop_newest and item is not None:
+                    self.dropped += 1
+                    return False
+                if not drop_newest:
+                    self._get()
+                    self.unfinished_tasks -= 1
+                    self.dropped += 1
+
+            self._put(item)
+            self.unfinished_tasks += 1
+            self.not_empty.notify()
+        return True
+
+    """ Called by Queue.Queue with the mutex held every time something goes
+    into the queue, which makes it a good place to keep count. """
+    def _put(self, item):
+        self.queue.append(item)
+        self.enqueued += 1
+        if len(self.queue) > self.high_water_mark:
+            self.high_water_mark = len(self.queue)
+
+    """ Return a dict of the queue's counters. """
+    def statistics(self):
+        with self.mutex:
+            return {'depth': self._qsize(), 'maxsize': self.maxsize,
+                'policy': self.policy, 'enqueued': self.enqueued,
+                'dropped': self.dropped,
+                'high_water_mark': self.high_water_mark}
+
+    """ Return the queue's counters as something that can be sent to the
+    user. """
+    def status_report(self):
+        stats = self.statistics()
+        report = "The tweet queue holds %(depth)d of at most %(maxsize)d tweets and uses the %(policy)s overflow policy.\n" % stats
+        report = report + "%(enqueued)d tweets have been queued and %(dropped)d have been dropped.  The queue has been as deep as %(high_water_mark)d tweets." % stats
+        return report
+
+# Core code...
+if __name__ == '__main__':
+    # Self tests.
+    queue = BoundedTweetQueue(3, BoundedTweetQueue.DROP_OLDEST)
+    for i in range(5):
+        queue.put(i)
+    assert list(queue.queue) == [2, 3, 4] and queue.dropped == 2
+
+    queue = BoundedTweetQueue(3, BoundedTweetQueue.DROP_NEWEST)
+    for i in range(5):
+        queue.put(i)
+    assert list(queue.queue) == [0, 1, 2] and queue.dropped == 2
+    queue.put(None)
+    assert list(queue.queue) == [1, 2, None]
+    assert not queue.put(5)
+    assert list(queue.queue) == [1, 2, None]
+
+    queue = BoundedTweetQueue(10, BoundedTweetQueue.SAMPLE, 0.5)
+    for i in range(1000):
+        queue.put(i)
+    assert queue.qsize() == 10 and queue.high_water_mark == 10
+    assert queue.dropped == 990 and queue.unfinished_tasks == 10
+
+    try:
+        BoundedTweetQueue(10, 'bogus')
+        assert False
+    except ValueError:
+        pass
+    print queue.status_report()
+    sys.exit(0)
+# Fin.
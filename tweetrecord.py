@@ -0,0 +1,245 @@
+#!/usr/bin/env python2
+# -*- coding: utf-8 -*-
+# vim: set expandtab tabstop=4 shiftwidth=4 :
+
+# This is an Exocortex helper class that holds the parts of a tweet that the
+# bot actually uses (see doc/twitter_streams.txt) and nothing else.  Tweepy
+# Status objects and decoded tweets drag around dozens of keys worth of user
+# profile and entities apiece, which adds up fast when the bot holds onto
+# search results, timelines, and tweets from the stream.
+# - Strings that are the same from one tweet to the next (screen names, user
+#   names, locations, and so forth) are interned, so every tweet from the
+#   same user shares one copy of them.
+# - Timestamps are stored as seconds since the epoch (UTC).
+# - Coordinates are stored as a (longitude, latitude) tuple, in the same
+#   order that Twitter's GeoJSON uses.
+# - Tweets from the stream are tagged with the search terms they matched (see
+#   termrouter.py).  Tweets that haven't been tagged have None instead.
+# - Benchmark decoding with:
+#   python tweetrecord.py [file of captured stream payloads, one per line]
+
+# TODO:
+# -
+
+# By: The Doctor <drwho at virtadpt dot net>
+#     0x807B17C1 / 7960 1CDC 85C9 0B63 8D9F  DD89 3BD8 FF2B 807B 17C1
+
+# License: GPLv3
+# Pre-requisite modules have their own licenses.
+
+# Load modules.
+import calendar
+import json
+import sys
+import threading
+import time
+from tweetview import TweetView
+
+# Month abbreviations used in Twitter's timestamps.
+_MONTHS = {'Jan': 1, 'Feb': 2, 'Mar': 3, 'Apr': 4, 'May': 5, 'Jun': 6,
+    'Jul': 7, 'Aug': 8, 'Sep': 9, 'Oct': 10, 'Nov': 11, 'Dec': 12}
+
+# Table of interned strings.  It's cleared if it ever gets this big, to keep
+# a long-running bot from holding onto every screen name it's ever seen.
+_interned = {}
+_interned_lock = threading.Lock()
+MAX_INTERNED = 100000
+
+# Classes.
+""" This class is a compact record of a single tweet. """
+class TweetRecord(object):
+    __slots__ = ('id_str', 'created_at', 'text', 'coordinates',
+        'retweet_count', 'urls', 'user_id_str', 'screen_name', 'name',
+        'description', 'location', 'url', 'time_zone', 'geo_enabled',
+        'terms')
+
+    def __init__(self, id_str=None, created_at=None, text=None,
+        coordinates=None, retweet_count=0, urls=(), user_id_str=None,
+        screen_name=None, name=None, description=None, location=None,
+        url=None, time_zone=None, geo_enabled=False, terms=None):
+        self.id_str = id_str
+        self.created_at = created_at
+        self.text = text
+        self.coordinates = coordinates
+        self.retweet_count = retweet_count
+        self.urls = urls
+        self.user_id_str = intern_string(user_id_str)
+        self.screen_name = intern_string(screen_name)
+        self.name = intern_string(name)
+        self.description = intern_string(description)
+        self.location = intern_string(location)
+        self.url = intern_string(url)
+        self.time_zone = intern_string(time_zone)
+        self.geo_enabled = geo_enabled
+        self.terms = terms
+
+    """ Build a record from a tweepy Status object. """
+    @classmethod
+    def from_status(cls, status):
+        user = status.user
+        entities = getattr(status, 'entities', None) or {}
+        return cls(status.id_str,
+            calendar.timegm(status.created_at.utctimetuple()),
+            status.text, _coordinates(status.coordinates),
+            getattr(status, 'retweet_count', 0), _urls(entities),
+            user.id_str, user.screen_name, user.name,
+            getattr(user, 'description', None),
+            getattr(user, 'location', None), getattr(user, 'url', None),
+            getattr(user, 'time_zone', None),
+            getattr(user, 'geo_enabled', False))
+
+    """ Build a record from a tweet as it comes off of the streaming API: raw
+    JSON, a decoded dict, or a TweetView.  Raw JSON is decoded in one go with
+    json.loads(), which is several times faster than picking the fields out
+    of it one at a time with a TweetView; only the fields that go into the
+    record are kept either way. """
+    @classmethod
+    def from_json(cls, tweet):
+        if isinstance(tweet, basestring):
+            tweet = json.loads(tweet)
+        if isinstance(tweet, TweetView):
+            get = tweet.field
+            user = tweet.user or {}
+            text = tweet.text
+            id_str = tweet.id_str
+            created_at = tweet.created_at
+            coordinates = tweet.coordinates
+        else:
+            get = tweet.get
+            user = tweet.get('user') or {}
+            text = tweet.get('text')
+            id_str = tweet.get('id_str')
+            created_at = tweet.get('created_at')
+            coordinates = tweet.get('coordinates')
+
+        return cls(id_str, parse_timestamp(created_at), text,
+            _coordinates(coordinates), get('retweet_count') or 0,
+            _urls(get('entities') or {}), user.get('id_str'),
+            user.get('screen_name'), user.get('name'),
+            user.get('description'), user.get('location'), user.get('url'),
+            user.get('time_zone'), user.get('geo_enabled', False))
+
+    """ Returns the timestamp of the tweet in the same format that tweepy's
+    datetime objects print in. """
+    def created_at_string(self):
+        if self.created_at is None:
+            return ""
+        return time.strftime('%Y-%m-%d %H:%M:%S',
+            time.gmtime(self.created_at))
+
+    # Pickling support, so that records can be passed between processes.
+    def __getstate__(self):
+        return tuple(getattr(self, slot) for slot in self.__slots__)
+
+    def __setstate__(self, state):
+        for (slot, value) in zip(self.__slots__, state):
+            setattr(self, slot, value)
+
+    def __repr__(self):
+        return "<TweetRecord %s @%s: %r>" % (self.id_str, self.screen_name,
+            self.text)
+
+""" Return the single shared copy of a string.  Works on unicode strings,
+unlike the intern() builtin. """
+def intern_string(value):
+    if value is None:
+        return None
+    shared = _interned.get(value)
+    if shared is not None:
+        return shared
+    with _interned_lock:
+        if len(_interned) >= MAX_INTERNED:
+            _interned.clear()
+        return _interned.setdefault(value, value)
+
+""" Turn a timestamp in Twitter's format ("Wed Aug 27 13:08:45 +0000 2014")
+into seconds since the epoch.  Returns None if it can't be parsed. """
+def parse_timestamp(timestamp):
+    try:
+        (weekday, month, day, clock, offset, year) = timestamp.split()
+        (hours, minutes, seconds) = clock.split(':')
+        seconds = calendar.timegm((int(year), _MONTHS[month], int(day),
+            int(hours), int(minutes), int(seconds), 0, 0, 0))
+        offset = int(offset)
+        sign = -1 if offset < 0 else 1
+        offset = abs(offset)
+        return seconds - sign * ((offset // 100) * 3600 + (offset % 100) * 60)
+    except (AttributeError, KeyError, ValueError):
+        return None
+
+""" Turn a GeoJSON point into a (longitude, latitude) tuple. """
+def _coordinates(coordinates):
+    if not coordinates:
+        return None
+    try:
+        return tuple(coordinates['coordinates'])
+    except (KeyError, TypeError):
+        return None
+
+""" Pull the expanded URLs out of a tweet's entities. """
+def _urls(entities):
+    return tuple(url.get('expanded_url') or url.get('url')
+        for url in entities.get('urls') or ())
+
+""" Decode function for TweetPipeline.  Turns a raw tweet into a TweetRecord
+in the worker, so all that comes back to the bot is the record. """
+def record_tweet(raw):
+    try:
+        return TweetRecord.from_json(raw)
+    except ValueError:
+        return None
+
+# Core code...
+if __name__ == '__main__':
+    # Self tests.
+    assert parse_timestamp("Wed Aug 27 13:08:45 +0000 2014") == 1409144925
+    assert parse_timestamp("Wed Aug 27 13:08:45 -0130 2014") == \
+        1409144925 + 5400
+    assert parse_timestamp(None) is None
+
+    from tweetpipeline import synthetic_payload
+    from tweetview import _deep_size
+    import cPickle
+
+    payload = synthetic_payload(42)
+    decoded = json.loads(payload)
+    for record in (TweetRecord.from_json(payload),
+        TweetRecord.from_json(decoded), record_tweet(payload),
+        cPickle.loads(cPickle.dumps(record_tweet(payload), 2))):
+        assert record.text == decoded['text']
+        assert record.id_str == decoded['id_str']
+        assert record.screen_name == "testuser42"
+        assert record.urls == ("http://boingboing.net/", )
+        assert record.retweet_count == 42
+        assert record.created_at_string() == "2014-08-27 13:08:45"
+
+    # Compare the memory used by a thousand tweets from a hundred users,
+    # kept as decoded dicts and as records.
+    payloads = [synthetic_payload(i % 100 + (i // 100) * 500)
+        for i in range(1000)]
+    decoded = [json.loads(payload) for payload in payloads]
+    records = [TweetRecord.from_json(payload) for payload in payloads]
+    seen = set()
+    decoded_size = sum(_deep_size(tweet, seen) for tweet in decoded)
+    seen = set()
+    records_size = 0
+    for record in records:
+        if id(record) not in seen:
+            seen.add(id(record))
+            records_size += sys.getsizeof(record)
+        for slot in record.__slots__:
+            records_size += _deep_size(getattr(record, slot), seen)
+    print "Decoded dicts: %d bytes per tweet." % (decoded_size / 1000)
+    print "TweetRecords:  %d bytes per tweet." % (records_size / 1000)
+
+    # Benchmark turning raw tweets into records.
+    from tweetpipeline import load_payloads
+    payloads = load_payloads(sys.argv[1] if len(sys.argv) > 1 else None)
+    start = time.time()
+    for payload in payloads:
+        record_tweet(payload)
+    elapsed = time.time() - start
+    print "record_tweet(): %.1f microseconds per tweet." % (elapsed /
+        len(payloads) * 1000000)
+    sys.exit(0)
+# Fin.
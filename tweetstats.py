@@ -0,0 +1,389 @@
+#!/usr/bin/env python2
+# -*- coding: utf-8 -*-
+# vim: set expandtab tabstop=4 shiftwidth=4 :
+
+# This is an Exocortex helper class that works out statistics about the tweets
+# the bot has archived: when a user (or everybody who tweets about something)
+# posts, how much their tweets get retweeted, which hashtags they use, and
+# what else they talk about.
+# - Tweets are kept as columns of numbers, not objects: when every tweet was
+#   posted, how many times it was retweeted, and the number of its author.
+#   The words, hashtags, and mentions in every tweet are turned into numbers
+#   too, and kept in two more columns (the term's number, and the number of
+#   the tweet it's in), one entry per distinct term per tweet.  What kind of
+#   term each one is (word, stop word, hashtag, or mention) is kept in a
+#   column of its own, filled in when the term is first seen.
+# - The columns are Python arrays, which are cheap to append to, and NumPy
+#   looks at them directly without copying them.  All of the statistics are
+#   worked out with NumPy array operations over the whole column (bincount,
+#   boolean masks, and so forth), never by looping over tweets in Python.
+# - Statistics can be for one user (@someone), for the tweets that contain
+#   every word of a term (#hashtag, word, or several words), or for
+#   everything.  Plain words match hashtags too, like search terms do (see
+#   termrouter.py).
+# - Times are UTC.
+# - The columns are saved to a .npz file when the bot shuts down and loaded
+#   again when it starts.  Tweets archived since the last clean shutdown are
+#   missing from the statistics after a crash.
+# - Benchmark it with:
+#   python tweetstats.py [number of tweets]
+
+# TODO:
+# -
+
+# By: The Doctor <drwho at virtadpt dot net>
+#     0x807B17C1 / 7960 1CDC 85C9 0B63 8D9F  DD89 3BD8 FF2B 807B 17C1
+
+# License: GPLv3
+# Pre-requisite modules have their own licenses.
+
+# Load modules.
+import array
+import numpy
+import os
+import re
+import sys
+import threading
+import time
+
+# Splits text into words, hashtags, and mentions.
+_TERMS = re.compile(r'[#@]?\w+', re.UNICODE)
+
+# Words that are too common to say anything about what a tweet is about.
+STOP_WORDS = frozenset("""a about after all also am an and any are as at be
+    because been but by can could did do does for from get got had has have he
+    her him his how i if in into is it its just like me more my no not now of
+    on or our out rt so some than that the their them then there they this to
+    too up us was we were what when which who why will with would you your
+    http https t co amp""".split())
+
+WEEKDAYS = ('Mon', 'Tue', 'Wed', 'Thu', 'Fri', 'Sat', 'Sun')
+
+# Kinds of terms.
+_WORD = 0
+_STOP_WORD = 1
+_HASHTAG = 2
+_MENTION = 3
+
+# Classes.
+""" This class is the store.  It's safe to use from several threads. """
+class TweetStats(object):
+    # How many hashtags and terms to list.
+    top = 5
+
+    # Columns, one entry per tweet: when it was posted (seconds since the
+    # epoch), how many times it was retweeted, and its author's number.
+    created_at = None
+    retweets = None
+    users = None
+
+    # Columns, one entry per distinct term per tweet: the term's number and
+    # the tweet's.
+    term_ids = None
+    term_rows = None
+
+    # Lowercase screen name or term -> number, and the other way around.
+    user_numbers = None
+    user_names = None
+    term_numbers = None
+    term_names = None
+
+    # Column, one entry per term: what kind of term it is.
+    term_kinds = None
+
+    def __init__(self, filename=None):
+        self.filename = filename
+        self.lock = threading.Lock()
+        self._clear()
+        if filename and os.path.exists(filename):
+            self.load(filename)
+
+    """ Empty the store. """
+    def _clear(self):
+        self.created_at = array.array('l')
+        self.retweets = array.array('i')
+        self.users = array.array('i')
+        self.term_ids = array.array('i')
+        self.term_rows = array.array('i')
+        self.user_numbers = {}
+        self.user_names = []
+        self.term_numbers = {}
+        self.term_names = []
+        self.term_kinds = array.array('b')
+
+    """ Returns the number of a name, giving it one if it doesn't have one
+    yet.  Called with the lock held. """
+    def _number(self, numbers, names, name):
+        number = numbers.get(name)
+        if number is None:
+            number = numbers[name] = len(names)
+            names.append(name)
+        return number
+
+    """ Add a TweetRecord. """
+    def add(self, record):
+        if record.text is None or record.created_at is None:
+            return
+        terms = set(_TERMS.findall(record.text.lower()))
+        with self.lock:
+            row = len(self.created_at)
+            self.created_at.append(int(record.created_at))
+            self.retweets.append(record.retweet_count or 0)
+            self.users.append(self._number(self.user_numbers,
+                self.user_names, (record.screen_name or "").lower()))
+            for term in terms:
+                number = self._number(self.term_numbers, self.term_names,
+                    term)
+                if number == len(self.term_kinds):
+                    self.term_kinds.append(_kind(term))
+                self.term_ids.append(number)
+                self.term_rows.append(row)
+
+    """ Returns how many tweets are in the store. """
+    def __len__(self):
+        return len(self.created_at)
+
+    """ Returns NumPy views of the columns.  Called with the lock held; the
+    views are only good until something else is added. """
+    def _columns(self):
+        return [numpy.frombuffer(column, dtype=column.typecode) for column in
+            (self.created_at, self.retweets, self.users, self.term_ids,
+            self.term_rows)]
+
+    """ Returns a dict of statistics about the tweets by a user (if 'subject'
+    starts with @), the tweets that contain every word of a term, or all of
+    them (if 'subject' is empty).  Returns None if there aren't any. """
+    def statistics(self, subject=""):
+        subject = subject.strip().lower()
+        with self.lock:
+            (created_at, retweets, users, term_ids, term_rows) = \
+                self._columns()
+            count = len(created_at)
+            if not count:
+                return None
+
+            # Pick out the tweets the statistics are about.
+            excluded = []
+            if subject.startswith('@') and ' ' not in subject:
+                number = self.user_numbers.get(subject[1:])
+                if number is None:
+                    return None
+                selected = users == number
+                excluded = [self.term_numbers.get(subject)]
+            elif subject:
+                selected = numpy.ones(count, dtype=bool)
+                for word in _TERMS.findall(subject):
+                    # Plain words match hashtags too.
+                    numbers = [self.term_numbers.get(form) for form in
+                        ((word, ) if word[0] in '#@' else (word, '#' + word))]
+                    numbers = [number for number in numbers if number is
+                        not None]
+                    if not numbers:
+                        return None
+                    containing = numpy.zeros(count, dtype=bool)
+                    for number in numbers:
+                        containing[term_rows[term_ids == number]] = True
+                    selected &= containing
+                    excluded.extend(numbers)
+            else:
+                selected = numpy.ones(count, dtype=bool)
+            selected_count = int(selected.sum())
+            if not selected_count:
+                return None
+
+            # When they were posted.
+            times = created_at[selected]
+            hours = numpy.bincount((times % 86400) // 3600, minlength=24)
+            # The epoch was a Thursday.
+            weekdays = numpy.bincount((times // 86400 + 3) % 7, minlength=7)
+            first = int(times.min())
+            last = int(times.max())
+            days = max(1.0, (last - first) / 86400.0)
+
+            # How much they were retweeted.
+            counts = retweets[selected]
+            percentiles = numpy.percentile(counts, [50, 90, 99])
+            never = int((counts == 0).sum())
+
+            # The terms in them, and how many of them each one is in.
+            in_selected = selected[term_rows]
+            frequencies = numpy.bincount(term_ids[in_selected],
+                minlength=len(self.term_names))
+            names = self.term_names
+            kinds = numpy.frombuffer(self.term_kinds, dtype='b')
+            hashtags = numpy.where(kinds == _HASHTAG, frequencies, 0)
+            words = numpy.where(kinds == _WORD, frequencies, 0)
+            mentions = numpy.where(kinds == _MENTION, frequencies, 0)
+            for number in excluded:
+                if number is not None:
+                    hashtags[number] = words[number] = mentions[number] = 0
+
+            return {'subject': subject or "everything",
+                'tweets': selected_count, 'first': first, 'last': last,
+                'per_day': selected_count / days,
+                'hours': hours.tolist(), 'weekdays': weekdays.tolist(),
+                'median_retweets': float(percentiles[0]),
+                'p90_retweets': float(percentiles[1]),
+                'p99_retweets': float(percentiles[2]),
+                'mean_retweets': float(counts.mean()),
+                'max_retweets': int(counts.max()),
+                'never_retweeted': 100.0 * never / selected_count,
+                'hashtags': _top(hashtags, names, self.top),
+                'terms': _top(words, names, self.top),
+                'mentions': _top(mentions, names, self.top)}
+
+    """ Return the statistics about something as something that can be sent to
+    the user. """
+    def report(self, subject=""):
+        stats = self.statistics(subject)
+        if stats is None:
+            return "I haven't archived any tweets about %s." % (
+                subject.strip() or "anything")
+        report = "Statistics for %s: %d tweets between %s and %s (%.1f per day).\n" % (stats['subject'], stats['tweets'], _date(stats['first']), _date(stats['last']), stats['per_day'])
+        busiest = sorted(range(24), key=lambda hour: -stats['hours'][hour])
+        report = report + "Busiest hours (UTC): %s.\n" % ", ".join(
+            "%02d:00 (%d)" % (hour, stats['hours'][hour]) for hour in
+            busiest[:3] if stats['hours'][hour])
+        report = report + "By hour (UTC, from midnight): %s.\n" % " ".join(
+            str(count) for count in stats['hours'])
+        report = report + "By weekday: %s.\n" % ", ".join("%s %d" % (day,
+            count) for (day, count) in zip(WEEKDAYS, stats['weekdays']))
+        report = report + "Retweets: median %(median_retweets).0f, mean %(mean_retweets).1f, 90th percentile %(p90_retweets).0f, 99th percentile %(p99_retweets).0f, most %(max_retweets)d.  %(never_retweeted).0f%% were never retweeted.\n" % stats
+        for (label, key) in (("Top hashtags", 'hashtags'),
+            ("Top terms", 'terms'), ("Top mentions", 'mentions')):
+            if stats[key]:
+                report = report + "%s: %s.\n" % (label, ", ".join(
+                    "%s (%d)" % (name, count) for (name, count) in
+                    stats[key]))
+        return report.rstrip()
+
+    """ Save the store to a .npz file. """
+    def save(self, filename=None):
+        filename = filename or self.filename
+        with self.lock:
+            (created_at, retweets, users, term_ids, term_rows) = \
+                self._columns()
+            temporary = filename + ".tmp.npz"
+            numpy.savez(temporary, created_at=created_at, retweets=retweets,
+                users=users, term_ids=term_ids, term_rows=term_rows,
+                user_names=numpy.array(self.user_names, dtype=unicode),
+                term_names=numpy.array(self.term_names, dtype=unicode))
+            os.rename(temporary, filename)
+
+    """ Replace what's in the store with what's in a .npz file. """
+    def load(self, filename):
+        saved = numpy.load(filename)
+        with self.lock:
+            self._clear()
+            for (name, column) in (('created_at', self.created_at),
+                ('retweets', self.retweets), ('users', self.users),
+                ('term_ids', self.term_ids), ('term_rows', self.term_rows)):
+                column.fromstring(saved[name].astype(
+                    column.typecode).tostring())
+            self.user_names = [unicode(name) for name in saved['user_names']]
+            self.term_names = [unicode(name) for name in saved['term_names']]
+            self.user_numbers = dict((name, number) for (number, name) in
+                enumerate(self.user_names))
+            self.term_numbers = dict((name, number) for (number, name) in
+                enumerate(self.term_names))
+            self._index_terms()
+
+    """ Work out the kind of every term from scratch.  Called with the lock
+    held. """
+    def _index_terms(self):
+        self.term_kinds = array.array('b', [_kind(name) for name in
+            self.term_names])
+
+""" Returns the 'top' (name, count) pairs with the highest counts. """
+def _top(counts, names, top):
+    if not len(counts):
+        return []
+    top = min(top, len(counts))
+    best = numpy.argpartition(-counts, top - 1)[:top]
+    best = best[numpy.argsort(-counts[best], kind='mergesort')]
+    return [(names[number], int(counts[number])) for number in best
+        if counts[number]]
+
+""" Returns what kind of term a term is. """
+def _kind(term):
+    if term[:1] == '#':
+        return _HASHTAG
+    if term[:1] == '@':
+        return _MENTION
+    if term in STOP_WORDS:
+        return _STOP_WORD
+    return _WORD
+
+""" Returns a timestamp as a date. """
+def _date(timestamp):
+    return time.strftime('%Y-%m-%d', time.gmtime(timestamp))
+
+# Core code...
+if __name__ == '__main__':
+    # Self tests.
+    import tempfile
+    from tweetrecord import TweetRecord
+    stats = TweetStats()
+    assert stats.statistics() is None
+    # Monday, 2014-08-25 13:00 UTC, then every six hours.
+    monday = 1408971600
+    for i in range(8):
+        stats.add(TweetRecord(str(i), monday + i * 6 * 3600,
+            "The #exocortex project, part %d @someone" % i if i % 2 else
+            "Working on the #exocortex with #python", retweet_count=i,
+            screen_name="DrWho" if i < 6 else "someone"))
+    result = stats.statistics("@drwho")
+    assert result['tweets'] == 6
+    assert result['hours'][13] == 2 and result['hours'][19] == 2
+    assert result['weekdays'] == [2, 4, 0, 0, 0, 0, 0]
+    assert result['hashtags'][0] == (u'#exocortex', 6)
+    assert result['hashtags'][1] == (u'#python', 3)
+    assert result['max_retweets'] == 5 and result['median_retweets'] == 2.5
+    assert stats.statistics("#exocortex")['tweets'] == 8
+    result = stats.statistics("exocortex project")
+    assert result['tweets'] == 4 and result['mentions'] == [(u'@someone', 4)]
+    assert result['hashtags'] == []
+    assert u'the' not in dict(result['terms'])
+    assert stats.statistics("nothing") is None
+    assert stats.statistics("@nobody") is None
+    print stats.report("@DrWho")
+
+    filename = tempfile.mktemp(suffix=".npz")
+    try:
+        stats.save(filename)
+        loaded = TweetStats(filename)
+        assert loaded.statistics("@drwho") == stats.statistics("@drwho")
+        assert loaded.term_kinds == stats.term_kinds
+    finally:
+        os.remove(filename)
+
+    # Benchmark: a million tweets by 10,000 users, using 100,000 terms.
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 1000000
+    terms_per_tweet = 12
+    generator = numpy.random.RandomState(42)
+    big = TweetStats()
+    big.created_at.fromstring(numpy.sort(generator.randint(1200000000,
+        1400000000, count)).astype('l').tostring())
+    big.retweets.fromstring(generator.zipf(2.0, count).astype('i').tostring())
+    big.users.fromstring(generator.randint(0, 10000, count).astype(
+        'i').tostring())
+    big.term_ids.fromstring(numpy.minimum(generator.zipf(1.3,
+        count * terms_per_tweet), 100000).astype('i').tostring())
+    big.term_rows.fromstring(numpy.repeat(numpy.arange(count),
+        terms_per_tweet).astype('i').tostring())
+    big.user_names = [u"user%d" % i for i in range(10000)]
+    big.user_numbers = dict((name, i) for (i, name) in
+        enumerate(big.user_names))
+    big.term_names = [u"#tag%d" % i if i % 10 == 0 else u"word%d" % i
+        for i in range(100001)]
+    big.term_numbers = dict((name, i) for (i, name) in
+        enumerate(big.term_names))
+    big._index_terms()
+    for subject in ("", "@user42", "word3", "word3 word7"):
+        start = time.time()
+        result = big.statistics(subject)
+        print "%d tweets, statistics for %-12s (%7d tweets): %4.0f ms." % (
+            count, subject or "everything", result['tweets'],
+            (time.time() - start) * 1000)
+    sys.exit(0)
+# Fin.
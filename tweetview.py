@@ -0,0 +1,264 @@
+#!/usr/bin/env python2
+# -*- coding: utf-8 -*-
+# vim: set expandtab tabstop=4 shiftwidth=4 :
+
+# This is an Exocortex helper class that wraps a raw tweet from Twitter's
+# streaming API and only decodes the parts of it that somebody asks for.
+# Tweets are several kilobytes of JSON, most of which is the user's profile
+# and the tweet's entities, and most of the time all the bot wants is the
+# text.
+# - The fields that get picked out on their own are text, id_str,
+#   created_at, coordinates, and user.screen_name.  Each one is cached the
+#   first time it's asked for.
+# - Everything else (or anything unusual about the tweet) falls back to
+#   decoding the whole thing with json.loads(), which is also cached.
+# - Benchmark it with:
+#   python tweetview.py [file of captured stream payloads, one per line]
+
+# TODO:
+# -
+
+# By: The Doctor <drwho at virtadpt dot net>
+#     0x807B17C1 / 7960 1CDC 85C9 0B63 8D9F  DD89 3BD8 FF2B 807B 17C1
+
+# License: GPLv3
+# Pre-requisite modules have their own licenses.
+
+# Load modules.
+import json
+import re
+import sys
+import time
+
+# Matches a JSON string literal, escaped quotes and all.
+_STRING = re.compile(r'"[^"\\]*(?:\\.[^"\\]*)*"')
+
+# Matches the whitespace that can come between a key and its value.
+_WHITESPACE = re.compile(r'[ \t\n\r]*')
+
+_decoder = json.JSONDecoder()
+
+# Marks a field that hasn't been looked up yet.
+_UNSET = object()
+
+# Classes.
+""" This class is a lazily decoded tweet.  It's built from the raw JSON that
+TwitterStreamListener.on_data() receives. """
+class TweetView(object):
+    __slots__ = ('raw', '_text', '_id_str', '_created_at', '_coordinates',
+        '_user', '_decoded')
+
+    # Fields that can be picked out of the raw tweet on their own.
+    fields = ('text', 'id_str', 'created_at', 'coordinates')
+
+    def __init__(self, raw):
+        self.raw = raw
+        self._text = _UNSET
+        self._id_str = _UNSET
+        self._created_at = _UNSET
+        self._coordinates = _UNSET
+        self._user = _UNSET
+        self._decoded = None
+
+    """ Returns the whole tweet as a dict, decoding it if it hasn't been
+    already. """
+    @property
+    def decoded(self):
+        if self._decoded is None:
+            self._decoded = json.loads(self.raw)
+        return self._decoded
+
+    """ Look up a top-level field of the tweet, decoding as little as
+    possible.  Returns None if the tweet doesn't have that field.  Unlike the
+    properties below, the value isn't cached. """
+    def field(self, key):
+        if self._decoded is None:
+            try:
+                return _top_level_value(self.raw, key)
+            except (KeyError, ValueError):
+                pass
+        return self.decoded.get(key)
+
+    @property
+    def text(self):
+        if self._text is _UNSET:
+            self._text = self.field('text')
+        return self._text
+
+    @property
+    def id_str(self):
+        if self._id_str is _UNSET:
+            self._id_str = self.field('id_str')
+        return self._id_str
+
+    @property
+    def created_at(self):
+        if self._created_at is _UNSET:
+            self._created_at = self.field('created_at')
+        return self._created_at
+
+    @property
+    def coordinates(self):
+        if self._coordinates is _UNSET:
+            self._coordinates = self.field('coordinates')
+        return self._coordinates
+
+    """ The user object of the tweet.  Only the user object gets decoded, not
+    the rest of the tweet. """
+    @property
+    def user(self):
+        if self._user is _UNSET:
+            self._user = self.field('user')
+        return self._user
+
+    @property
+    def screen_name(self):
+        user = self.user
+        if not user:
+            return None
+        return user.get('screen_name')
+
+    # Dict-style access, for code that expects a decoded tweet.
+    def __getitem__(self, key):
+        if key in self.fields:
+            value = getattr(self, key)
+            if value is not None or key in self.decoded:
+                return value
+        return self.decoded[key]
+
+    def get(self, key, default=None):
+        try:
+            return self[key]
+        except KeyError:
+            return default
+
+    def __contains__(self, key):
+        if key in self.fields and getattr(self, key) is not None:
+            return True
+        return key in self.decoded
+
+    # Pickling support, so that views can be passed between processes.
+    # Fields that haven't been looked up yet aren't sent.
+    def __getstate__(self):
+        state = {}
+        for slot in self.__slots__:
+            value = getattr(self, slot)
+            if value is not _UNSET:
+                state[slot] = value
+        return state
+
+    def __setstate__(self, state):
+        self.__init__(state.pop('raw'))
+        for (slot, value) in state.iteritems():
+            setattr(self, slot, value)
+
+""" Find a key in the top level of a raw JSON object and decode its value.
+Every occurrence of the key is checked to make sure it isn't inside of a
+string or a nested object by stripping the strings out of everything in
+front of it and counting the braces and brackets that are left.  Raises
+KeyError if the key isn't at the top level, or ValueError if the JSON is
+broken. """
+def _top_level_value(raw, key):
+    needle = '"%s":' % key
+    scanned = 0
+    objects = 0
+    arrays = 0
+    position = raw.find(needle)
+    while position >= 0:
+        # Only look at what's between this occurrence and the last one that
+        # wasn't inside of a string.
+        chunk = _STRING.sub('', raw[scanned:position])
+        if '"' not in chunk:
+            objects += chunk.count('{') - chunk.count('}')
+            arrays += chunk.count('[') - chunk.count(']')
+            scanned = position
+            if objects == 1 and not arrays:
+                start = _WHITESPACE.match(raw, position + len(needle)).end()
+                return _decoder.raw_decode(raw, start)[0]
+        position = raw.find(needle, position + 1)
+    raise KeyError(key)
+
+""" Decode function for TweetPipeline.  Wraps a raw tweet in a TweetView and
+looks up its text in the worker, so that the delivery thread doesn't have
+to. """
+def view_tweet(raw):
+    view = TweetView(raw)
+    view.text
+    return view
+
+""" Add up the memory taken by an object and everything it refers to. """
+def _deep_size(thing, seen=None):
+    if seen is None:
+        seen = set()
+    if id(thing) in seen:
+        return 0
+    seen.add(id(thing))
+    size = sys.getsizeof(thing)
+    if isinstance(thing, dict):
+        for (key, value) in thing.iteritems():
+            size += _deep_size(key, seen) + _deep_size(value, seen)
+    elif isinstance(thing, (list, tuple)):
+        for value in thing:
+            size += _deep_size(value, seen)
+    elif isinstance(thing, TweetView):
+        for slot in thing.__slots__:
+            value = getattr(thing, slot)
+            if value is not _UNSET:
+                size += _deep_size(value, seen)
+    return size
+
+# Core code...
+if __name__ == '__main__':
+    # Self tests.
+    tricky = json.dumps({"created_at": "Wed Aug 27 13:08:45 +0000 2014",
+        "quoted": "\"text\": \"not this one\" {",
+        "retweeted_status": {"text": "nor this one", "user": {}},
+        "id_str": "1234", "text": "This is a test tweet. #foo",
+        "user": {"screen_name": "drwho", "entities": {"text": "nope"}},
+        "coordinates": None})
+    view = TweetView(tricky)
+    assert view.text == "This is a test tweet. #foo"
+    assert view.id_str == "1234" and view.screen_name == "drwho"
+    assert view.coordinates is None and view._decoded is None
+    assert 'coordinates' in view
+    assert view['quoted'] == "\"text\": \"not this one\" {"
+    assert view.get('bogus') is None and 'bogus' not in view
+
+    deletion = TweetView('{"delete":{"status":{"id":1234,"id_str":"1234"}}}')
+    assert deletion.text is None and 'text' not in deletion
+
+    import cPickle
+    view = cPickle.loads(cPickle.dumps(view_tweet(tricky), 2))
+    assert view._text == "This is a test tweet. #foo" and view._user is _UNSET
+    assert view.screen_name == "drwho"
+
+    # Benchmark.
+    from tweetpipeline import load_payloads
+    payloads = load_payloads(sys.argv[1] if len(sys.argv) > 1 else None)
+    print "%d payloads, %d bytes on average." % (len(payloads),
+        sum(len(payload) for payload in payloads) / len(payloads))
+
+    def full_decode(payload):
+        tweet = json.loads(payload)
+        return (tweet, tweet.get('text'))
+
+    def view_text(payload):
+        view = TweetView(payload)
+        return (view, view.text)
+
+    def view_all(payload):
+        view = TweetView(payload)
+        return (view, (view.text, view.id_str, view.created_at,
+            view.coordinates, view.screen_name))
+
+    for (name, function) in (("json.loads()", full_decode),
+        ("TweetView, text only", view_text),
+        ("TweetView, all five fields", view_all)):
+        start = time.clock()
+        results = [function(payload) for payload in payloads]
+        elapsed = time.clock() - start
+        retained = sum(_deep_size(result[0]) for result in results[:1000])
+        print "%-28s %6.1f us of CPU and %6d bytes retained per tweet." % (
+            name, elapsed / len(payloads) * 1000000, retained / 1000)
+    sys.exit(0)
+# Fin.
@@ -7,17 +7,10 @@
 
 # TODO:
 # - Get replies to the user's account.
-# - Monitor trending topics and alert if specific search terms show up in the
-#   list.
-# - Monitor the activity of a particular user.  Archive the user's tweets for
-#   searching.
 # - Monitor the stream for a particular hashtag.  Scan for particular users or
 #   keywords.
 # - Add support for the Statusnet API.
 #   Twitter-compatible API: http://status.net/wiki/Twitter-compatible_API
-# - Make it possible to do a file:send to the bot of the user's tweet archive
-#   and it'll load the tweets.csv file into a database server it's connected
-#   to.
 # - Decide whether or not to serialize the list of currently active search
 #   terms to disk on shutdown or not.
 
@@ -28,19 +21,39 @@
 # Pre-requisite modules have their own licenses.
 
 # Load modules.
-import datetime
+from apigateway import APIGateway
+from commanddispatcher import command
+import csv
+from durablequeue import DurableTweetQueue
 from exocortex import ExocortexBot
-import json
 from multiprocessing import JoinableQueue
 import os
-import Queue
-import string
+import re
+import sqlite3
+from streambackfill import StreamBackfill
+from streamsupervisor import StreamSupervisor
 import sys
+import tempfile
+from termrouter import TermRouter
 import threading
+import time
+from trendscache import TrendsCache
+from trenddetector import TrendDetector
+from tweetarchive import TweetArchive
+from tweetdedup import TweetDeduplicator
+from tweetdigest import TweetDigest
+from tweetindex import TweetIndex
+from tweetpipeline import TweetPipeline
+from tweetqueue import BoundedTweetQueue
+from tweetrecord import record_tweet, TweetRecord
+from tweetstats import TweetStats
 import tweepy
 from tweepy import Stream
+from twitterhealth import TwitterHealth
 import twitterstreamlistener
 from twitterstreamlistener import TwitterStreamListener
+from usercache import UserCache
+from userwatcher import UserWatcher
 
 # Classes.
 """ This class implements an interface to the Twitter API which allows the bot
@@ -67,6 +80,18 @@ class TwitterBot(ExocortexBot):
     auth = ""
     api = ""
 
+    # Every call to the Twitter API goes through a gateway that keeps track
+    # of the rate limit of every endpoint and holds calls back until there's
+    # quota for them (see apigateway.py).  self.api makes interactive calls
+    # (the bot's owner is waiting for them) and self.background_api makes
+    # background calls, which wait their turn.
+    api_gateway = None
+    background_api = None
+
+    # Probes the Twitter API in the background so that 'twitter status' can
+    # be answered without any API calls (see twitterhealth.py).
+    health = None
+
     # Twitter developer account interface objects.  I don't have a better word
     # to describe this, so that's what it is for now.  Blame the "I'm screwing
     # around with this API" test script I wrote.
@@ -77,9 +102,51 @@ class TwitterBot(ExocortexBot):
     # monitoring thread should notice the changes and react accordingly.
     monitoring_terms = []
 
-    # Tweets picked out of the stream get put into a multiprocessing queue to
-    # be analyzed by another thread.
-    monitored_tweets = Queue.Queue()
+    # Tweets picked out of the stream get put into a bounded queue to be
+    # analyzed by another thread.  If that thread falls behind, the queue's
+    # overflow policy decides which tweets get thrown away (see
+    # tweetqueue.py).  Alternatively, the queue can spill to disk instead of
+    # throwing tweets away, and keep them when the bot shuts down (see
+    # durablequeue.py).
+    monitored_tweets = None
+    queue_backends = ('memory', 'disk')
+
+    # How many workers decode the tweets in the queue, whether they're
+    # threads or processes, and whether tweets are passed along in the order
+    # they arrived in (see tweetpipeline.py).
+    decode_workers = 1
+    decode_mode = TweetPipeline.THREAD
+    ordered_delivery = True
+
+    # Duplicate tweets and retweets are thrown away before they're decoded,
+    # unless the config file turns that off (see tweetdedup.py).
+    deduplicator = None
+
+    # Every tweet the bot sees (from the stream, searches, and user timelines)
+    # goes into a local full-text index so it can be searched again later
+    # (see tweetindex.py).
+    tweet_index = None
+
+    # Twitter users whose tweets are archived as they post them, and sent to
+    # the bot's owner (see userwatcher.py).
+    user_watcher = None
+
+    # Statistics about the tweets in the local archive are worked out from a
+    # columnar copy of them (see tweetstats.py).
+    tweet_stats = None
+
+    # The tweets.csv file from the bot's owner's Twitter archive can be
+    # imported into an SQLite database and searched (see tweetarchive.py).
+    # It can be sent to the bot by file transfer (XEP-0047), and the files
+    # that are on their way are kept here by stream ID.
+    my_tweets = None
+    incoming_archives = {}
+
+    # In digest mode, tweets from the stream aren't sent as they arrive.
+    # Instead, the bot sends a summary of each search term's matches every
+    # so often (see tweetdigest.py).
+    digest = None
+    digest_mode = False
 
     # A list of commands defined on bots descended from this particular class.
     # This list is inherited from the ExocortexBot base class, but is extended
@@ -90,7 +157,9 @@ class TwitterBot(ExocortexBot):
         'get my tweets', 'query user', 'query user activity/timeline',
         'monitor twitter for', 'list search terms',
         'stop listening for/delete search term', 'stop monitoring',
-        'delete search terms']
+        'delete search terms', 'search archive', 'digest mode on/off',
+        'digest interval', 'import archive', 'search my tweets', 'stats',
+        'local trends', 'watch user', 'unwatch user', 'list watched users']
     commands = commands + twitterbot_commands
 
     # API error catcher.
@@ -100,17 +169,49 @@ class TwitterBot(ExocortexBot):
     # this value for later commands.
     woeid = []
 
-    # It's easier to manipulate the threads if their pointers are outside
-    # of the context of the conditionals they're created in.
-    twitter_monitor = ""
+    # Cache of the places that have trending topics and their trends (see
+    # trendscache.py).
+    trends_cache = None
+
+    # Finds the words and hashtags that are spiking in the stream, and lets
+    # the bot's owner know when one of their search terms starts spiking
+    # (see trenddetector.py).
+    trend_detector = None
+
+    # Cache of the profiles and timelines of users the bot's been asked about
+    # (see usercache.py).
+    user_cache = None
+
+    # The connection to Twitter's streaming API is owned by a supervisor,
+    # which reconnects it whenever the list of search terms changes (see
+    # streamsupervisor.py).  The queue processor thread is started the first
+    # time the bot is told to monitor Twitter and runs until the bot shuts
+    # down.
+    stream_supervisor = None
     queue_processor = ""
 
+    # When the stream comes back after dropping, the tweets it missed while it
+    # was down are searched for and pushed into the queue (see
+    # streambackfill.py).
+    stream_backfill = None
+
+    # Works out which of the search terms each tweet from the stream matched
+    # (see termrouter.py).  Search terms can use "quoted phrases", #hashtags,
+    # and -words to rule out, which Twitter's stream doesn't understand, so
+    # the router has the final say on whether a tweet matched.
+    term_router = None
+
     """ Default constructor for the TwitterBot class.  Inherits much of its
     code from ExocortexBot.__init__(), and in fact calls it to set up the
     basic stuff. """
     def __init__(self, owner, botname, jid, password, room, room_announcement,
         imalive, responsefile, function, api_key, api_secret, access_token,
-        access_token_secret):
+        access_token_secret, tweet_queue_size=10000,
+        tweet_queue_policy=BoundedTweetQueue.DROP_OLDEST, decode_workers=1,
+        decode_mode=TweetPipeline.THREAD, tweet_archive=None,
+        dedup_capacity=100000, dedup_error_rate=0.001,
+        tweet_queue_backend='memory', tweet_queue_directory=None,
+        tweet_database=None, deduplicate=True, near_duplicates=False):
 
         # Copy the TwitterBot-specific constructor args into class attributes
         # to make them easier to work with.
@@ -119,16 +220,89 @@ class TwitterBot(ExocortexBot):
         self.access_token = access_token
         self.access_token_secret = access_token_secret
 
+        # Set up the queue that the stream listener pushes tweets into.  The
+        # disk-backed queue keeps tweet_queue_size tweets in memory and goes
+        # in a directory named after the bot unless the config file says
+        # otherwise.
+        if tweet_queue_backend not in self.queue_backends:
+            raise ValueError("Unknown tweet queue backend '%s'.  Choose from %s." % (tweet_queue_backend, ", ".join(self.queue_backends)))
+        if tweet_queue_backend == 'disk':
+            if not tweet_queue_directory:
+                tweet_queue_directory = botname.lower() + ".queue"
+            self.monitored_tweets = DurableTweetQueue(tweet_queue_directory,
+                tweet_queue_size)
+        else:
+            self.monitored_tweets = BoundedTweetQueue(tweet_queue_size,
+                tweet_queue_policy)
+        self.decode_workers = decode_workers
+        self.decode_mode = decode_mode
+        if deduplicate:
+            self.deduplicator = TweetDeduplicator(dedup_capacity,
+                dedup_error_rate, near_duplicates)
+
+        # Open the index of tweets the bot has seen.  It goes in a directory
+        # named after the bot unless the config file says otherwise.
+        if not tweet_archive:
+            tweet_archive = botname.lower() + ".tweets"
+        self.tweet_index = TweetIndex(tweet_archive)
+        self.tweet_stats = TweetStats(os.path.join(tweet_archive,
+            "stats.npz"))
+
+        # Open the database of the bot's owner's own tweets.  It's named
+        # after the bot unless the config file says otherwise.
+        if not tweet_database:
+            tweet_database = botname.lower() + ".sqlite"
+        self.my_tweets = TweetArchive(tweet_database)
+        self.incoming_archives = {}
+
+        # Set up the digests of monitored search terms.
+        self.digest = TweetDigest(lambda: self.monitoring_terms,
+            self._send_digest)
+
+        # Set up the detector of spiking terms in the stream.
+        self.trend_detector = TrendDetector(self._term_spiking)
+
         # Call the base class' constructor.
         ExocortexBot.__init__(self, owner, botname, jid, password, room,
             room_announcement, imalive, responsefile, function)
 
+        # Accept tweets.csv files sent by file transfer.
+        self.register_plugin('xep_0047', {'auto_accept': True})
+        self.add_event_handler("ibb_stream_start", self._archive_start)
+        self.add_event_handler("ibb_stream_data", self._archive_data)
+        self.add_event_handler("ibb_stream_end", self._archive_end)
+
         # Authenticate with the Twitter API server.
         self.auth = tweepy.OAuthHandler(self.api_key, self.api_secret)
         self.auth.set_access_token(self.access_token, self.access_token_secret)
 
-        # Create an API interface object.
-        self.api = tweepy.API(self.auth)
+        # Create an API interface object, and route it through the gateway.
+        self.api_gateway = APIGateway(tweepy.API(self.auth))
+        self.api = self.api_gateway.client(APIGateway.INTERACTIVE,
+            self._rate_limited)
+        self.background_api = self.api_gateway.client(APIGateway.BACKGROUND)
+        self.health = TwitterHealth(self.background_api)
+        self.trends_cache = TrendsCache(self.api)
+        self.user_cache = UserCache(self.api, TweetRecord.from_status)
+
+        # Set up the supervisor of the stream.  Every connection gets a new
+        # listener that pushes tweets into the same queue, and reconnections
+        # after a drop are backfilled from the search API.
+        self.stream_backfill = StreamBackfill(self.background_api,
+            self.monitored_tweets)
+        self.stream_supervisor = StreamSupervisor(
+            lambda supervisor: TwitterStreamListener(self.monitored_tweets,
+                self.monitoring_terms, self, supervisor),
+            lambda listener: Stream(self.auth, listener),
+            backfill=self._backfill_stream)
+        self.term_router = TermRouter()
+
+        # Start watching the users that were being watched the last time the
+        # bot ran.  The list is kept with the archive of tweets.
+        self.user_watcher = UserWatcher(self.background_api,
+            self._archive_tweets, self._watched_user_tweeted,
+            TweetRecord.from_status,
+            os.path.join(self.tweet_index.directory, "watched.json"))
 
         # Create an interface to the bot's owner's Twitter dev account.
         try:
@@ -140,401 +314,500 @@ class TwitterBot(ExocortexBot):
             self.send_message(mto=self.owner,
                 mbody="Unable to contact Twitter API server.  Error message: %s.  Retrying..." % api_error.reason)
 
-    """ Event handler that fires whenever a message is sent to this JID. The
-    argument 'msg' represents a message stanza.  This method implements
-    Twitter-specific commands. """
-    def message(self, msg, threaded=True):
-        # Potential message types: normal, chat, error, headline, groupchat
-        if msg['type'] in ('chat', 'normal'):
-            # Extract whom the message came from.
-            msg_from = str(msg.getFrom())
-            msg_from = string.split(msg_from, '/')[0]
-
-            # If the message did not come from the bot's owner, ignore by
-            # bouncing out of this method.
-            if msg_from != self.owner:
-                return
-
-            # To make parsing easier, lowercase the message body before matching
-            # against it.
-            message = msg['body'].lower()
-
-            # Parse the message text for commands.
-            # Class-specific help message
-            if "help" in message:
-                self.send_message(mto=msg['from'],
-                    mbody="Hello.  My name is %s.  %s  In addition to the usual ExocortexBot commands, I also support the following specialized commands:\n\n%s\n" % (self.botname, self.function, str(self.commands)))
-                self.send_message(mto=msg['from'],
-                    mbody="You can search Twitter for hashtags or arbitrary terms with the commands 'search hashtag #somehashtag' or 'search for somesearchterm'.\n")
-                self.send_message(mto=msg['from'],
-                    mbody="You can post something to Twitter with the commands 'post tweet <140 characters here>' or 'post to twitter <140 characters here>'.\n")
-                self.send_message(mto=msg['from'],
-                    mbody="You can search Twitter for trending topics around the world with the commands 'list trends <geographic location>' or 'find trends <geographic location>'.\n")
-                self.send_message(mto=msg['from'],
-                    mbody="You can follow trends on Twitter with the command 'follow trend <keyword>'.\n")
-                self.send_message(mto=msg['from'],
-                    mbody="You can query a Twitter user's profile with the command 'query user <Twitter username>'.\n")
-                self.send_message(mto=msg['from'],
-                    mbody="You can query a Twitter user's recent activity with the command 'query user activity <Twitter username> <number of tweets (default: 20)>' or 'query user timeline <username> <number of tweets>' .\n")
-                self.send_message(mto=msg['from'],
-                    mbody="You can set up a near-realtime search of arbitrary terms and hashtags on Twitter with the command 'monitor twitter for <search term>'.  Multiple search terms can be monitored for simultaneously.\n")
-                self.send_message(mto=msg['from'],
-                    mbody="You can list the currently active search terms with the command 'list search terms'.\n")
-                self.send_message(mto=msg['from'],
-                    mbody="Search terms can be dropped with the commands 'stop listening for <term>', or 'delete search term <term>'.\n")
-                self.send_message(mto=msg['from'],
-                    mbody="I can be told to stop monitoring with the commands 'stop monitoring' or 'delete search terms'.\n")
-                return
+    """ Class-specific help message. """
+    @command('help')
+    def _help(self, msg, message):
+        self.send_message(mto=msg['from'],
+            mbody="Hello.  My name is %s.  %s  In addition to the usual ExocortexBot commands, I also support the following specialized commands:\n\n%s\n" % (self.botname, self.function, str(self.commands)))
+        self.send_message(mto=msg['from'],
+            mbody="You can search Twitter for hashtags or arbitrary terms with the commands 'search hashtag #somehashtag' or 'search for somesearchterm'.\n")
+        self.send_message(mto=msg['from'],
+            mbody="You can post something to Twitter with the commands 'post tweet <140 characters here>' or 'post to twitter <140 characters here>'.\n")
+        self.send_message(mto=msg['from'],
+            mbody="You can search Twitter for trending topics around the world with the commands 'list trends <geographic location>' or 'find trends <geographic location>'.\n")
+        self.send_message(mto=msg['from'],
+            mbody="You can follow trends on Twitter with the command 'follow trend <keyword>'.\n")
+        self.send_message(mto=msg['from'],
+            mbody="You can see which words and hashtags are spiking in the tweets I'm monitoring right now (without asking Twitter) with the command 'local trends'.  I'll also let you know when one of your search terms starts spiking.\n")
+        self.send_message(mto=msg['from'],
+            mbody="You can query a Twitter user's profile with the command 'query user <Twitter username>'.\n")
+        self.send_message(mto=msg['from'],
+            mbody="You can query a Twitter user's recent activity with the command 'query user activity <Twitter username> <number of tweets (default: 20)>' or 'query user timeline <username> <number of tweets>' .\n")
+        self.send_message(mto=msg['from'],
+            mbody="You can watch what a Twitter user posts with the command 'watch user <Twitter username>'.  I'll archive their tweets and send you the new ones every few minutes.  Stop with the command 'unwatch user <Twitter username>', and see who's being watched with the command 'list watched users'.\n")
+        self.send_message(mto=msg['from'],
+            mbody="You can set up a near-realtime search of arbitrary terms and hashtags on Twitter with the command 'monitor twitter for <search term>'.  Multiple search terms can be monitored for simultaneously.  A search term matches tweets that contain all of its words.  Put \"quotes\" around words that have to appear together, and a minus sign in front of words that must not appear (e.g., 'monitor twitter for \"exocortex project\" -spam').\n")
+        self.send_message(mto=msg['from'],
+            mbody="You can list the currently active search terms with the command 'list search terms'.\n")
+        self.send_message(mto=msg['from'],
+            mbody="Search terms can be dropped with the commands 'stop listening for <term>', or 'delete search term <term>'.\n")
+        self.send_message(mto=msg['from'],
+            mbody="I can be told to stop monitoring with the commands 'stop monitoring' or 'delete search terms'.\n")
+        self.send_message(mto=msg['from'],
+            mbody="You can search every tweet I've seen so far (from the stream, searches, and user timelines) with the command 'search archive <search terms>'.\n")
+        self.send_message(mto=msg['from'],
+            mbody="You can get statistics about the tweets I've archived (when they were posted, how often they were retweeted, and the hashtags, terms, and users they mention) for one user, for a search term, or for everything, with the command 'stats <@username or search term>'.\n")
+        self.send_message(mto=msg['from'],
+            mbody="You can import the tweets.csv file from your Twitter archive (see 'get my tweets') by sending it to me, or with the command 'import archive <path to tweets.csv>' if it's on the machine I'm running on.  Search it with the command 'search my tweets <search terms>'.\n")
+        self.send_message(mto=msg['from'],
+            mbody="Instead of sending every tweet that matches your search terms, I can send you a digest of each search term every so often.  Turn this on and off with the commands 'digest mode on' and 'digest mode off', and set how often digests are sent with the command 'digest interval <seconds>'.\n")
+        return
 
-            # The user wants only the status of the Twitter connection.
-            if 'twitter status' in message:
-                self.send_message(mto=msg['from'],
-                    mbody="Polling Twitter status.  Please wait...")
-                status = self._twitter_status()
-                self.send_message(mto=msg['from'], mbody=status)
-                return
+    """ The user wants only the status of the Twitter connection. """
+    @command('twitter status')
+    def _twitter_status_command(self, msg, message):
+        status = self._twitter_status()
+        self.send_message(mto=msg['from'], mbody=status)
+        return
 
-            # The user wants to execute a hashtag search.
-            if 'search hashtag' in message or 'search for' in message:
-                hashtag = message.split()[-1]
-                if hashtag == 'hashtag':
-                    self.send_message(mto=self.owner,
-                        mbody="No hashtag was specified.")
-                    return
-                else:
-                    self.send_message(mto=self.owner,
-                        mbody="Executing search for term %s.  Just a moment." %
-                        hashtag)
-                hashtag_results = self.api.search(q=hashtag,
-                    result_type='recent')
-                number_of_results = len(hashtag_results)
-
-                # If nothing came back, bounce.
-                if not number_of_results:
-                    response = "No results were returned for search on " + hashtag + ".'"
-                    self.send_message(mto=self.owner, mbody=response)
-                    return
-                else:
-                    response = str(number_of_results) + " tweets were found."
-                    self.send_message(mto=self.owner, mbody=response)
-
-                # Build response and send back to user.
-                response = ""
-                for tweet in hashtag_results:
-                    response_line = "@" + tweet.user.name + ": " + tweet.text + "\n" + "Retweeted " + str(tweet.retweet_count) + " times.\n\n"
-                    response = response + response_line
-                self.send_message(mto=self.owner, mbody=response)
-                return
+    """ The user wants to execute a hashtag search. """
+    @command('search hashtag', 'search for')
+    def _search(self, msg, message):
+        hashtag = message.split()[-1]
+        if hashtag == 'hashtag':
+            self.send_message(mto=self.owner,
+                mbody="No hashtag was specified.")
+            return
+        else:
+            self.send_message(mto=self.owner,
+                mbody="Executing search for term %s.  Just a moment." %
+                hashtag)
+        hashtag_results = self.api.search(q=hashtag,
+            result_type='recent')
+        hashtag_results = map(TweetRecord.from_status, hashtag_results)
+        self._archive_tweets(hashtag_results)
+        number_of_results = len(hashtag_results)
+
+        # If nothing came back, bounce.
+        if not number_of_results:
+            response = "No results were returned for search on " + hashtag + ".'"
+            self.send_message(mto=self.owner, mbody=response)
+            return
+        else:
+            response = str(number_of_results) + " tweets were found."
+            self.send_message(mto=self.owner, mbody=response)
+
+        # Build response and send back to user.
+        response = ""
+        for tweet in hashtag_results:
+            response_line = "@" + tweet.name + ": " + tweet.text + "\n" + "Retweeted " + str(tweet.retweet_count) + " times.\n\n"
+            response = response + response_line
+        self.send_message(mto=self.owner, mbody=response)
+        return
 
-            # The user wants to update their Twitter timeline.
-            if 'post tweet' in message or 'post to twitter' in message:
-                # Remove the command from the message.
-                if 'post tweet' in message:
-                    message = message.replace('post tweet', '')
-                if 'post to twitter' in message:
-                    message = message.replace('post to twitter', '')
-                message = message.strip()
-
-                # Do some sanity checking - if the tweet's longer than 140
-                # characters, don't bother trying.
-                if len(message) > 140:
-                    self.send_message(mto=self.owner,
-                        mbody="Your message is longer than 140 characters.  I can't post this.")
-                    return
-
-                # Post the message to Twitter.
-                self.send_message(mto=msg['from'],
-                    mbody="Posting message to Twitter.  Please wait...")
-                posted_to_twitter = self._post_to_twitter(message)
-                if posted_to_twitter == True:
-                    self.send_message(mto=self.owner,
-                        mbody="Status update successfully posted to Twitter.")
-                return
+    """ The user wants to search the tweets the bot has already seen. """
+    @command('search archive')
+    def _search_archive(self, msg, message):
+        query = message.replace('search archive', '').strip()
+        if not query:
+            self.send_message(mto=self.owner,
+                mbody="You need to specify something to search for.")
+            return
 
-            # The user wants a list of trending topics on Twitter.
-            if 'list trends' in message or 'find trends' in message:
-                # Reset the list of WOEID's.
-                self.woeid = []
-
-                # Strip the command string out of the message, leaving only
-                # the keywords we want to work with.
-                message = message.replace('list trends', '')
-                message = message.replace('find trends', '')
-                message = message.strip()
-                location = message.title()
-
-                # If the user asks for help or does not give a location,
-                # send a help message.
-                if message == 'help' or message == '':
-                    self.send_message(mto=self.owner,
-                        mbody="Twitter maps trending topics by geographic location, so this command must be used with the name of a Country or city.")
-                    return
-
-                # Inform the user that the search is about to begin.
-                self.send_message(mto=self.owner,
-                    mbody="Searching trending topics on Twitter for %s..." %
-                           location)
-
-                # Pull the current database of trending locations around the
-                # world from the API server.  This is usually in the ballpark
-                # of 100kb.
-                try:
-                    trending_locations = self.api.trends_available()
-                except tweepy.error.TweepError as api_error:
-                    self.send_message(mto=self.owner,
-                        mbody="Unable to contact Twitter API server.  Error message: %s." % api_error.reason)
-                    return
-
-                # Search for the named location in that database.  There are
-                # two possible fields that it can appear in, either in
-                # 'country' or in 'name' (which can be either the name of the
-                # country or a more specific place in that country).  Store
-                # the WOEID's in a list.
-                for locale in trending_locations:
-                    if locale['country'] == location:
-                        if locale['woeid'] not in self.woeid:
-                            self.woeid.append(locale['woeid'])
-                    if locale['name'] == location:
-                        if locale['woeid'] not in self.woeid:
-                            self.woeid.append(locale['woeid'])
-
-                # Send a response back to the user.  If there are no results,
-                # there's no sense in going through the rest of the method.
-                if not len(self.woeid):
-                    response = "There are currently no trending topics in " + location + " at this time."
-                    self.send_message(mto=self.owner, mbody=response)
-                    return
-
-                # There are results, so treat them appropriately.
-                if len(self.woeid) == 1:
-                    response = "There is one trending topic in " + location + " at this time."
-                if len(self.woeid) > 1:
-                    response = "There are " + str(len(self.woeid)) + " trending topics in " + location + " at this time."
-                self.send_message(mto=self.owner, mbody=response)
-
-                # Query the API server for as many trending terms (Twitter
-                # limits this to 10) as we can get for every WOEID.
-                response = "The following terms are trending in location:\n"
-                for locale in self.woeid:
-                    try:
-                        trends = self.api.trends_place(id=locale)
-                    except tweepy.error.TweepError as api_error:
-                        self.send_message(mto=self.owner,
-                            mbody="Unable to contact Twitter API server.  Error message: %s." % api_error.reason)
-                        return
-
-                    # Walk through the list of trending locations and assemble
-                    # a list of terms and URLs that the user can click on to
-                    # look at the lists of tweets.
-                    for i in trends[0]['trends']:
-                        response = response + "Trending term: " + i['name']
-                        response = response + "  URL: " + i['url'] + "\n"
-
-                # Send the response back to the user.
-                self.send_message(mto=self.owner, mbody=response)
-                return
+        start = time.time()
+        results = self.tweet_index.search(query)
+        elapsed = (time.time() - start) * 1000
+        if not results:
+            self.send_message(mto=self.owner,
+                mbody="No archived tweets match '%s'.  (%d tweets searched in %.1f ms.)" % (query, len(self.tweet_index), elapsed))
+            return
 
-            # The user asks to have their content archive downloaded from
-            # Twitter.  The bot can't do that, but it can tell you how to do
-            # that.
-            if "get archive" in message or "get tweets" in message or "get my tweets" in message:
-                self._get_my_tweets()
-                return
+        response = "The %d best matches for '%s' out of %d archived tweets (%.1f ms):\n\n" % (len(results), query, len(self.tweet_index), elapsed)
+        for (score, id_str, created_at, screen_name, text) in results:
+            record = TweetRecord(id_str, created_at, text)
+            response = response + "@" + str(screen_name) + " (" + record.created_at_string() + "): " + text + "\n\n"
+        self.send_message(mto=self.owner, mbody=response)
+        return
 
-            # Query a user's recent timeline activity.
-            if "query user activity" in message or 'query user timeline' in message:
-                # Extract the user's Twitter username and number of tweets to
-                # pull.
-                message = message.replace('query user activity', '')
-                message = message.replace('query user timeline', '')
-                queried_user = message.split(' ')[1].strip()
-
-                # This is a little hacky, but I can't think of a better way
-                # to take into account situations where the user doesn't
-                # supply the number of tweets to pull.
-                number_of_tweets = ""
-                try:
-                    number_of_tweets = message.split()[2].strip()
-                    number_of_tweets = int(number_of_tweets)
-                except:
-                    number_of_tweets = 20
-
-                # Sanity check the number of tweets the user is asking for.
-                if number_of_tweets < 0:
-                    self.send_message(mto=self.owner, mbody="ERROR: You cannot request a negative number of tweets.  That doesn't make any sense.")
-                    return
-                if number_of_tweets > 3200:
-                    self.send_message(mto=self.owner, mbody="ERROR: The Twitter API server limits the number of tweets you can request from someone's timeline to 3200.")
-                    return
-                self._query_user_activity(queried_user, number_of_tweets)
-                return
+    """ The user wants statistics about the tweets the bot has archived, for a
+    user (@someone), a search term, or everything. """
+    @command('stats')
+    def _stats(self, msg, message):
+        subject = message.replace('stats', '', 1).strip()
+        start = time.time()
+        report = self.tweet_stats.report(subject)
+        elapsed = (time.time() - start) * 1000
+        self.send_message(mto=msg['from'],
+            mbody="%s\n(%d archived tweets analyzed in %.1f ms.)" % (report, len(self.tweet_stats), elapsed))
+        return
 
-            # Query a user's profile.
-            if "query user" in message:
-                # Extract the Twitter username
-                queried_user = message.replace('query user', '').strip()
-                self._query_user(queried_user)
-                return
+    """ The user wants to import the tweets.csv file from their Twitter archive
+    from a file on the machine the bot is running on.  'message' has been
+    lowercased, and filenames are case sensitive, so the filename comes out
+    of the original message. """
+    @command('import archive')
+    def _import_archive_command(self, msg, message):
+        match = re.search(r'import archive(.*)', msg['body'],
+            re.IGNORECASE | re.DOTALL)
+        filename = os.path.expanduser(match.group(1).strip()) if match \
+            else ""
+        if not filename:
+            self.send_message(mto=self.owner,
+                mbody="You need to tell me where your tweets.csv file is.")
+            return
+        if not os.path.isfile(filename):
+            self.send_message(mto=self.owner,
+                mbody="I can't find the file %s." % filename)
+            return
+        self._import_archive(filename)
+        return
 
-            # The user asks the bot to monitor Twitter for a particular search
-            # term.  The search term goes into the list of terms.  If the size
-            # of the list is suddenly non-zero, spawn the listener and
-            # processor threads to make it happen.
-            if "monitor twitter for" in message:
-                term = message.replace('monitor twitter for', '').strip()
-                if not term:
-                    self.send_message(mto=self.owner,
-                        mbody="You need to specify a search term.")
-                    return
-
-                # Determine whether or not the threads are running based upon
-                # the size of the list of search terms.
-                threads_running = threading.activeCount()
-                print "\n\nNumber of threads running: " + str(threads_running) + "\n\n"
-
-                # See if the new search term needs to be added to the list of
-                # things to watch for.
-                if term not in self.monitoring_terms:
-                    self.monitoring_terms.append(term)
-                    self.send_message(mto=self.owner,
-                        mbody="Added search term '%s' to the list of things to monitor Twitter for." % term)
-                else:
-                    self.send_message(mto=self.owner,
-                        mbody="I'm already monitoring Twitter for the search term '%s'." % term)
-                    return
-
-                if not self.twitter_monitor and not self.queue_processor:
-                    print "\n\nNo Twitter monitoring threads running.\n\n"
-
-                    # Instantiate a Twitter stream listener thread.
-                    print "\n\nInstantiating Twitter monitoring thread.\n\n"
-                    listener = TwitterStreamListener(self.monitored_tweets,
-                        self.monitoring_terms, self)
-                    twitter_stream = Stream(self.auth, listener)
-                    twitter_stream.filter(track=self.monitoring_terms)
-                    self.twitter_monitor = threading.Thread(
-                        target=twitter_stream,
-                        name="TwitterBotStreamListener")
-                    self.twitter_monitor.daemon = True
-                    self.twitter_monitor.start()
-
-                    if self.twitter_monitor:
-                        print "\n\nStarted thread self.twitter_monitor.\n\n"
-                    else:
-                        print "\n\nUnable to start thread self.twitter_monitor.\n\n"
-
-                    # Instantiate a queue processor thread to process the
-                    # captured tweets and message the bot's owner.
-                    print "\n\nInstantiating tweet queue monitoring thread.\n\n"
-                    self.queue_processor = threading.Thread(
-                        target=self._tweet_queue_processor,
-                        name="TwitterBotQueueProcessor",
-                        args=(self.monitored_tweets, ))
-                    self.queue_processor.daemon = True
-                    self.queue_processor.start()
-
-                    if self.queue_processor:
-                        print "\n\nStarted thread self.queue_processor.\n\n"
-                    else:
-                        print "\n\nUnable to start thread self.queue_processor.\n\n"
-
-                    self.send_message(mto=self.owner,
-                        mbody="Now monitoring Twitter's live stream for your search terms.  I'll send them to you as they arrive.")
-                return
+    """ The user wants to search the tweets they've imported. """
+    @command('search my tweets')
+    def _search_my_tweets(self, msg, message):
+        query = message.replace('search my tweets', '').strip()
+        if not query:
+            self.send_message(mto=self.owner,
+                mbody="You need to specify something to search for.")
+            return
+        try:
+            results = self.my_tweets.search(query)
+        except sqlite3.Error as error:
+            self.send_message(mto=self.owner,
+                mbody="Unable to search your tweets: %s." % error)
+            return
+        if not results:
+            self.send_message(mto=self.owner,
+                mbody="None of your %d imported tweets match '%s'." % (len(self.my_tweets), query))
+            return
 
-            # The user asks for the list of active search terms.
-            if "list search terms" in message:
-                if len(self.monitoring_terms):
-                    response = "Currently active search terms: " + str(self.monitoring_terms)
-                else:
-                    response = "There are no search terms set at this time."
-                self.send_message(mto=self.owner, mbody=response)
-                return
+        response = "The %d most recent of your tweets that match '%s':\n\n" % (len(results), query)
+        for (tweet_id, timestamp, text) in results:
+            record = TweetRecord(str(tweet_id), timestamp, text)
+            response = response + record.created_at_string() + ": " + text + "\n\n"
+        self.send_message(mto=self.owner, mbody=response)
+        return
 
-            # Clear the list of search terms.
-            if "stop monitoring" in message or "delete search terms" in message:
-                # Sanity check: If the bot isn't listening for anything in
-                # particular at the moment don't do anything.
-                if not len(self.monitoring_terms):
-                    self.send_message(mto=self.owner,
-                        mbody="There are no active search terms.")
-                    return
-
-                # Establish the termination sentinels.
-                self.monitoring_terms = []
-                self.monitored_tweets.put(None)
-
-                # Catch the threads we spawned.
-                self.twitter_monitor.join(10.0)
-                self.queue_processor.join(10.0)
-                self.twitter_monitor = None
-                self.queue_processor = None
-                self.send_message(mto=self.owner,
-                    mbody="Active search terms deleted.")
-                return
+    """ The user wants to update their Twitter timeline. """
+    @command('post tweet', 'post to twitter')
+    def _post_tweet(self, msg, message):
+        # Remove the command from the message.
+        if 'post tweet' in message:
+            message = message.replace('post tweet', '')
+        if 'post to twitter' in message:
+            message = message.replace('post to twitter', '')
+        message = message.strip()
+
+        # Do some sanity checking - if the tweet's longer than 140
+        # characters, don't bother trying.
+        if len(message) > 140:
+            self.send_message(mto=self.owner,
+                mbody="Your message is longer than 140 characters.  I can't post this.")
+            return
 
-            # Delete a search term from the list.
-            if "stop listening for" in message or "delete search term" in message:
-                # Clean out the possible commands to leave the arguments.
-                term = message.replace('stop listening for', '').strip()
-                term = message.replace('delete search term', '').strip()
-                if not term:
-                    self.send_message(mto=self.owner,
-                        mbody="You need to specify a search term.")
-                    return
-                try:
-                    self.monitoring_terms.remove(term)
-                except:
-                    self.send_message(mto=self.owner,
-                        mbody="That search term doesn't exist.")
-                self.send_message(mto=self.owner,
-                    mbody="Search term %s removed." % term)
-
-                # If the size of the list of search terms is now zero, push a
-                # termination sentinel into the queue.
-                if not len(self.monitoring_terms):
-                    self.monitored_tweets.put(None)
-                    self.send_message(mto=self.owner,
-                         mbody="The list of terms to monitor for is empty.")
-                    self.twitter_monitor.join()
-                    self.queue_processor.join()
-                    self.twitter_monitor = None
-                    self.queue_processor = None
-                return
+        # Post the message to Twitter.
+        self.send_message(mto=msg['from'],
+            mbody="Posting message to Twitter.  Please wait...")
+        posted_to_twitter = self._post_to_twitter(message)
+        if posted_to_twitter == True:
+            self.send_message(mto=self.owner,
+                mbody="Status update successfully posted to Twitter.")
+        return
 
-            # Class-specific commands out of the way, call the message parser of
-            # the base class.
-            ExocortexBot.message(self, msg)
+    """ The user wants to know what's spiking in the stream right now. """
+    @command('local trends')
+    def _local_trends(self, msg, message):
+        self.send_message(mto=msg['from'],
+            mbody=self.trend_detector.report())
+        return
 
-    """ This method only displays the status of the Twitter API server
-    connection.  It can be called by self._process_status() but doesn't have
-    to be. """
-    def _twitter_status(self):
-        number_of_followers = ""
-        status = ""
+    """ The user wants a list of trending topics on Twitter. """
+    @command('list trends', 'find trends')
+    def _list_trends(self, msg, message):
+        # Reset the list of WOEID's.
+        self.woeid = []
+
+        # Strip the command string out of the message, leaving only
+        # the keywords we want to work with.
+        message = message.replace('list trends', '')
+        message = message.replace('find trends', '')
+        message = message.strip()
+        location = message.title()
+
+        # If the user asks for help or does not give a location,
+        # send a help message.
+        if message == 'help' or message == '':
+            self.send_message(mto=self.owner,
+                mbody="Twitter maps trending topics by geographic location, so this command must be used with the name of a Country or city.")
+            return
 
-        # Query the number of followers the user's account has.  If the query
-        # goes through the Twitter API connection is up.
+        # Inform the user that the search is about to begin.
+        self.send_message(mto=self.owner,
+            mbody="Searching trending topics on Twitter for %s..." %
+                   location)
+
+        # Look the location up in the database of trending locations around
+        # the world.  It can be either the name of a country or a more
+        # specific place in that country.  The database is only downloaded
+        # from the API server (it's usually in the ballpark of 100kb) when
+        # the cached copy is out of date.
         try:
-            number_of_followers = len(self.api.followers())
+            self.woeid = self.trends_cache.woeids(location)
         except tweepy.error.TweepError as api_error:
-            return "ERROR: " + api_error.reason
-        if number_of_followers:
-            status = self.botname + " has an active connection to the Twitter API service.\n"
+            self.send_message(mto=self.owner,
+                mbody="Unable to contact Twitter API server.  Error message: %s." % api_error.reason)
+            return
 
-        # Query the number of API requests available in this 60 minute
-        # timespan and when the hit counter will reset.
+        # Send a response back to the user.  If there are no results,
+        # there's no sense in going through the rest of the method.
+        if not len(self.woeid):
+            response = "There are currently no trending topics in " + location + " at this time."
+            self.send_message(mto=self.owner, mbody=response)
+            return
+
+        # There are results, so treat them appropriately.
+        if len(self.woeid) == 1:
+            response = "There is one trending topic in " + location + " at this time."
+        if len(self.woeid) > 1:
+            response = "There are " + str(len(self.woeid)) + " trending topics in " + location + " at this time."
+        self.send_message(mto=self.owner, mbody=response)
+
+        # Query the API server for as many trending terms (Twitter
+        # limits this to 10) as we can get for every WOEID.  The ones that
+        # aren't cached are requested all at once.
         try:
-            limit_status = self.api.rate_limit_status()
+            trends_by_place = self.trends_cache.trends(self.woeid)
         except tweepy.error.TweepError as api_error:
-            return "ERROR: " + api_error.reason
-
-        # Assemble the status message to transmit to the bot's owner.
-        hits_remaining = limit_status['resources']['application']['/application/rate_limit_status']['remaining']
-        hits_reset = limit_status['resources']['application']['/application/rate_limit_status']['reset']
-        reset_time = datetime.datetime.fromtimestamp(int(hits_reset)).strftime('%H:%M:%S hours on %Y/%m/%d')
-        status = status + "This bot has " + str(hits_remaining) + " API hits remaining until Twitter temporarily cuts it off.\n"
-        status = status + "The API hit counter will refresh at " + reset_time + "."
+            self.send_message(mto=self.owner,
+                mbody="Unable to contact Twitter API server.  Error message: %s." % api_error.reason)
+            return
+
+        response = "The following terms are trending in location:\n"
+        for (locale, trends) in trends_by_place:
+            # Walk through the list of trending locations and assemble
+            # a list of terms and URLs that the user can click on to
+            # look at the lists of tweets.
+            for i in trends[0]['trends']:
+                response = response + "Trending term: " + i['name']
+                response = response + "  URL: " + i['url'] + "\n"
+
+        # Send the response back to the user.
+        self.send_message(mto=self.owner, mbody=response)
+        return
+
+    """ The user asks to have their content archive downloaded from Twitter.  The
+    bot can't do that, but it can tell you how to do that. """
+    @command('get archive', 'get tweets', 'get my tweets')
+    def _get_archive(self, msg, message):
+        self._get_my_tweets()
+        return
+
+    """ Query a user's recent timeline activity. """
+    @command('query user activity', 'query user timeline')
+    def _query_user_activity_command(self, msg, message):
+        # Extract the user's Twitter username and number of tweets to
+        # pull.
+        message = message.replace('query user activity', '')
+        message = message.replace('query user timeline', '')
+        queried_user = message.split(' ')[1].strip()
+
+        # This is a little hacky, but I can't think of a better way
+        # to take into account situations where the user doesn't
+        # supply the number of tweets to pull.
+        number_of_tweets = ""
+        try:
+            number_of_tweets = message.split()[2].strip()
+            number_of_tweets = int(number_of_tweets)
+        except:
+            number_of_tweets = 20
+
+        # Sanity check the number of tweets the user is asking for.
+        if number_of_tweets < 0:
+            self.send_message(mto=self.owner, mbody="ERROR: You cannot request a negative number of tweets.  That doesn't make any sense.")
+            return
+        if number_of_tweets > 3200:
+            self.send_message(mto=self.owner, mbody="ERROR: The Twitter API server limits the number of tweets you can request from someone's timeline to 3200.")
+            return
+        self._query_user_activity(queried_user, number_of_tweets)
+        return
+
+    """ Query a user's profile. """
+    @command('query user')
+    def _query_user_command(self, msg, message):
+        # Extract the Twitter username
+        queried_user = message.replace('query user', '').strip()
+        self._query_user(queried_user)
+        return
+
+    """ The user asks the bot to monitor Twitter for a particular search term.
+    The search term goes into the list of terms, and the stream supervisor
+    reconnects the stream to track it.  The first time this happens, the
+    queue processor thread is started. """
+    @command('monitor twitter for')
+    def _monitor_twitter(self, msg, message):
+        term = message.replace('monitor twitter for', '').strip()
+        if not term:
+            self.send_message(mto=self.owner,
+                mbody="You need to specify a search term.")
+            return
+
+        # See if the new search term needs to be added to the list of
+        # things to watch for.
+        if term not in self.monitoring_terms:
+            self.monitoring_terms.append(term)
+            self.send_message(mto=self.owner,
+                mbody="Added search term '%s' to the list of things to monitor Twitter for." % term)
+        else:
+            self.send_message(mto=self.owner,
+                mbody="I'm already monitoring Twitter for the search term '%s'." % term)
+            return
+
+        if not self.queue_processor:
+            # Instantiate a queue processor thread to process the
+            # captured tweets and message the bot's owner.
+            print "\n\nInstantiating tweet queue monitoring thread.\n\n"
+            self.queue_processor = threading.Thread(
+                target=self._tweet_queue_processor,
+                name="TwitterBotQueueProcessor",
+                args=(self.monitored_tweets, ))
+            self.queue_processor.daemon = True
+            self.queue_processor.start()
+
+        self._search_terms_changed()
+        self.send_message(mto=self.owner,
+            mbody="Now monitoring Twitter's live stream for your search terms.  I'll send them to you as they arrive.")
+        return
+
+    """ The user asks for the list of active search terms. """
+    @command('list search terms')
+    def _list_search_terms(self, msg, message):
+        if len(self.monitoring_terms):
+            response = "Currently active search terms: " + str(self.monitoring_terms)
+        else:
+            response = "There are no search terms set at this time."
+        self.send_message(mto=self.owner, mbody=response)
+        return
+
+    """ Clear the list of search terms.  The stream is disconnected, but the
+    queue processor keeps running so that it's ready when monitoring starts
+    again. """
+    @command('stop monitoring', 'delete search terms')
+    def _stop_monitoring(self, msg, message):
+        # Sanity check: If the bot isn't listening for anything in
+        # particular at the moment don't do anything.
+        if not len(self.monitoring_terms):
+            self.send_message(mto=self.owner,
+                mbody="There are no active search terms.")
+            return
+
+        del self.monitoring_terms[:]
+        self._search_terms_changed()
+        self.send_message(mto=self.owner,
+            mbody="Active search terms deleted.")
+        return
+
+    """ Turn digest mode on or off. """
+    @command('digest mode')
+    def _digest_mode(self, msg, message):
+        setting = message.replace('digest mode', '').strip()
+        if setting == 'on':
+            self.digest_mode = True
+            self.send_message(mto=self.owner,
+                mbody="Digest mode is on.  I'll send you a summary of each search term's matches every %d seconds." % self.digest.interval)
+        elif setting == 'off':
+            self.digest_mode = False
+            self.digest.clear()
+            self.send_message(mto=self.owner,
+                mbody="Digest mode is off.  I'll send you tweets that match your search terms as they arrive.")
+        else:
+            self.send_message(mto=self.owner,
+                mbody="Digest mode is currently %s.  Use 'digest mode on' or 'digest mode off' to change it." % ("on" if self.digest_mode else "off"))
+        return
+
+    """ Change how often digests are sent. """
+    @command('digest interval')
+    def _digest_interval(self, msg, message):
+        try:
+            interval = int(message.replace('digest interval', '').strip())
+        except ValueError:
+            interval = 0
+        if interval <= 0:
+            self.send_message(mto=self.owner,
+                mbody="You need to specify how often (in seconds) to send digests.  I'm currently sending them every %d seconds." % self.digest.interval)
+            return
+        self.digest.set_interval(interval)
+        self.send_message(mto=self.owner,
+            mbody="I'll send digests every %d seconds." % interval)
+        return
+
+    """ Delete a search term from the list. """
+    @command('stop listening for', 'delete search term')
+    def _delete_search_term(self, msg, message):
+        # Clean out the possible commands to leave the arguments.
+        term = message.replace('stop listening for', '')
+        term = term.replace('delete search term', '').strip()
+        if not term:
+            self.send_message(mto=self.owner,
+                mbody="You need to specify a search term.")
+            return
+        try:
+            self.monitoring_terms.remove(term)
+        except:
+            self.send_message(mto=self.owner,
+                mbody="That search term doesn't exist.")
+            return
+        self.send_message(mto=self.owner,
+            mbody="Search term %s removed." % term)
+        self._search_terms_changed()
+
+        if not len(self.monitoring_terms):
+            self.send_message(mto=self.owner,
+                 mbody="The list of terms to monitor for is empty.")
+        return
+
+    """ Recompile the term router and reconnect the stream after the list of
+    search terms changes. """
+    def _search_terms_changed(self):
+        self.term_router.compile(self.monitoring_terms)
+        self.stream_supervisor.set_terms(self.term_router.track_terms())
+        self.trend_detector.watch(self.monitoring_terms)
+
+    """ Extends the base class' status report with the state of the queue of
+    monitored tweets. """
+    def _process_status(self, botname):
+        status = ExocortexBot._process_status(self, botname)
+        status = status + "\n" + self.stream_supervisor.status_report()
+        status = status + "\n" + self.stream_backfill.status_report()
+        status = status + "\n" + self.monitored_tweets.status_report()
+        if self.deduplicator:
+            status = status + "\n" + self.deduplicator.status_report()
+        status = status + "\n" + self.trend_detector.status_report()
+        status = status + "\n%d tweets are in the local archive." % len(self.tweet_index)
+        status = status + "\n" + self.my_tweets.status_report()
+        status = status + "\n" + self.user_watcher.status_report()
+        status = status + "\n" + self.api_gateway.status_report()
+        return status
+
+    """ Called by the API gateway when something the bot's owner asked for has
+    to wait for Twitter's rate limit to reset. """
+    def _rate_limited(self, endpoint, seconds):
+        self.send_message(mto=self.owner,
+            mbody="Twitter's rate limit for %s has been used up.  Your request will be sent in about %d seconds." % (endpoint, seconds))
+
+    """ Extends the base class' shutdown procedure by stopping the health
+    probe and the user watcher, disconnecting the stream, saving the queue of
+    tweets from the stream (if it's the disk-backed kind), stopping the
+    digests, and writing the tweets in the archive's memory and their
+    statistics out to disk first. """
+    def _shutdown(self, destination):
+        self.health.stop()
+        self.user_watcher.stop()
+        self.stream_supervisor.stop()
+        if isinstance(self.monitored_tweets, DurableTweetQueue):
+            self.monitored_tweets.close()
+        self.digest.stop()
+        self.tweet_index.close()
+        self.tweet_stats.save()
+        ExocortexBot._shutdown(self, destination)
+
+    """ This method only displays the status of the Twitter API server
+    connection.  It can be called by self._process_status() but doesn't have
+    to be.  It's put together from what the health probe found the last time
+    it checked, so it doesn't make any API calls. """
+    def _twitter_status(self):
+        status = self.health.status_report(self.botname) + "\n"
+        status = status + self.api_gateway.status_report() + "\n"
+        status = status + self.user_cache.status_report()
         return(status)
 
     """ Helper method that posts updates to the bot owner's Twitter feed.
@@ -553,9 +826,68 @@ class TwitterBot(ExocortexBot):
     their API, but they will let you download a package of them to use
     offline.  Inform the user about this if they ask. """
     def _get_my_tweets(self):
-        response = "The Twitter API server does not let you download your Twitter timeline.  Twitter will, however, let you download the contents of your timeline.  They'll generate a .zip file for you to download containing, among other things, a file called 'tweets.csv' which you can import into a database.\n\nClick on this link to request your tweet archive: https://twitter.com/settings/account"
+        response = "The Twitter API server does not let you download your Twitter timeline.  Twitter will, however, let you download the contents of your timeline.  They'll generate a .zip file for you to download containing, among other things, a file called 'tweets.csv' which you can import into a database.  Send it to me, or use the command 'import archive <path to tweets.csv>', and I'll import it so you can search it with 'search my tweets'.\n\nClick on this link to request your tweet archive: https://twitter.com/settings/account"
         self.send_message(mto=self.owner, mbody=response)
 
+    """ Import a tweets.csv file in a separate thread, keeping the bot's owner
+    up to date on how it's going.  If 'delete' is True the file is deleted
+    afterward. """
+    def _import_archive(self, filename, delete=False):
+        def progress(rows, read, total):
+            if total:
+                self.send_message(mto=self.owner,
+                    mbody="Imported %d tweets so far (%d%% of the file)." % (rows, 100 * read / total))
+            else:
+                self.send_message(mto=self.owner,
+                    mbody="Imported %d tweets so far." % rows)
+
+        def run():
+            self.send_message(mto=self.owner,
+                mbody="Importing your tweets from %s.  This might take a little while." % filename)
+            try:
+                (rows, elapsed) = self.my_tweets.import_csv(filename, progress)
+            except (IOError, ValueError, csv.Error, sqlite3.Error) as error:
+                self.send_message(mto=self.owner,
+                    mbody="Unable to import your tweets: %s" % error)
+                return
+            finally:
+                if delete:
+                    os.remove(filename)
+            self.send_message(mto=self.owner,
+                mbody="Imported %d tweets in %.1f seconds.  Your archive now holds %d tweets, which you can search with the command 'search my tweets <search terms>'." % (rows, elapsed, len(self.my_tweets)))
+
+        thread = threading.Thread(target=run, name="TweetArchiveImport")
+        thread.daemon = True
+        thread.start()
+
+    """ Event handler that fires when someone starts sending the bot a file.
+    Only files from the bot's owner are kept; they're assumed to be
+    tweets.csv files and go into a temporary file next to the database. """
+    def _archive_start(self, stream):
+        if stream.peer_jid.bare != self.owner:
+            return
+        (handle, filename) = tempfile.mkstemp(suffix=".csv",
+            dir=os.path.dirname(os.path.abspath(self.my_tweets.filename)))
+        self.incoming_archives[stream.sid] = (os.fdopen(handle, 'wb'),
+            filename)
+        self.send_message(mto=self.owner,
+            mbody="Receiving your tweet archive...")
+
+    """ Event handler that fires with every block of a file being sent to the
+    bot. """
+    def _archive_data(self, event):
+        incoming = self.incoming_archives.get(event['stream'].sid)
+        if incoming:
+            incoming[0].write(event['data'])
+
+    """ Event handler that fires when a file has been sent to the bot.  The
+    file gets imported. """
+    def _archive_end(self, stream):
+        incoming = self.incoming_archives.pop(stream.sid, None)
+        if incoming:
+            incoming[0].close()
+            self._import_archive(incoming[1], delete=True)
+
     """ Given a Twitter username, pull their most recent timeline activity.
     Defaults to the 20 most recent tweets, but the API server will let you
     request up to 3200 tweets. """
@@ -565,8 +897,9 @@ class TwitterBot(ExocortexBot):
 
         # Request a user timeline object from the API server.
         try:
-            user_timeline = self.api.user_timeline(screen_name=queried_user,
-                include_rts=True, count=tweet_count)
+            user_timeline = self.user_cache.timeline(queried_user,
+                tweet_count)
+            self._archive_tweets(user_timeline)
         except tweepy.error.TweepError as api_error:
             self.send_message(mto=self.owner,
                 mbody="Unable to access user's timeline.  Error message: %s." % api_error.reason)
@@ -577,15 +910,60 @@ class TwitterBot(ExocortexBot):
         # Walk through the user's most recent tweets, and for each one
         # assemble a private chat message to the bot's owner.
         for tweet in user_timeline:
-            message = str(tweet.created_at) + ": " + tweet.text
+            message = tweet.created_at_string() + ": " + tweet.text
             if tweet.coordinates:
                 message = message + "Coordinates: " + str(tweet.coordinates)
-            if tweet.entities['urls']:
-                message = message + "\n" + tweet.entities['urls'][0]['expanded_url']
+            if tweet.urls:
+                message = message + "\n" + tweet.urls[0]
             message = message + "\n"
             self.send_message(mto=self.owner, mbody=message)
         return
 
+    """ The user wants to watch what someone posts. """
+    @command('watch user')
+    def _watch_user(self, msg, message):
+        user = message.replace('watch user', '').strip().lstrip('@')
+        if not user:
+            self.send_message(mto=self.owner,
+                mbody="You need to tell me who to watch.")
+            return
+        if not self.user_watcher.watch(user):
+            self.send_message(mto=self.owner,
+                mbody="I'm already watching @%s." % user)
+            return
+        self.send_message(mto=self.owner,
+            mbody="Now watching @%s.  I'm archiving their latest tweets now, and I'll send you the new ones as they post them." % user)
+        return
+
+    """ The user wants to stop watching someone. """
+    @command('unwatch user')
+    def _unwatch_user(self, msg, message):
+        user = message.replace('unwatch user', '').strip().lstrip('@')
+        if not self.user_watcher.unwatch(user):
+            self.send_message(mto=self.owner,
+                mbody="I'm not watching @%s." % user)
+            return
+        self.send_message(mto=self.owner,
+            mbody="No longer watching @%s." % user)
+        return
+
+    """ The user wants to know who's being watched. """
+    @command('list watched users')
+    def _list_watched_users(self, msg, message):
+        users = self.user_watcher.watched()
+        if not users:
+            self.send_message(mto=msg['from'],
+                mbody="I'm not watching anyone right now.")
+            return
+        response = "I'm watching %d users:\n" % len(users)
+        for user in users:
+            response = response + "@%s: %d tweets archived" % (user.screen_name, user.tweets)
+            if user.followers_count is not None:
+                response = response + ", %d followers" % user.followers_count
+            response = response + "\n"
+        self.send_message(mto=msg['from'], mbody=response)
+        return
+
     """ Given a Twitter username, pull their profile.  Send it back to the
     bot's owner in a private chat. """
     def _query_user(self, user):
@@ -595,7 +973,7 @@ class TwitterBot(ExocortexBot):
 
         # Request a user object from the API server.
         try:
-            queried_user_profile = self.api.get_user(queried_user)
+            queried_user_profile = self.user_cache.profile(queried_user)
         except tweepy.error.TweepError as api_error:
             self.send_message(mto=self.owner,
                 mbody="Unable to pull user profile.  Error message: %s." % api_error.reason)
@@ -612,28 +990,88 @@ class TwitterBot(ExocortexBot):
         return
 
     """ This is a helper method which runs in a separate thread.  It processes
-    the queue of matching tweets by picking out useful information and sending
-    it to the bot's owner. """
+    the queue of matching tweets by throwing away duplicates and running the
+    rest through a pool of decode workers, which turn them into TweetRecords
+    and hand them to self._deliver_tweet() one at a time.  It returns when it finds the
+    termination sentinel in the queue. """
     def _tweet_queue_processor(self, queue):
         print "\n\nEntered TwitterBot._tweet_queue_processor().\n\n"
         self.send_message(mto=self.owner,
             mbody="Running self._tweet_queue_processor() in a separate thread.")
-        while True:
-            print "\n\nProcessing queue entry...\n\n"
-            tweet = queue.get()
+        pipeline = TweetPipeline(queue, self._deliver_tweet,
+            self.decode_workers, self.decode_mode, self.ordered_delivery,
+            record_tweet, prefilter=self.deduplicator)
+        pipeline.run()
 
-            # Detect 'None' as a termination sentinel in the queue.
-            if tweet is None:
-                break
-            else:
-                # Process the queue entry.
-                tweet = json.loads(tweet)
-                if 'text' in tweet:
-                    print "\n\n" + tweet['text'] + "\n\n"
-                    self.send_message(mto=self.owner, mbody=tweet['text'])
         # All done.  Bail.
         print "\nTerminating queue processor.\n"
-        queue.task_done()
+
+    """ Adds TweetRecords to the local archive, and the ones that weren't
+    already there to the statistics. """
+    def _archive_tweets(self, records):
+        for record in records:
+            if self.tweet_index.add(record):
+                self.tweet_stats.add(record)
+
+    """ Picks useful information out of a TweetRecord from the stream, tags
+    it with the search terms it matched, archives it, counts its words toward
+    the trend detector's, and either sends it to the bot's owner or saves it
+    for the next digest.  Tweets that don't match any of the search terms as
+    far as the term router is concerned are archived and counted but not
+    sent. """
+    def _deliver_tweet(self, tweet):
+        if tweet.text is not None:
+            tweet.terms = self.term_router.match(tweet.text)
+            self._archive_tweets([tweet])
+            self.trend_detector.add(tweet)
+            if not tweet.terms:
+                return
+            self.stream_backfill.record(tweet)
+            if self.digest_mode:
+                self.digest.add(tweet)
+                return
+            print "\n\n" + tweet.text + "\n\n"
+            self.send_message(mto=self.owner,
+                mbody="[%s] %s" % (", ".join(tweet.terms), tweet.text))
+
+    """ Called by the stream supervisor when the stream comes back after
+    dropping, with the terms it's tracking now.  Searches for the tweets
+    that went by while it was down. """
+    def _backfill_stream(self, track_terms):
+        self.stream_backfill.forget(list(self.monitoring_terms))
+        found = self.stream_backfill.backfill(
+            self.term_router.tracked_by(track_terms))
+        if found:
+            self.send_message(mto=self.owner,
+                mbody="The Twitter stream was reconnected.  Searching for what it missed while it was down turned up %d tweets.  The ones you haven't seen are on their way." % found)
+
+    """ Called by the trend detector when a word or hashtag starts spiking in
+    the stream, or a search term starts bursting.  The bot's owner is only
+    told about search terms and the words that are part of them. """
+    def _term_spiking(self, term, result):
+        if term in self.monitoring_terms:
+            self.send_message(mto=self.owner,
+                mbody="Tweets matching %s are coming in faster than usual: %.0f in the last few minutes, %.1f times as many as usual." % (term, result['count'], result['ratio']))
+            return
+        words = set()
+        for search_term in self.monitoring_terms:
+            words.update(word.strip('"').lstrip('#') for word in
+                search_term.lower().split() if not word.startswith('-'))
+        if term.lstrip('#') not in words:
+            return
+        self.send_message(mto=self.owner,
+            mbody="%s is spiking in the stream: %.0f tweets in the last few minutes, %.1f times as many as usual." % (term, result['count'], result['ratio']))
+
+    """ Called by the user watcher with the new tweets from someone it's
+    watching, oldest first.  Sends them to the bot's owner. """
+    def _watched_user_tweeted(self, screen_name, tweets):
+        for tweet in tweets:
+            self.send_message(mto=self.owner,
+                mbody="[@%s] %s: %s" % (screen_name, tweet.created_at_string(), tweet.text))
+
+    """ Sends a search term's digest to the bot's owner. """
+    def _send_digest(self, term, summary):
+        self.send_message(mto=self.owner, mbody=summary)
 
 # Core code...
 if __name__ == '__main__':
@@ -0,0 +1,196 @@
+#!/usr/bin/env python2
+# -*- coding: utf-8 -*-
+# vim: set expandtab tabstop=4 shiftwidth=4 :
+
+# This is an Exocortex helper class that keeps an eye on the bot's connection
+# to Twitter's API, so that asking about it doesn't cost any API calls.
+# - A thread probes the API every so often with rate_limit_status(), which is
+#   the cheapest call there is: it has its own quota, it doesn't use up any
+#   other endpoint's quota, and what it returns updates the API gateway's
+#   idea of every endpoint's quota for free.
+# - The time and latency of the last successful probe, the last error, and
+#   how many probes in a row have failed are remembered.  The status report is
+#   made from those, without talking to Twitter.
+# - A probe can be asked for at any time (e.g., when the bot starts up).  It
+#   runs in the probe thread, so the caller doesn't wait for it.
+
+# TODO:
+# -
+
+# By: The Doctor <drwho at virtadpt dot net>
+#     0x807B17C1 / 7960 1CDC 85C9 0B63 8D9F  DD89 3BD8 FF2B 807B 17C1
+
+# License: GPLv3
+# Pre-requisite modules have their own licenses.
+
+# Load modules.
+import datetime
+import sys
+import threading
+import time
+
+# The rate_limit_status() entry for rate_limit_status() itself.
+_FAMILY = 'application'
+_ENDPOINT = '/application/rate_limit_status'
+
+# Classes.
+""" This class probes the API.  It's given a tweepy API object (or anything
+else with a rate_limit_status() method), ideally one that makes background
+calls through the API gateway. """
+class TwitterHealth(object):
+    # How often (in seconds) to probe the API.
+    interval = 300
+
+    api = None
+
+    # When the last probe was made, when the last one succeeded and how long
+    # it took (in seconds), the last error, and how many probes in a row have
+    # failed.
+    last_attempt = None
+    last_success = None
+    latency = None
+    last_error = None
+    failures = 0
+
+    # How many calls to rate_limit_status() are left, and when that resets,
+    # as of the last probe.
+    remaining = None
+    reset = None
+
+    def __init__(self, api, interval=None):
+        self.api = api
+        if interval:
+            self.interval = interval
+        self.last_attempt = None
+        self.last_success = None
+        self.latency = None
+        self.last_error = None
+        self.failures = 0
+        self.remaining = None
+        self.reset = None
+        self.probes = 0
+        self.lock = threading.Lock()
+        self.wakeup = threading.Event()
+        self.stopping = False
+
+        self.thread = threading.Thread(target=self._run, name="TwitterHealth")
+        self.thread.daemon = True
+        self.thread.start()
+
+    """ This is a helper method which runs in a separate thread.  It probes
+    the API every so often, or when it's asked to. """
+    def _run(self):
+        while not self.stopping:
+            self.probe()
+            self.wakeup.wait(self.interval)
+            self.wakeup.clear()
+
+    """ Probe the API once, in the calling thread.  Returns True if it's up. """
+    def probe(self):
+        start = time.time()
+        try:
+            limits = self.api.rate_limit_status()
+        except Exception as error:
+            with self.lock:
+                self.probes += 1
+                self.last_attempt = start
+                self.last_error = getattr(error, 'reason', None) or str(error)
+                self.failures += 1
+            return False
+        finished = time.time()
+        with self.lock:
+            self.probes += 1
+            self.last_attempt = start
+            self.last_success = finished
+            self.latency = finished - start
+            self.failures = 0
+            try:
+                quota = limits['resources'][_FAMILY][_ENDPOINT]
+                self.remaining = quota['remaining']
+                self.reset = quota['reset']
+            except (KeyError, TypeError):
+                pass
+        return True
+
+    """ Ask the probe thread to probe the API now. """
+    def probe_soon(self):
+        self.wakeup.set()
+
+    """ Stop probing. """
+    def stop(self):
+        self.stopping = True
+        self.wakeup.set()
+
+    """ Return a dict of what the last probes found. """
+    def statistics(self):
+        now = time.time()
+        with self.lock:
+            return {'up': self.last_success is not None and
+                    self.failures == 0,
+                'probes': self.probes, 'failures': self.failures,
+                'last_error': self.last_error,
+                'last_attempt': now - self.last_attempt
+                    if self.last_attempt else None,
+                'last_success': now - self.last_success
+                    if self.last_success else None,
+                'latency': self.latency * 1000 if self.latency is not None
+                    else None,
+                'remaining': self.remaining, 'reset': self.reset}
+
+    """ Return what the last probes found as something that can be sent to the
+    user. """
+    def status_report(self, botname="This bot"):
+        stats = self.statistics()
+        if stats['last_attempt'] is None:
+            return "%s hasn't checked its connection to the Twitter API service yet." % botname
+        if stats['up']:
+            report = "%s has an active connection to the Twitter API service.  It was last checked %d seconds ago and answered in %.0f ms.\n" % (botname, stats['last_attempt'], stats['latency'])
+        else:
+            report = "%s can't reach the Twitter API service: %s.  The last %d checks failed" % (botname, stats['last_error'], stats['failures'])
+            if stats['last_success'] is not None:
+                report = report + ", and the last successful check was %d seconds ago" % stats['last_success']
+            report = report + ".\n"
+        if stats['remaining'] is not None:
+            reset_time = datetime.datetime.fromtimestamp(int(stats['reset'])).strftime('%H:%M:%S hours on %Y/%m/%d')
+            report = report + "This bot has " + str(stats['remaining']) + " API hits remaining until Twitter temporarily cuts it off.\n"
+            report = report + "The API hit counter will refresh at " + reset_time + "."
+        return report.rstrip()
+
+# Core code...
+if __name__ == '__main__':
+    # Self tests, with a fake API that goes down partway through.
+    class FakeAPI(object):
+        up = True
+        calls = 0
+
+        def rate_limit_status(self):
+            self.calls += 1
+            time.sleep(0.02)
+            if not self.up:
+                raise IOError("Connection refused")
+            return {'resources': {_FAMILY: {_ENDPOINT: {'limit': 180,
+                'remaining': 180 - self.calls, 'reset': time.time() + 900}}}}
+
+    api = FakeAPI()
+    health = TwitterHealth(api, interval=0.2)
+    time.sleep(0.1)
+    stats = health.statistics()
+    assert stats['up'] and stats['remaining'] == 179 and stats['latency'] >= 20
+    print health.status_report("TestBot")
+
+    # Reports don't make API calls.
+    for i in range(100):
+        health.status_report()
+    assert api.calls == 1
+
+    api.up = False
+    health.probe_soon()
+    time.sleep(0.1)
+    assert not health.statistics()['up']
+    print health.status_report("TestBot")
+    api.up = True
+    time.sleep(0.3)
+    assert health.statistics()['up']
+    health.stop()
+    sys.exit(0)
+# Fin.
@@ -34,8 +34,12 @@ class TwitterStreamListener(StreamListener):
     terms = []
     communications_channel = ""
 
+    # The StreamSupervisor that owns the stream this listener is attached to,
+    # if there is one.
+    supervisor = None
+
     """ Set up a pointer to a queue of tweets higher up in the hierarchy. """
-    def __init__(self, queue, terms, communications_channel):
+    def __init__(self, queue, terms, communications_channel, supervisor=None):
         # Call the constructor for the superclass.
         StreamListener.__init__(self)
 
@@ -43,10 +47,24 @@ class TwitterStreamListener(StreamListener):
         self.queue = queue
         self.terms = terms
         self.communications_channel = communications_channel
+        self.supervisor = supervisor
+
+    """ Let the supervisor know that Twitter accepted the connection. """
+    def on_connect(self):
+        if self.supervisor:
+            self.supervisor.connected(self)
 
     """ Every time a tweet matching one of the search terms is detected, push
     it into the queue. """
     def on_data(self, data):
+        # If the stream is supervised, the supervisor decides when it stops.
+        # A listener that's been replaced by a newer one stops its stream.
+        if self.supervisor:
+            if not self.supervisor.is_current(self):
+                return False
+            self.queue.put(data)
+            return True
+
         # Every time a tweet that matches one of the search terms comes up,
         # add it to the queue.
         self.queue.put(data)
@@ -61,12 +79,17 @@ class TwitterStreamListener(StreamListener):
             self.queue.put(None)
             return False
 
-    """ In the event of an error, send a status message to the user. """
+    """ In the event of an error, send a status message to the user.  If the
+    stream is supervised, tell the supervisor and stop the stream; the
+    supervisor reconnects it after a while. """
     def on_error(self, status):
         print "\n\nError: " + str(status) + "\n\n"
         self.communications_channel.send_message(
             mto=self.communications_channel.owner,
             mbody="An error has occurred while communicating with the Twitter API server: %s" % str(status))
+        if self.supervisor:
+            self.supervisor.disconnected(self, status)
+            return False
 
 # Core code...
 if __name__ == '__main__':
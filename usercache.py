@@ -0,0 +1,334 @@
+#!/usr/bin/env python2
+# -*- coding: utf-8 -*-
+# vim: set expandtab tabstop=4 shiftwidth=4 :
+
+# This is an Exocortex helper class that caches Twitter users' profiles and
+# timelines, so that asking about the same user over and over doesn't
+# download the same things over and over.
+# - Profiles and timelines are kept in two least-recently-used caches of a
+#   fixed size, and expire after a while (profiles change slowly, timelines
+#   quickly).
+# - An expired timeline isn't downloaded again.  Only the tweets newer than
+#   the newest one in the cache are asked for (since_id) and put in front of
+#   the ones already there.  If more tweets are asked for than are cached,
+#   only the older ones that are missing are asked for (max_id).
+# - If a refresh turns up a full page of new tweets there could be a gap
+#   between them and the cached ones, so the timeline is downloaded from
+#   scratch instead.
+# - Twitter returns at most PAGE_SIZE tweets per call, so more than that are
+#   downloaded a page at a time, each page older than the last (max_id).  A
+#   timeline is only known to be complete when a page comes back empty:
+#   Twitter throws deleted tweets out of a page after counting them, so a
+#   short page doesn't mean there aren't any more.
+# - Hits, misses, and how many API calls and tweets the cache saved are
+#   counted.
+
+# TODO:
+# -
+
+# By: The Doctor <drwho at virtadpt dot net>
+#     0x807B17C1 / 7960 1CDC 85C9 0B63 8D9F  DD89 3BD8 FF2B 807B 17C1
+
+# License: GPLv3
+# Pre-requisite modules have their own licenses.
+
+# Load modules.
+from collections import OrderedDict
+import sys
+import threading
+import time
+
+# The most tweets Twitter will return from a user's timeline, and the most it
+# returns per call.
+MAX_TIMELINE = 3200
+PAGE_SIZE = 200
+
+# Classes.
+""" This class is a cached timeline. """
+class _Timeline(object):
+    __slots__ = ('tweets', 'fetched', 'complete')
+
+    def __init__(self, tweets, fetched, complete):
+        # Tweets, newest first, when they were last brought up to date, and
+        # whether they're all of the tweets the user has.
+        self.tweets = tweets
+        self.fetched = fetched
+        self.complete = complete
+
+""" This class is the cache.  It's given a tweepy API object (or anything else
+with get_user() and user_timeline() methods), and optionally a function that
+turns the Status objects that user_timeline() returns into something else
+(like TweetRecord.from_status).  Whatever it turns them into has to have an
+id_str attribute.  Errors from the API are passed along to the caller. """
+class UserCache(object):
+    # How many users' profiles and timelines are kept, and for how long (in
+    # seconds) before they're refreshed.
+    profiles_size = 256
+    timelines_size = 64
+    profile_ttl = 900
+    timeline_ttl = 60
+
+    api = None
+    convert = None
+
+    # Lowercase screen name -> (time it was fetched, profile) or _Timeline.
+    profiles = None
+    timelines = None
+
+    # Counters.
+    profile_hits = 0
+    profile_misses = 0
+    timeline_hits = 0
+    timeline_refreshes = 0
+    timeline_misses = 0
+    calls_saved = 0
+    tweets_saved = 0
+
+    def __init__(self, api, convert=None, profiles_size=None,
+        timelines_size=None, profile_ttl=None, timeline_ttl=None):
+        self.api = api
+        self.convert = convert
+        if profiles_size:
+            self.profiles_size = profiles_size
+        if timelines_size:
+            self.timelines_size = timelines_size
+        if profile_ttl is not None:
+            self.profile_ttl = profile_ttl
+        if timeline_ttl is not None:
+            self.timeline_ttl = timeline_ttl
+        self.profiles = OrderedDict()
+        self.timelines = OrderedDict()
+        self.lock = threading.Lock()
+
+    """ Look something up in one of the caches and move it to the front.
+    Called with the lock held. """
+    def _get(self, cache, key):
+        value = cache.pop(key, None)
+        if value is not None:
+            cache[key] = value
+        return value
+
+    """ Put something into one of the caches, throwing out the least recently
+    used entry if it's full.  Called with the lock held. """
+    def _put(self, cache, key, value, size):
+        cache.pop(key, None)
+        cache[key] = value
+        while len(cache) > size:
+            cache.popitem(last=False)
+
+    """ Returns a user's profile. """
+    def profile(self, screen_name):
+        key = screen_name.lower()
+        with self.lock:
+            cached = self._get(self.profiles, key)
+            if cached and time.time() - cached[0] < self.profile_ttl:
+                self.profile_hits += 1
+                self.calls_saved += 1
+                return cached[1]
+            self.profile_misses += 1
+        profile = self.api.get_user(screen_name)
+        with self.lock:
+            self._put(self.profiles, key, (time.time(), profile),
+                self.profiles_size)
+        return profile
+
+    """ Returns up to 'count' of a user's most recent tweets, newest first. """
+    def timeline(self, screen_name, count=20):
+        count = min(count, MAX_TIMELINE)
+        key = screen_name.lower()
+        with self.lock:
+            cached = self._get(self.timelines, key)
+        now = time.time()
+
+        if cached is None:
+            (tweets, complete) = self._fetch(screen_name, count)
+            cached = _Timeline(tweets, now, complete)
+            with self.lock:
+                self.timeline_misses += 1
+        else:
+            calls = 0
+            downloaded = 0
+            fresh = now - cached.fetched < self.timeline_ttl
+            tweets = cached.tweets
+            if not fresh:
+                calls += 1
+                newer = []
+                if tweets:
+                    # Ask for the tweets posted since the newest cached one.
+                    (newer, _) = self._fetch(screen_name, PAGE_SIZE,
+                        since_id=tweets[0].id_str)
+                    downloaded += len(newer)
+                if not tweets or len(newer) >= PAGE_SIZE:
+                    # There might be a gap, or there's nothing to add the
+                    # new tweets to.  Start over.
+                    calls += 1
+                    (tweets, complete) = self._fetch(screen_name, count)
+                    downloaded += len(tweets)
+                    cached = _Timeline(tweets, now, complete)
+                else:
+                    cached = _Timeline((newer + tweets)[:MAX_TIMELINE], now,
+                        cached.complete)
+                    tweets = cached.tweets
+            if len(tweets) < count and not cached.complete:
+                # Ask for the older tweets that aren't cached.
+                calls += 1
+                (older, complete) = self._fetch(screen_name,
+                    count - len(tweets), max_id=str(int(tweets[-1].id_str) -
+                    1) if tweets else None)
+                downloaded += len(older)
+                cached.tweets = tweets + older
+                cached.complete = complete
+            with self.lock:
+                if not calls:
+                    self.timeline_hits += 1
+                    self.calls_saved += 1
+                else:
+                    self.timeline_refreshes += 1
+                self.tweets_saved += max(0, min(count, len(cached.tweets)) -
+                    downloaded)
+
+        with self.lock:
+            self._put(self.timelines, key, cached, self.timelines_size)
+        return cached.tweets[:count]
+
+    """ Ask the API for up to 'count' tweets from a user's timeline, a page
+    at a time.  Returns the tweets, and whether a page came back empty (that
+    is, there aren't any more). """
+    def _fetch(self, screen_name, count, since_id=None, max_id=None):
+        tweets = []
+        while len(tweets) < count:
+            wanted = min(PAGE_SIZE, count - len(tweets))
+            kwargs = {}
+            if since_id:
+                kwargs['since_id'] = since_id
+            if max_id:
+                kwargs['max_id'] = max_id
+            page = self.api.user_timeline(screen_name=screen_name,
+                include_rts=True, count=wanted, **kwargs)
+            if self.convert:
+                page = map(self.convert, page)
+            page = list(page)
+            if not page:
+                return (tweets, True)
+            tweets.extend(page)
+            max_id = str(int(page[-1].id_str) - 1)
+        return (tweets, False)
+
+    """ Forget everything. """
+    def clear(self):
+        with self.lock:
+            self.profiles.clear()
+            self.timelines.clear()
+
+    """ Return a dict of the cache's counters. """
+    def statistics(self):
+        with self.lock:
+            lookups = self.profile_hits + self.profile_misses
+            fetches = self.timeline_hits + self.timeline_refreshes + \
+                self.timeline_misses
+            return {'profiles': len(self.profiles),
+                'timelines': len(self.timelines),
+                'profile_hits': self.profile_hits,
+                'profile_misses': self.profile_misses,
+                'profile_percent': 100.0 * self.profile_hits / lookups
+                    if lookups else 0.0,
+                'timeline_hits': self.timeline_hits,
+                'timeline_refreshes': self.timeline_refreshes,
+                'timeline_misses': self.timeline_misses,
+                'timeline_percent': 100.0 * (self.timeline_hits +
+                    self.timeline_refreshes) / fetches if fetches else 0.0,
+                'calls_saved': self.calls_saved,
+                'tweets_saved': self.tweets_saved}
+
+    """ Return the cache's counters as something that can be sent to the
+    user. """
+    def status_report(self):
+        stats = self.statistics()
+        report = "User profile cache: %(profiles)d profiles, %(profile_hits)d hits, %(profile_misses)d misses (%(profile_percent).1f%% hit rate).\n" % stats
+        report = report + "User timeline cache: %(timelines)d timelines, %(timeline_hits)d hits, %(timeline_refreshes)d incremental refreshes, %(timeline_misses)d misses (%(timeline_percent).1f%% served at least partly from the cache).\n" % stats
+        report = report + "The cache saved %(calls_saved)d API calls and downloading %(tweets_saved)d tweets again." % stats
+        return report
+
+# Core code...
+if __name__ == '__main__':
+    # Self tests, with a fake API for a user who's posted 500 tweets, which
+    # returns up to PAGE_SIZE of them at a time like Twitter does, less any
+    # that have been deleted.
+    class FakeTweet(object):
+        def __init__(self, id_str):
+            self.id_str = id_str
+
+    class FakeAPI(object):
+        def __init__(self):
+            self.tweets = [FakeTweet(str(i)) for i in range(500, 0, -1)]
+            self.deleted = set()
+            self.calls = []
+
+        def get_user(self, screen_name):
+            self.calls.append(('get_user', screen_name))
+            return {'screen_name': screen_name}
+
+        def user_timeline(self, screen_name, include_rts, count,
+            since_id=None, max_id=None):
+            self.calls.append(('user_timeline', count, since_id, max_id))
+            tweets = [tweet for tweet in self.tweets if
+                (since_id is None or int(tweet.id_str) > int(since_id)) and
+                (max_id is None or int(tweet.id_str) <= int(max_id))]
+            return [tweet for tweet in tweets[:min(count, PAGE_SIZE)] if
+                tweet.id_str not in self.deleted]
+
+    api = FakeAPI()
+    cache = UserCache(api, timeline_ttl=0.2, profiles_size=2)
+    assert cache.profile("DrWho") == cache.profile("drwho")
+    assert len(api.calls) == 1
+    cache.profile("someone")
+    cache.profile("someone else")
+    cache.profile("drwho")
+    assert len(api.calls) == 4
+
+    ids = lambda tweets: [int(tweet.id_str) for tweet in tweets]
+    assert ids(cache.timeline("drwho", 20)) == range(500, 480, -1)
+    assert ids(cache.timeline("drwho", 10)) == range(500, 490, -1)
+    assert len(api.calls) == 5
+
+    # More tweets than are cached: only the older ones are fetched.
+    assert ids(cache.timeline("drwho", 30)) == range(500, 470, -1)
+    assert api.calls[-1] == ('user_timeline', 10, None, '480')
+
+    # New tweets: only those are fetched once the timeline has expired, until
+    # a page comes back empty.
+    api.tweets = [FakeTweet(str(i)) for i in range(505, 500, -1)] + api.tweets
+    assert ids(cache.timeline("drwho", 30)) == range(500, 470, -1)
+    time.sleep(0.3)
+    assert ids(cache.timeline("drwho", 30)) == range(505, 475, -1)
+    assert api.calls[-2:] == [('user_timeline', 200, '500', None),
+        ('user_timeline', 195, '500', '500')]
+
+    # Asking for more tweets than the user has stops at the oldest.
+    assert len(cache.timeline("drwho", 3200)) == 505
+    calls = len(api.calls)
+    assert len(cache.timeline("drwho", 1000)) == 505
+    assert len(api.calls) == calls
+
+    # Timelines longer than a page are downloaded a page at a time, and
+    # aren't complete until a page comes back empty.
+    cache = UserCache(api)
+    assert ids(cache.timeline("x", 20)) == range(505, 485, -1)
+    calls = len(api.calls)
+    assert ids(cache.timeline("x", 500)) == range(505, 5, -1)
+    assert [call[1] for call in api.calls[calls:]] == [200, 200, 80]
+    assert not cache.timelines["x"].complete
+    calls = len(api.calls)
+    assert ids(cache.timeline("x", 900)) == range(505, 0, -1)
+    assert [call[1] for call in api.calls[calls:]] == [200, 200]
+    assert cache.timelines["x"].complete
+
+    # Deleted tweets make pages come back short, but there's more after
+    # them.
+    api.deleted = set(str(i) for i in range(450, 400, -1))
+    assert ids(cache.timeline("y", 300)) == range(505, 450, -1) + \
+        range(400, 155, -1)
+    assert not cache.timelines["y"].complete
+    print cache.status_report()
+    sys.exit(0)
+# Fin.
@@ -0,0 +1,431 @@
+#!/usr/bin/env python2
+# -*- coding: utf-8 -*-
+# vim: set expandtab tabstop=4 shiftwidth=4 :
+
+# This is an Exocortex helper class that keeps an eye on what a list of
+# Twitter users are tweeting, and archives their tweets as they go by.
+# - One thread polls every watched user once a round (every five minutes by
+#   default), however many of them there are.
+# - Every round starts by asking for the profiles of the watched users, 100
+#   at a time (users/lookup), which brings their names, follower counts, and
+#   so forth up to date.  A profile comes with the user's newest tweet, so
+#   only the users who have tweeted since they were last polled need their
+#   timelines asked for.  Most rounds, most users cost 1/100th of an API call.
+# - A timeline is only asked for from the newest tweet that's already been
+#   seen (since_id), a page at a time going back from the newest (max_id), so
+#   no tweet is downloaded twice.  The first time a user is polled, only their
+#   latest page of tweets is downloaded.
+# - Users are looked up by their user ID once it's known, so renaming their
+#   account doesn't lose them.
+# - New tweets are handed to one function (which archives them) and, after
+#   the first time a user is polled, to another (which tells the bot's owner
+#   about them).
+# - The list of watched users and the newest tweet seen from each of them are
+#   saved to a JSON file after every change and every round, so nothing is
+#   downloaded again after a restart.
+
+# TODO:
+# - Protected accounts can only be watched if the bot's account follows them.
+
+# By: The Doctor <drwho at virtadpt dot net>
+#     0x807B17C1 / 7960 1CDC 85C9 0B63 8D9F  DD89 3BD8 FF2B 807B 17C1
+
+# License: GPLv3
+# Pre-requisite modules have their own licenses.
+
+# Load modules.
+import json
+import os
+import sys
+import threading
+import time
+from usercache import MAX_TIMELINE, PAGE_SIZE
+
+# The most users users/lookup will return at once.
+LOOKUP_SIZE = 100
+
+# Classes.
+""" This class is a watched user. """
+class WatchedUser(object):
+    __slots__ = ('screen_name', 'user_id', 'since_id', 'statuses_count',
+        'followers_count', 'tweets', 'polled')
+
+    def __init__(self, screen_name, user_id=None, since_id=None,
+        statuses_count=None, followers_count=None, tweets=0, polled=None):
+        self.screen_name = screen_name
+        self.user_id = user_id
+        # ID of the newest tweet seen from them.
+        self.since_id = since_id
+        self.statuses_count = statuses_count
+        self.followers_count = followers_count
+        # How many of their tweets have been archived, and when their
+        # timeline was last asked for.
+        self.tweets = tweets
+        self.polled = polled
+
+    """ Returns the user as a dict that can be turned into JSON. """
+    def to_dict(self):
+        return dict((name, getattr(self, name)) for name in self.__slots__)
+
+""" This class is the watcher.  It's given a tweepy API object (or anything
+else with lookup_users() and user_timeline() methods; ideally one that makes
+background calls through the API gateway), the function that archives new
+tweets, and optionally the function that tells the bot's owner about them
+(called with the user's screen name and their new tweets, oldest first), a
+function that turns the Status objects that user_timeline() returns into
+something else (like TweetRecord.from_status; whatever it turns them into has
+to have an id_str attribute), and the file the list of watched users is kept
+in. """
+class UserWatcher(object):
+    # How often (in seconds) every watched user is polled.
+    interval = 300
+
+    # How many pages of new tweets to download per user per round at most.
+    max_pages = MAX_TIMELINE / PAGE_SIZE
+
+    api = None
+    archive = None
+    notify = None
+    convert = None
+    filename = None
+
+    # Lowercase screen name -> WatchedUser.
+    users = None
+
+    # Counters.
+    rounds = 0
+    lookups = 0
+    timeline_calls = 0
+    skipped = 0
+    new_tweets = 0
+    last_error = None
+
+    def __init__(self, api, archive, notify=None, convert=None,
+        filename=None, interval=None):
+        self.api = api
+        self.archive = archive
+        self.notify = notify
+        self.convert = convert
+        self.filename = filename
+        if interval:
+            self.interval = interval
+        self.users = {}
+        self.rounds = 0
+        self.lookups = 0
+        self.timeline_calls = 0
+        self.skipped = 0
+        self.new_tweets = 0
+        self.last_error = None
+        self.lock = threading.Lock()
+        self.wakeup = threading.Event()
+        self.stopping = False
+        if filename and os.path.exists(filename):
+            self.load()
+
+        self.thread = threading.Thread(target=self._run, name="UserWatcher")
+        self.thread.daemon = True
+        self.thread.start()
+
+    """ Start watching a user.  They're polled right away.  Returns False if
+    they were already being watched. """
+    def watch(self, screen_name):
+        screen_name = screen_name.lstrip('@')
+        with self.lock:
+            if screen_name.lower() in self.users:
+                return False
+            self.users[screen_name.lower()] = WatchedUser(screen_name)
+        self.save()
+        self.wakeup.set()
+        return True
+
+    """ Stop watching a user.  Returns False if they weren't being watched. """
+    def unwatch(self, screen_name):
+        screen_name = screen_name.lstrip('@').lower()
+        with self.lock:
+            if screen_name not in self.users:
+                return False
+            del self.users[screen_name]
+        self.save()
+        return True
+
+    """ Returns the watched users, sorted by screen name. """
+    def watched(self):
+        with self.lock:
+            return [self.users[key] for key in sorted(self.users)]
+
+    """ This is a helper method which runs in a separate thread.  It polls the
+    watched users every interval, or as soon as a new one is added. """
+    def _run(self):
+        while not self.stopping:
+            self.wakeup.wait(self.interval)
+            self.wakeup.clear()
+            if self.stopping:
+                break
+            try:
+                self.poll()
+            except Exception as error:
+                print "ERROR: Unable to poll the watched users: %s" % error
+
+    """ Poll every watched user once, in the calling thread. """
+    def poll(self):
+        with self.lock:
+            users = self.users.values()
+        due = []
+        for start in xrange(0, len(users), LOOKUP_SIZE):
+            due.extend(self._lookup(users[start:start + LOOKUP_SIZE]))
+        for user in due:
+            self._poll(user)
+        with self.lock:
+            self.rounds += 1
+        self.save()
+
+    """ Bring a batch of users' profiles up to date.  Returns the ones who
+    need their timelines polled. """
+    def _lookup(self, users):
+        user_ids = [user.user_id for user in users if user.user_id]
+        screen_names = [user.screen_name for user in users if not
+            user.user_id]
+        try:
+            profiles = self.api.lookup_users(user_ids=user_ids or None,
+                screen_names=screen_names or None)
+        except Exception as error:
+            self._error(error)
+            return []
+        with self.lock:
+            self.lookups += 1
+        by_id = dict((profile.id_str, profile) for profile in profiles)
+        by_name = dict((profile.screen_name.lower(), profile) for profile in
+            profiles)
+
+        due = []
+        for user in users:
+            profile = by_id.get(user.user_id) if user.user_id else \
+                by_name.get(user.screen_name.lower())
+            if profile is None:
+                # Suspended, deleted, or misspelled.
+                continue
+            status = getattr(profile, 'status', None)
+            newest = getattr(status, 'id_str', None)
+            if user.since_id is None or (newest and
+                int(newest) > int(user.since_id)) or (not newest and
+                profile.statuses_count != user.statuses_count):
+                due.append(user)
+            else:
+                with self.lock:
+                    self.skipped += 1
+            user.user_id = profile.id_str
+            if user.screen_name != profile.screen_name:
+                with self.lock:
+                    if self.users.get(user.screen_name.lower()) is user:
+                        del self.users[user.screen_name.lower()]
+                        self.users[profile.screen_name.lower()] = user
+                user.screen_name = profile.screen_name
+            user.statuses_count = profile.statuses_count
+            user.followers_count = profile.followers_count
+        return due
+
+    """ Download a user's tweets since the newest one seen, and pass them
+    along. """
+    def _poll(self, user):
+        first = user.since_id is None
+        tweets = []
+        max_id = None
+        for page in xrange(1 if first else self.max_pages):
+            kwargs = {'count': PAGE_SIZE, 'include_rts': True}
+            if user.since_id:
+                kwargs['since_id'] = user.since_id
+            if max_id:
+                kwargs['max_id'] = max_id
+            try:
+                results = self.api.user_timeline(user_id=user.user_id,
+                    **kwargs) if user.user_id else \
+                    self.api.user_timeline(screen_name=user.screen_name,
+                    **kwargs)
+            except Exception as error:
+                self._error(error)
+                return
+            with self.lock:
+                self.timeline_calls += 1
+            if self.convert:
+                results = map(self.convert, results)
+            results = list(results)
+            if not results:
+                break
+            tweets.extend(results)
+            max_id = str(min(int(tweet.id_str) for tweet in results) - 1)
+            if len(results) < PAGE_SIZE:
+                break
+
+        user.polled = time.time()
+        if not tweets:
+            return
+        tweets.sort(key=lambda tweet: int(tweet.id_str))
+        user.since_id = tweets[-1].id_str
+        user.tweets += len(tweets)
+        with self.lock:
+            self.new_tweets += len(tweets)
+        self.archive(tweets)
+        if self.notify and not first:
+            try:
+                self.notify(user.screen_name, tweets)
+            except Exception as error:
+                print "ERROR: Unable to send the new tweets from @%s: %s" % (
+                    user.screen_name, error)
+
+    """ Remember an error from the API. """
+    def _error(self, error):
+        with self.lock:
+            self.last_error = getattr(error, 'reason', None) or str(error)
+
+    """ Save the list of watched users. """
+    def save(self):
+        if not self.filename:
+            return
+        with self.lock:
+            users = [user.to_dict() for user in self.users.itervalues()]
+        temporary = self.filename + ".tmp"
+        with open(temporary, "w") as output:
+            json.dump(users, output)
+        os.rename(temporary, self.filename)
+
+    """ Load the list of watched users. """
+    def load(self):
+        with open(self.filename) as saved:
+            users = [WatchedUser(**dict((str(name), value) for (name, value)
+                in user.iteritems())) for user in json.load(saved)]
+        with self.lock:
+            self.users = dict((user.screen_name.lower(), user) for user in
+                users)
+
+    """ Stop polling. """
+    def stop(self):
+        self.stopping = True
+        self.wakeup.set()
+
+    """ Return a dict of the watcher's counters. """
+    def statistics(self):
+        with self.lock:
+            polls = self.timeline_calls + self.skipped
+            return {'users': len(self.users), 'rounds': self.rounds,
+                'lookups': self.lookups,
+                'timeline_calls': self.timeline_calls,
+                'skipped': self.skipped, 'new_tweets': self.new_tweets,
+                'calls_per_poll': float(self.lookups + self.timeline_calls) /
+                    polls if polls else 0.0,
+                'last_error': self.last_error}
+
+    """ Return the watcher's counters as something that can be sent to the
+    user. """
+    def status_report(self):
+        stats = self.statistics()
+        report = "Watching %(users)d Twitter users.  %(rounds)d rounds of polling took %(lookups)d profile lookups and %(timeline_calls)d timeline downloads (%(calls_per_poll).2f API calls per user polled), skipped %(skipped)d timelines that had nothing new, and archived %(new_tweets)d tweets." % stats
+        if stats['last_error']:
+            report = report + "  The last error was: %(last_error)s." % stats
+        return report
+
+# Core code...
+if __name__ == '__main__':
+    # Self tests, with a fake API with 1000 users who have tweeted 250 times
+    # each.
+    import tempfile
+
+    class FakeTweet(object):
+        def __init__(self, id_str):
+            self.id_str = id_str
+
+    class FakeProfile(object):
+        def __init__(self, user_id, screen_name, newest, statuses_count):
+            self.id_str = str(user_id)
+            self.screen_name = screen_name
+            self.status = FakeTweet(str(newest)) if newest else None
+            self.statuses_count = statuses_count
+            self.followers_count = 42
+
+    class FakeAPI(object):
+        def __init__(self, count):
+            # User ID -> [screen name, tweet IDs, oldest first].
+            self.users = dict((i, ["User%d" % i, [i * 1000000 + j for j in
+                range(1, 251)]]) for i in range(1, count + 1))
+            self.calls = []
+
+        def lookup_users(self, user_ids=None, screen_names=None):
+            assert len(user_ids or []) + len(screen_names or []) <= 100
+            self.calls.append('lookup_users')
+            wanted = set(int(i) for i in user_ids or []) | set(i for (i,
+                user) in self.users.items() if user[0].lower() in
+                [name.lower() for name in screen_names or []])
+            return [FakeProfile(i, self.users[i][0], self.users[i][1][-1],
+                len(self.users[i][1])) for i in sorted(wanted)]
+
+        def user_timeline(self, count, include_rts, user_id=None,
+            screen_name=None, since_id=None, max_id=None):
+            self.calls.append(('user_timeline', since_id, max_id))
+            if user_id is None:
+                user_id = [i for (i, user) in self.users.items() if
+                    user[0].lower() == screen_name.lower()][0]
+            ids = [i for i in reversed(self.users[int(user_id)][1]) if
+                (since_id is None or i > int(since_id)) and
+                (max_id is None or i <= int(max_id))]
+            return [FakeTweet(str(i)) for i in ids[:count]]
+
+    archived = []
+    notified = []
+    filename = os.path.join(tempfile.mkdtemp(), "watched.json")
+    api = FakeAPI(1000)
+    watcher = UserWatcher(api, archived.extend,
+        lambda name, tweets: notified.append((name, len(tweets))),
+        filename=filename, interval=3600)
+    assert watcher.watch("@User1") and not watcher.watch("user1")
+    time.sleep(0.2)
+    assert len(archived) == 200
+    assert [int(tweet.id_str) for tweet in archived[:2]] == [1000051, 1000052]
+    assert watcher.watched()[0].since_id == "1000250"
+    assert not notified
+
+    # Nothing new: one lookup, no timeline calls.
+    del api.calls[:]
+    watcher.poll()
+    assert api.calls == ['lookup_users']
+
+    # 300 new tweets: two pages, since_id and max_id.
+    api.users[1][1].extend(range(1000251, 1000551))
+    del api.calls[:]
+    watcher.poll()
+    assert api.calls == ['lookup_users', ('user_timeline', '1000250', None),
+        ('user_timeline', '1000250', '1000350')]
+    assert notified == [("User1", 300)] and len(archived) == 500
+    assert len(set(tweet.id_str for tweet in archived)) == 500
+
+    # Renamed accounts are followed by user ID.
+    api.users[1][0] = "Renamed"
+    watcher.poll()
+    assert watcher.watched()[0].screen_name == "Renamed"
+
+    # The cost per user stays flat as the watch list grows.
+    watcher.stop()
+    for i in range(2, 1001):
+        watcher.watch("user%d" % i)
+    watcher.poll()
+    del api.calls[:]
+    watcher.poll()
+    assert api.calls == ['lookup_users'] * 10
+    for i in range(1, 1001, 100):
+        api.users[i][1].append(i * 1000000 + 999999)
+    del api.calls[:]
+    watcher.poll()
+    assert len(api.calls) == 10 + 10
+    print watcher.status_report()
+
+    # The list of watched users and what's been seen survive a restart.
+    watcher = UserWatcher(api, archived.extend, filename=filename,
+        interval=3600)
+    watcher.stop()
+    assert len(watcher.watched()) == 1000
+    del api.calls[:]
+    watcher.poll()
+    assert api.calls == ['lookup_users'] * 10
+
+    assert watcher.unwatch("renamed") and not watcher.unwatch("renamed")
+    assert len(watcher.watched()) == 999
+    sys.exit(0)
+# Fin.